@@ -0,0 +1,113 @@
+"""Бэкапы БД.
+
+Снимок через sqlite3 backup API по BACKUP_PAGES страниц за шаг: писатели блокируются
+не дольше одного шага. Снимок проверяется integrity_check, сжимается gzip и ротируется.
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+import glob, gzip, logging, os, secrets, shutil, sqlite3, tarfile, tempfile, time
+from datetime import datetime
+from contextlib import closing
+from config import *
+from utils import hash_password
+from db import DBRoute, file_lock, archive_path, archive_years
+
+logger = logging.getLogger(__name__)
+router = APIRouter(route_class=DBRoute)
+
+def list_backups():
+    # с шардами или архивами бэкап — tar.gz из всех файлов
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, "barbercrm_*.db.gz")) + glob.glob(os.path.join(BACKUP_DIR, "barbercrm_*.tar.gz")), reverse=True)
+
+def snapshot(path, tmp):
+    """Онлайн-копия файла БД через backup API с integrity_check"""
+    src, dst = sqlite3.connect(path), sqlite3.connect(tmp)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES, sleep=0.005)
+        dst.execute("PRAGMA journal_mode=DELETE")  # снимок — один самодостаточный файл
+        check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        src.close(); dst.close()
+    if check != "ok":
+        os.remove(tmp); raise RuntimeError(f"integrity_check {os.path.basename(path)}: {check}")
+    return check
+
+def backup_files():
+    """(файл, имя в снимке): общая БД или каталог, файлы филиалов и архивы лет — без архивов восстановление теряло бы старую историю"""
+    files = [(DB_PATH, "catalog.db")]
+    if SHARD_DIR: files += [(f, f"shards/{os.path.basename(f)}") for f in sorted(glob.glob(os.path.join(SHARD_DIR, "branch_*.db")))]
+    return files + [(archive_path(y), f"archives/{os.path.basename(archive_path(y))}") for y in archive_years()]
+
+def create_backup():
+    with file_lock("backup", blocking=False) as locked:
+        if not locked: raise HTTPException(409, "Бэкап уже выполняется")
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        t0 = time.time()
+        files = backup_files()
+        if len(files) > 1: out, check = backup_set(ts, files)
+        else:
+            tmp, out = os.path.join(BACKUP_DIR, f".snapshot_{ts}.db"), os.path.join(BACKUP_DIR, f"barbercrm_{ts}.db.gz")
+            check = snapshot(DB_PATH, tmp)
+            with open(tmp, "rb") as f, gzip.open(out + ".tmp", "wb", compresslevel=6) as g: shutil.copyfileobj(f, g)
+            os.replace(out + ".tmp", out); os.remove(tmp)
+        for old in list_backups()[BACKUP_KEEP:]: os.remove(old)
+        logger.info(f"💾 Бэкап {os.path.basename(out)}: файлов {len(files)} ({time.time()-t0:.1f} с)")
+        return {"file": os.path.basename(out), "size": os.path.getsize(out), "files": len(files), "integrity": check, "seconds": round(time.time() - t0, 2)}
+
+def backup_set(ts, files):
+    """Снимки нескольких файлов в один barbercrm_<ts>.tar.gz (catalog.db, shards/*.db, archives/*.db)"""
+    out = os.path.join(BACKUP_DIR, f"barbercrm_{ts}.tar.gz")
+    with tempfile.TemporaryDirectory(dir=BACKUP_DIR) as tmp:
+        with tarfile.open(out + ".tmp", "w:gz", compresslevel=6) as tar:
+            for path, name in files:
+                snap = os.path.join(tmp, os.path.basename(name))
+                snapshot(path, snap)
+                tar.add(snap, arcname=name); os.remove(snap)
+    os.replace(out + ".tmp", out)
+    return out, "ok"
+
+def restore_backup(path):
+    """Восстановление из .db.gz (или .tar.gz с шардами и архивами): распаковка, integrity_check, затем backup API поверх рабочих файлов"""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(DB_PATH)) as tmp:
+        if path.endswith(".tar.gz"):
+            with tarfile.open(path, "r:gz") as tar: tar.extractall(tmp, filter="data")
+            shards = glob.glob(os.path.join(tmp, "shards", "*.db"))
+            if shards and not SHARD_DIR: raise RuntimeError("Бэкап с шардами — задайте SHARD_DIR")
+            pairs = ([(os.path.join(tmp, "catalog.db"), DB_PATH)] + [(f, os.path.join(SHARD_DIR, os.path.basename(f))) for f in shards]
+                     + [(f, os.path.join(ARCHIVE_DIR, os.path.basename(f))) for f in glob.glob(os.path.join(tmp, "archives", "archive_*.db"))])
+            for d in {os.path.dirname(dst) for _, dst in pairs}: os.makedirs(d, exist_ok=True)
+        else:
+            pairs = [(os.path.join(tmp, "restore.db"), DB_PATH)]
+            with gzip.open(path, "rb") as g, open(pairs[0][0], "wb") as f: shutil.copyfileobj(g, f)
+        # сначала проверяются все файлы, чтобы не восстановить половину
+        for src_path, _ in pairs:
+            with closing(sqlite3.connect(src_path)) as src:
+                check = src.execute("PRAGMA integrity_check").fetchone()[0]
+            if check != "ok": raise RuntimeError(f"Бэкап повреждён ({os.path.basename(src_path)}): {check}")
+        for src_path, dst_path in pairs:
+            with closing(sqlite3.connect(src_path)) as src, closing(sqlite3.connect(dst_path)) as dst: src.backup(dst, pages=BACKUP_PAGES)
+    return {"restored_from": os.path.basename(path), "integrity": check, "files": len(pairs)}
+
+@router.post("/admin/backup")
+def admin_backup():
+    return {"success": True, **create_backup()}
+
+@router.get("/admin/backups")
+def admin_list_backups():
+    return {"success": True, "backups": [{"file": os.path.basename(p), "size": os.path.getsize(p),
+        "created_at": datetime.fromtimestamp(os.path.getmtime(p)).strftime("%Y-%m-%d %H:%M:%S")} for p in list_backups()]}
+
+def require_admin(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    """HTTP Basic с логином и паролем администратора из настроек"""
+    user_ok = secrets.compare_digest(credentials.username.encode(), ADMIN_USERNAME.encode())
+    password_ok = secrets.compare_digest(hash_password(credentials.password), ADMIN_PASSWORD_HASH)
+    if not (user_ok and password_ok): raise HTTPException(401, "Неверный логин или пароль администратора", headers={"WWW-Authenticate": "Basic"})
+
+@router.get("/admin/backups/latest")
+def admin_download_latest_backup(_: None = Depends(require_admin)):
+    """Последний снимок файлом — в нём хэши паролей и токены филиалов, поэтому только с паролем администратора"""
+    backups = list_backups()
+    if not backups: raise HTTPException(404, "Бэкапов ещё нет")
+    return FileResponse(backups[0], media_type="application/gzip", filename=os.path.basename(backups[0]))
@@ -0,0 +1,94 @@
+"""Настройки из переменных окружения и общие константы"""
+import hashlib, os
+
+REPORT_EMAIL_TO = os.getenv('REPORT_EMAIL_TO', '')
+SMTP_HOST = os.getenv('SMTP_HOST', '')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_USER = os.getenv('SMTP_USER', '')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
+SMTP_USE_SSL = os.getenv('SMTP_USE_SSL', 'false').lower() == 'true'
+ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
+ADMIN_PASSWORD_HASH = hashlib.sha256(os.getenv('ADMIN_PASSWORD', 'admin').encode()).hexdigest()
+DB_PATH = os.getenv('DB_PATH', '/app/data/barbercrm.db')
+SHARD_DIR = os.getenv('SHARD_DIR', '')  # пусто — все филиалы в DB_PATH; иначе — файл на филиал, в DB_PATH остаётся каталог
+SHARD_FANOUT = int(os.getenv('SHARD_FANOUT', '8'))  # сколько шардов опрашивается параллельно
+DELETE_CHUNK_SIZE = int(os.getenv('DELETE_CHUNK_SIZE', '500'))
+DELETE_CHUNK_PAUSE = float(os.getenv('DELETE_CHUNK_PAUSE', '0.05'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.dirname(DB_PATH))
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '24'))  # 0 = архивирование выключено
+ARCHIVE_HOUR = int(os.getenv('ARCHIVE_HOUR', '3'))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', '1000'))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))  # воркеров uvicorn (uvicorn читает ту же переменную)
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', str(min(4, max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))))  # процессов отчётов на воркер
+DB_WORKERS = int(os.getenv('DB_WORKERS', '8'))  # потоков для работы с SQLite
+REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH), 'report_cache'))
+REPORT_CACHE_MAX_MB = int(os.getenv('REPORT_CACHE_MAX_MB', '200'))
+REPORT_PREBUILD_HOUR = int(os.getenv('REPORT_PREBUILD_HOUR')) if os.getenv('REPORT_PREBUILD_HOUR') else None
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(DB_PATH), 'backups'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_HOUR = int(os.getenv('BACKUP_HOUR', '2')) if os.getenv('BACKUP_HOUR', '2') else None
+BACKUP_PAGES = int(os.getenv('BACKUP_PAGES', '256'))  # страниц за шаг backup API
+CHANGES_KEEP_DAYS = int(os.getenv('CHANGES_KEEP_DAYS', '7'))
+STREAM_POLL_SECONDS = float(os.getenv('STREAM_POLL_SECONDS', '1'))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv('STREAM_HEARTBEAT_SECONDS', '15'))
+# Сколько тяжёлых запросов каждого вида выполняется одновременно; остальные ждут до ADMISSION_WAIT_SECONDS, затем 429
+ROUTE_LIMITS = {"report": int(os.getenv('REPORT_CONCURRENCY', '2')), "network-report": int(os.getenv('NETWORK_REPORT_CONCURRENCY', '1')),
+                "export": int(os.getenv('EXPORT_CONCURRENCY', '2'))}
+ADMISSION_WAIT_SECONDS = float(os.getenv('ADMISSION_WAIT_SECONDS', '10'))
+# Профиль SQLite на каждое соединение; 0 / DEFAULT — оставить значение SQLite по умолчанию
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', '64'))
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', '256'))
+SQLITE_TEMP_STORE = os.getenv('SQLITE_TEMP_STORE', 'MEMORY').upper()
+MAINTENANCE_HOUR = int(os.getenv('MAINTENANCE_HOUR', '4'))
+CHECKPOINT_EVERY = int(os.getenv('CHECKPOINT_EVERY', '600'))  # проверка тишины для wal_checkpoint(TRUNCATE), секунд
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', '500'))  # сколько отклонённых строк вернуть в отчёте
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '2000'))  # строк за транзакцию при заполнении ключей
+BACKFILL_CHUNK_PAUSE = float(os.getenv('BACKFILL_CHUNK_PAUSE', '0.05'))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))  # строк за одно чтение курсора при выгрузке
+
+BRANCH_GOALS = {"morning_events": 16, "field_visits": 4, "one_on_one": 6, "weekly_reports": 4, "master_plans": 10, "reviews": 52, "new_employees": 10}
+SECTION_TABLES = ["morning_events","field_visits","one_on_one","weekly_metrics","master_plans","reviews","newbie_adaptation","branch_summaries"]
+# Полнотекстовый поиск: секция → таблица, индексируемые поля, поле-заголовок и дата
+SEARCH_CONFIG = {
+    "one-on-one": {"table": "one_on_one", "fields": ["master_name","goal","results","development_plan"], "title": "master_name", "date": "date"},
+    "field-visits": {"table": "field_visits", "fields": ["master_name","additional_services_comment","cosmetics_comment","standards_comment","errors_comment"], "title": "master_name", "date": "date"},
+    "morning-events": {"table": "morning_events", "fields": ["event_type","comment"], "title": "event_type", "date": "date"},
+}
+# Секции: таблица, колонки выгрузки с русскими заголовками, редактируемые поля
+SECTION_CONFIG = {
+    "morning-events": {
+        "table": "morning_events",
+        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', week as 'Неделя', event_type as 'Тип мероприятия', participants as 'Участники', efficiency as 'Эффективность', comment as 'Комментарий'",
+        "update_fields": {"date":"date","week":"week","event_type":"event_type","participants":"participants","efficiency":"efficiency","comment":"comment"},
+    },
+    "field-visits": {
+        "table": "field_visits",
+        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', master_name as 'Имя мастера', haircut_quality as 'Качество стрижки', service_quality as 'Качество обслуживания', additional_services_comment as 'Доп. услуги (комм.)', additional_services_rating as 'Доп. услуги (оценка)', cosmetics_comment as 'Косметика (комм.)', cosmetics_rating as 'Косметика (оценка)', standards_comment as 'Стандарты (комм.)', standards_rating as 'Стандарты (оценка)', errors_comment as 'Ошибки', next_check_date as 'Дата след. проверки', average_rating as 'Общая оценка'",
+    },
+    "one-on-one": {
+        "table": "one_on_one",
+        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', master_name as 'Имя мастера', goal as 'Цель', results as 'Результаты', development_plan as 'План развития', indicator as 'Показатель', next_meeting_date as 'Дата след. встречи'",
+    },
+    "weekly-metrics": {
+        "table": "weekly_metrics",
+        "select": "id, submitted_at as 'Дата отправки', period as 'Период', average_check_plan as 'Средний чек (план)', average_check_fact as 'Средний чек (факт)', cosmetics_plan as 'Косметика (план)', cosmetics_fact as 'Косметика (факт)', additional_services_plan as 'Доп. услуги (план)', additional_services_fact as 'Доп. услуги (факт)'",
+    },
+    "master-plans": {
+        "table": "master_plans",
+        "select": "id, submitted_at as 'Дата отправки', month as 'Месяц', master_name as 'Имя мастера', average_check_plan as 'Средний чек (план)', average_check_fact as 'Средний чек (факт)', additional_services_plan as 'Доп. услуги (план)', additional_services_fact as 'Доп. услуги (факт)', sales_plan as 'Продажи (план)', sales_fact as 'Продажи (факт)', salary_plan as 'ЗП (план)', salary_fact as 'ЗП (факт)'",
+    },
+    "reviews": {
+        "table": "reviews",
+        "select": "id, submitted_at as 'Дата отправки', week as 'Неделя', manager_name as 'Имя руководителя', plan as 'План', fact as 'Факт', monthly_target as 'Месячная цель'",
+    },
+    "newbie-adaptation": {
+        "table": "newbie_adaptation",
+        "select": "id, submitted_at as 'Дата отправки', start_date as 'Дата начала', name as 'Имя', haircut_practice as 'Практика стрижки', service_standards as 'Стандарты обслуживания', hygiene_sanitation as 'Гигиена/санитария', additional_services as 'Доп. услуги', cosmetics_sales as 'Продажи косметики', iclient_basics as 'Основы iClient', status as 'Статус'",
+    },
+    "branch-summary": {
+        "table": "branch_summaries",
+        "select": "id, submitted_at as 'Дата отправки', manager as 'Руководитель', month as 'Месяц', metric as 'Метрика', current_value as 'Текущее количество', goal_value as 'Цель на месяц', percentage as 'Выполнение %'",
+    },
+}
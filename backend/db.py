@@ -0,0 +1,621 @@
+"""Хранилище: соединения SQLite (общая БД или шард филиала), пул DB_EXECUTOR, схема, ключи измерений, сводка мастеров и архивы"""
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+import asyncio, contextvars, fcntl, functools, glob, hashlib, logging, os, re, sqlite3, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+from datetime import datetime
+from config import *
+from utils import parse_date_flexible
+
+logger = logging.getLogger(__name__)
+
+# ============= DATABASE =============
+def apply_storage_profile(conn):
+    if SQLITE_SYNCHRONOUS != "DEFAULT": conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    if SQLITE_CACHE_MB: conn.execute(f"PRAGMA cache_size={-SQLITE_CACHE_MB * 1024}")
+    if SQLITE_MMAP_MB: conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    if SQLITE_TEMP_STORE != "DEFAULT": conn.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
+
+@contextmanager
+def get_db(readonly=False, **connect):
+    """Соединение с БД; в режиме шардов внутри use_shard(филиал) — с файлом филиала, каталог подключён как catalog"""
+    shard = _shard.get() if SHARD_DIR else None
+    path = shard_path(shard) if shard else DB_PATH
+    if shard and not os.path.exists(path): raise HTTPException(404, f"Филиал '{shard}' не найден")
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, **connect)
+        conn.row_factory = sqlite3.Row
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, **connect)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+    # имена без схемы ищутся сначала в main (шард), затем в catalog — branches и прочие общие таблицы находятся сами
+    if shard: conn.execute("ATTACH DATABASE ? AS catalog", (f"file:{DB_PATH}?mode=ro" if readonly else DB_PATH,))
+    apply_storage_profile(conn)
+    sync_shared_state(conn)
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# Обработчики — async def; блокирующие обращения к SQLite идут в свой ограниченный пул DB_WORKERS потоков,
+# чтобы SMTP и прочий блокирующий ввод-вывод (общий пул anyio) и сборка XLSX (пул процессов) их не вытесняли.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+class DBRoute(APIRoute):
+    """Синхронный обработчик становится async def, тело которого выполняется в DB_EXECUTOR"""
+    def __init__(self, path, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            sync = endpoint
+            @functools.wraps(sync)
+            async def endpoint(**kw): return await run_db(routed, sync, kw)
+        super().__init__(path, endpoint, **kwargs)
+
+def routed(fn, kw):
+    """Обработчик с {branch_name} в пути работает с шардом этого филиала"""
+    with use_shard(kw.get("branch_name")): return fn(**kw)
+
+# Файл соединения: общая БД или шард филиала из use_shard (сами шарды — в shards.py)
+_shard = contextvars.ContextVar("shard", default=None)
+
+def shard_path(branch_name):
+    safe = re.sub(r"[^\w-]+", "_", branch_name)[:40]
+    return os.path.join(SHARD_DIR, f"branch_{safe}_{hashlib.sha1(branch_name.encode()).hexdigest()[:8]}.db")
+
+@contextmanager
+def use_shard(branch_name):
+    token = _shard.set(branch_name)
+    try: yield
+    finally: _shard.reset(token)
+
+def live_branch_names():
+    with get_db() as conn:
+        return [r['name'] for r in conn.execute("SELECT name FROM branches WHERE deleted_at IS NULL ORDER BY name").fetchall()]
+
+# ============= НЕСКОЛЬКО ВОРКЕРОВ =============
+# uvicorn --workers N (WEB_CONCURRENCY) запускает N процессов над одной БД. Первый, кто взял flock DB_PATH.leader.lock,
+# становится ведущим: выполняет init_db и миграции, фоновые задачи и продолжение удалений. Остальные только отвечают
+# на запросы и перехватывают роль, если ведущий завершился. Кэши в памяти процесса сверяются с версиями в shared_versions.
+_leader = None
+_shared_seen = {}
+
+@contextmanager
+def file_lock(name, blocking=True):
+    """flock на DB_PATH.<name>.lock — общий для всех воркеров; без blocking при занятом замке отдаёт False"""
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    with open(f"{DB_PATH}.{name}.lock", "a") as f:
+        try: fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False; return
+        try: yield True
+        finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+def try_lead():
+    """True, если процесс ведущий; замок держится до завершения процесса"""
+    global _leader
+    if _leader is None:
+        f = open(f"{DB_PATH}.leader.lock", "a")
+        try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close(); return False
+        _leader = f
+        logger.info(f"👑 Процесс {os.getpid()} — ведущий")
+    return True
+
+def is_leader(): return _leader is not None
+
+def bump_shared_version(conn, name):
+    conn.execute("INSERT INTO shared_versions (name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1", (name,))
+
+def sync_shared_state(conn):
+    """Сбрасывает кэши процесса, чья версия в shared_versions сменилась (запись сделал другой воркер)"""
+    global DIM_READY
+    try: rows = conn.execute("SELECT name, version FROM shared_versions").fetchall()
+    except sqlite3.OperationalError: return  # до первого init_db таблицы нет
+    for name, version in rows:
+        if _shared_seen.get(name) == version: continue
+        _shared_seen[name] = version
+        if name == "branches": _branch_ids.clear()
+        elif name == "dimensions": DIM_READY = True
+
+# ============= СХЕМА =============
+# changes есть в обоих наборах: в каталоге в неё пишут триггеры branches, в данных — триггеры секций
+CATALOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS branches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL, address TEXT NOT NULL,
+        manager_name TEXT NOT NULL, manager_phone TEXT NOT NULL,
+        password_hash TEXT NOT NULL, token TEXT NOT NULL, created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, record_id INTEGER NOT NULL,
+        op TEXT NOT NULL, branch_name TEXT NOT NULL, changed_at TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_changes_branch ON changes(branch_name, seq);
+    CREATE TABLE IF NOT EXISTS shared_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0);
+    CREATE TRIGGER IF NOT EXISTS branches_shared_ad AFTER DELETE ON branches BEGIN
+        INSERT INTO shared_versions (name, version) VALUES ('branches', 1) ON CONFLICT(name) DO UPDATE SET version = version + 1;
+    END;
+    CREATE TABLE IF NOT EXISTS job_runs (
+        name TEXT PRIMARY KEY, last_run TEXT NOT NULL, last_duration REAL, last_result TEXT, last_error TEXT, pid INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS branch_deletions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        status TEXT NOT NULL, total_rows INTEGER NOT NULL DEFAULT 0,
+        deleted_rows INTEGER NOT NULL DEFAULT 0, started_at TEXT NOT NULL,
+        finished_at TEXT DEFAULT NULL, error TEXT DEFAULT ''
+    );
+"""
+DATA_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS morning_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, date TEXT NOT NULL, week INTEGER NOT NULL,
+        event_type TEXT NOT NULL, participants INTEGER NOT NULL,
+        efficiency INTEGER NOT NULL, comment TEXT DEFAULT ''
+    );
+    CREATE TABLE IF NOT EXISTS field_visits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, date TEXT NOT NULL, master_name TEXT NOT NULL,
+        haircut_quality INTEGER NOT NULL, service_quality INTEGER NOT NULL,
+        additional_services_comment TEXT DEFAULT '', additional_services_rating INTEGER NOT NULL,
+        cosmetics_comment TEXT DEFAULT '', cosmetics_rating INTEGER NOT NULL,
+        standards_comment TEXT DEFAULT '', standards_rating INTEGER NOT NULL,
+        errors_comment TEXT DEFAULT '', next_check_date TEXT DEFAULT '', average_rating REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS one_on_one (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, date TEXT NOT NULL, master_name TEXT NOT NULL,
+        goal TEXT NOT NULL, results TEXT NOT NULL, development_plan TEXT NOT NULL,
+        indicator TEXT NOT NULL, next_meeting_date TEXT DEFAULT ''
+    );
+    CREATE TABLE IF NOT EXISTS weekly_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, period TEXT NOT NULL,
+        average_check_plan REAL NOT NULL, average_check_fact REAL NOT NULL,
+        cosmetics_plan REAL NOT NULL, cosmetics_fact REAL NOT NULL,
+        additional_services_plan REAL NOT NULL, additional_services_fact REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS master_plans (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, month TEXT NOT NULL, master_name TEXT NOT NULL,
+        average_check_plan REAL NOT NULL, average_check_fact REAL NOT NULL,
+        additional_services_plan INTEGER NOT NULL, additional_services_fact INTEGER NOT NULL,
+        sales_plan REAL NOT NULL, sales_fact REAL NOT NULL,
+        salary_plan REAL NOT NULL, salary_fact REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, week TEXT NOT NULL, manager_name TEXT NOT NULL,
+        plan INTEGER NOT NULL DEFAULT 13, fact INTEGER NOT NULL, monthly_target INTEGER NOT NULL DEFAULT 52
+    );
+    CREATE TABLE IF NOT EXISTS newbie_adaptation (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, start_date TEXT NOT NULL, name TEXT NOT NULL,
+        haircut_practice TEXT NOT NULL, service_standards TEXT NOT NULL,
+        hygiene_sanitation TEXT NOT NULL, additional_services TEXT NOT NULL,
+        cosmetics_sales TEXT NOT NULL, iclient_basics TEXT NOT NULL, status TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS branch_summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
+        submitted_at TEXT NOT NULL, manager TEXT NOT NULL, month TEXT NOT NULL,
+        metric TEXT NOT NULL, current_value INTEGER NOT NULL,
+        goal_value INTEGER NOT NULL, percentage REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS master_rollup (
+        branch_name TEXT NOT NULL, master_name TEXT NOT NULL,
+        visits_count INTEGER NOT NULL DEFAULT 0, last_visit_date TEXT DEFAULT NULL,
+        last_average_rating REAL DEFAULT NULL, avg_rating REAL DEFAULT NULL,
+        plan_month TEXT DEFAULT NULL, average_check_pct REAL DEFAULT NULL,
+        additional_services_pct REAL DEFAULT NULL, sales_pct REAL DEFAULT NULL, salary_pct REAL DEFAULT NULL,
+        one_on_one_count INTEGER NOT NULL DEFAULT 0, last_one_on_one_date TEXT DEFAULT NULL,
+        updated_at TEXT NOT NULL, PRIMARY KEY (branch_name, master_name)
+    );
+    CREATE TABLE IF NOT EXISTS data_versions (
+        branch_name TEXT NOT NULL, table_name TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (branch_name, table_name)
+    );
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, record_id INTEGER NOT NULL,
+        op TEXT NOT NULL, branch_name TEXT NOT NULL, changed_at TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_changes_branch ON changes(branch_name, seq);
+    CREATE TABLE IF NOT EXISTS masters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_id INTEGER NOT NULL, name TEXT NOT NULL, UNIQUE (branch_id, name)
+    );
+    CREATE TABLE IF NOT EXISTS managers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, branch_id INTEGER NOT NULL, name TEXT NOT NULL, UNIQUE (branch_id, name)
+    );
+"""
+
+def init_catalog():
+    """Каталог (без шардов — и таблицы секций); с шардами отдаёт живые филиалы, чьи файлы создаст shards.init_shard"""
+    with get_db() as conn:
+        conn.executescript(CATALOG_SCHEMA)
+        add_column_if_missing(conn, "branches", "deleted_at", "TEXT DEFAULT NULL")
+        add_column_if_missing(conn, "branch_deletions", "owner_pid", "INTEGER DEFAULT NULL")
+        init_change_log(conn, ["branches"])
+        if not SHARD_DIR:
+            init_data(conn); return []
+        global DIM_READY
+        DIM_READY = True  # шарды создаются уже с ключами, см. init_shard и split_into_shards
+        conn.execute("INSERT OR IGNORE INTO shared_versions (name, version) VALUES ('dimensions', 1)")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='morning_events'").fetchone():
+            logger.warning("⚠️ В DB_PATH остались таблицы секций — перенесите их в шарды: python main.py shard")
+        return conn.execute("SELECT id, name FROM branches WHERE deleted_at IS NULL").fetchall()
+
+def init_data(conn, shard=False):
+    """Таблицы секций, ключи, индексы, поиск, версии и лента — в общей БД или в шарде филиала"""
+    conn.executescript(DATA_SCHEMA)
+    for t in SECTION_TABLES:
+        add_column_if_missing(conn, t, "branch_id", "INTEGER DEFAULT NULL")
+        if t in DIM_COLUMNS: add_column_if_missing(conn, t, DIM_COLUMNS[t][2], "INTEGER DEFAULT NULL")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{t}_bid ON {t}(branch_id, submitted_at)")
+    for t in MASTER_TABLES: conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{t}_master ON {t}(master_id)")
+    # AFTER UPDATE-триггеры, созданные до ключей, пересоздаются ниже уже с DIM_BACKFILL_GUARD
+    for r in conn.execute(f"""SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name IN ({','.join('?'*len(SECTION_TABLES))})
+            AND name LIKE '%au' AND sql NOT LIKE '%branch_id IS NULL%'""", SECTION_TABLES).fetchall():
+        conn.execute(f"DROP TRIGGER {r[0]}")
+    if not shard:
+        global DIM_READY
+        DIM_READY = not dimension_backlog(conn)
+        if DIM_READY: conn.execute("INSERT OR IGNORE INTO shared_versions (name, version) VALUES ('dimensions', 1)")
+        else: conn.execute("DELETE FROM shared_versions WHERE name='dimensions'")
+        # пока ключи заполняются, фильтры идут по branch_name — его индекс нужен до конца миграции
+        if not DIM_READY:
+            for t in SECTION_TABLES: conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{t}_branch ON {t}(branch_name, submitted_at)")
+    init_search(conn)
+    init_data_versions(conn)
+    init_change_log(conn, SECTION_TABLES)
+    if not conn.execute("SELECT 1 FROM master_rollup LIMIT 1").fetchone(): rebuild_master_rollup(conn)
+    # без sqlite_stat1 планировщик не знает селективность индексов
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone(): conn.execute("ANALYZE main")
+    if not shard: logger.info("✅ БД инициализирована")
+
+def init_data_versions(conn):
+    """Счётчик версии данных (филиал, таблица) — увеличивается триггерами при любой записи"""
+    for t in SECTION_TABLES:
+        for suffix, event, row, when in [("ai", "INSERT", "new", ""), ("au", "UPDATE", "new", DIM_BACKFILL_GUARD), ("ad", "DELETE", "old", "")]:
+            conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {t}_ver_{suffix} AFTER {event} ON {t} {when} BEGIN
+                INSERT INTO data_versions (branch_name, table_name, version) VALUES ({row}.branch_name, '{t}', 1)
+                ON CONFLICT(branch_name, table_name) DO UPDATE SET version = version + 1;
+            END""")
+
+def init_change_log(conn, tables):
+    """Лента изменений: триггеры пишут в changes (seq, таблица, id записи, операция, филиал)"""
+    targets = [(t, "id", "branch_name", "", DIM_BACKFILL_GUARD) if t != "branches" else ("branches", "id", "name", " OF address, manager_name, manager_phone, deleted_at", "") for t in tables]
+    for t, rid, bn, cols, guard in targets:
+        for suffix, event, row, when in [("ai", "INSERT", "new", ""), ("au", f"UPDATE{cols}", "new", guard), ("ad", "DELETE", "old", "")]:
+            conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {t}_chg_{suffix} AFTER {event} ON {t} {when} BEGIN
+                INSERT INTO changes (table_name, record_id, op, branch_name) VALUES ('{t}', {row}.{rid}, '{event.split()[0].lower()}', {row}.{bn});
+            END""")
+
+def log_change(conn, table, record_id, op, branch_name):
+    """Для записей в архивных файлах — на них триггеров нет"""
+    conn.execute("INSERT INTO main.changes (table_name, record_id, op, branch_name) VALUES (?, ?, ?, ?)", (table, record_id, op, branch_name))
+
+def log_branch_change(conn, bid, op, branch_name):
+    """С шардами триггеры branches пишут в ленту каталога, а /changes?branch= читает ленту шарда — событие
+    филиала (профиль, удаление) дублируется туда явно. conn — соединение с шардом этого филиала"""
+    if SHARD_DIR: log_change(conn, "branches", bid, op, branch_name)
+
+def bump_data_version(conn, branch_name, table):
+    """Для записей в архивных файлах — на них триггеров нет"""
+    conn.execute("""INSERT INTO main.data_versions (branch_name, table_name, version) VALUES (?, ?, 1)
+        ON CONFLICT(branch_name, table_name) DO UPDATE SET version = version + 1""", (branch_name, table))
+
+def init_search(conn):
+    """FTS5-таблицы поверх текстовых полей секций, синхронизируются триггерами"""
+    for cfg in SEARCH_CONFIG.values():
+        t, f = cfg['table'], cfg['fields']
+        cols, new, old = ', '.join(f), ', '.join(f"new.{c}" for c in f), ', '.join(f"old.{c}" for c in f)
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (f"{t}_fts",)).fetchone()
+        conn.executescript(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {t}_fts USING fts5({cols}, branch_name UNINDEXED,
+            content='{t}', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+        CREATE TRIGGER IF NOT EXISTS {t}_fts_ai AFTER INSERT ON {t} BEGIN
+            INSERT INTO {t}_fts(rowid, {cols}, branch_name) VALUES (new.id, {new}, new.branch_name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {t}_fts_ad AFTER DELETE ON {t} BEGIN
+            INSERT INTO {t}_fts({t}_fts, rowid, {cols}, branch_name) VALUES ('delete', old.id, {old}, old.branch_name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS {t}_fts_au AFTER UPDATE ON {t} {DIM_BACKFILL_GUARD} BEGIN
+            INSERT INTO {t}_fts({t}_fts, rowid, {cols}, branch_name) VALUES ('delete', old.id, {old}, old.branch_name);
+            INSERT INTO {t}_fts(rowid, {cols}, branch_name) VALUES (new.id, {new}, new.branch_name);
+        END;
+        """)
+        if not exists: conn.execute(f"INSERT INTO {t}_fts({t}_fts) VALUES ('rebuild')")
+
+def add_column_if_missing(conn, table, column, decl):
+    cols = [r['name'] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in cols: conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def table_columns(conn, table, schema="main"):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+# ============= ИЗМЕРЕНИЯ =============
+# Филиал, мастер и руководитель хранятся в строках секций ещё и целыми ключами: branch_id → branches.id,
+# master_id → masters.id, manager_id → managers.id. Текстовые колонки остаются ради API, архивов и ленты изменений.
+# Старые строки заполняет фоновая миграция; пока она не закончена (DIM_READY), фильтры идут по branch_name.
+DIM_COLUMNS = {  # таблица → (текстовая колонка, справочник, ключ)
+    "field_visits": ("master_name", "masters", "master_id"), "one_on_one": ("master_name", "masters", "master_id"),
+    "master_plans": ("master_name", "masters", "master_id"), "reviews": ("manager_name", "managers", "manager_id"),
+    "branch_summaries": ("manager", "managers", "manager_id"),
+}
+# Заполнение ключей миграцией — не правка записи: без ленты изменений, версий и переиндексации FTS
+DIM_BACKFILL_GUARD = "WHEN NOT (old.branch_id IS NULL AND new.branch_id IS NOT NULL)"
+DIM_READY = False
+_branch_ids = {}
+
+def branch_id(conn, name):
+    """id филиала по имени из URL; кэшируется до окончательного удаления филиала (AUTOINCREMENT не переиспользует id)"""
+    bid = _branch_ids.get(name)
+    if bid is None:
+        r = conn.execute("SELECT id FROM branches WHERE name=?", (name,)).fetchone()
+        if r: bid = _branch_ids[name] = r[0]
+    return bid
+
+def forget_branch_id(name):
+    """После окончательного удаления филиала: имя можно зарегистрировать заново с новым id"""
+    _branch_ids.pop(name, None)
+
+def require_branch_id(conn, name):
+    """id филиала для новой строки; без него строку не увидит ни одно чтение, поэтому запись в незарегистрированный филиал — 404"""
+    bid = branch_id(conn, name)
+    if bid is None: raise HTTPException(404, f"Филиал '{name}' не найден")
+    return bid
+
+def branch_key(conn, name):
+    """Условие на филиал для WHERE: (колонка, значение)"""
+    return ("branch_id", branch_id(conn, name)) if DIM_READY else ("branch_name", name)
+
+def network_branch_key():
+    """Для сборов по всей сети: (колонка группировки по филиалу, условие «филиал не удалён»); после миграции — целый branch_id"""
+    if DIM_READY: return "branch_id", "branch_id IN (SELECT id FROM branches WHERE deleted_at IS NULL)"
+    return "branch_name", "branch_name IN (SELECT name FROM branches WHERE deleted_at IS NULL)"
+
+def branch_names(conn, keys):
+    """Имена филиалов для ключей группировки из network_branch_key"""
+    names = dict(conn.execute("SELECT id, name FROM branches").fetchall()) if DIM_READY else {}
+    return [names.get(k, k) for k in keys]
+
+def dim_id(conn, table, bid, name):
+    """id мастера/руководителя в справочнике table; запись заводится при первом упоминании"""
+    name = str(name or "").strip()
+    if bid is None or not name: return None
+    conn.execute(f"INSERT OR IGNORE INTO main.{table} (branch_id, name) VALUES (?, ?)", (bid, name))
+    return conn.execute(f"SELECT id FROM main.{table} WHERE branch_id=? AND name=?", (bid, name)).fetchone()[0]
+
+def row_keys(conn, table, branch_name, record):
+    """Ключи для новой строки table: {'branch_id': …, 'master_id'/'manager_id': …}"""
+    keys = {"branch_id": require_branch_id(conn, branch_name)}
+    if table in DIM_COLUMNS:
+        col, dim, key = DIM_COLUMNS[table]
+        keys[key] = dim_id(conn, dim, keys["branch_id"], record.get(col))
+    return keys
+
+def dimension_backlog(conn, schemas=None):
+    """Строки существующих филиалов без branch_id — по схемам (main и архивы)"""
+    left = {}
+    for s in schemas or chain(["main"], each_archive(conn)):
+        for t in SECTION_TABLES:
+            if "branch_id" not in table_columns(conn, t, s):
+                if table_columns(conn, t, s): left[f"{s}.{t}"] = None  # архив ещё без колонки
+                continue
+            n = conn.execute(f"SELECT COUNT(*) FROM {s}.{t} WHERE branch_id IS NULL AND branch_name IN (SELECT name FROM main.branches)").fetchone()[0]
+            if n: left[f"{s}.{t}"] = n
+    return left
+
+def backfill_dimensions():
+    """Онлайн-миграция: порциями по BACKFILL_CHUNK_SIZE заполняет ключи в горячей БД и архивах.
+    По окончании фильтры переключаются на branch_id, а индексы по branch_name удаляются"""
+    global DIM_READY
+    filled = {}
+    with get_db() as conn:
+        for s in chain(["main"], each_archive(conn)):
+            if s != "main": sync_archive_schema(conn, s); conn.commit()
+            for t in SECTION_TABLES:
+                if not table_columns(conn, t, s): continue
+                col, dim, key = DIM_COLUMNS.get(t, (None, None, None))
+                extra = f", {key} = (SELECT d.id FROM main.{dim} d WHERE d.branch_id = b.id AND d.name = TRIM(x.{col}))" if dim else ""
+                if dim:
+                    conn.execute(f"""INSERT OR IGNORE INTO main.{dim} (branch_id, name) SELECT DISTINCT b.id, TRIM(x.{col}) FROM {s}.{t} x
+                        JOIN main.branches b ON b.name = x.branch_name WHERE x.branch_id IS NULL AND TRIM(x.{col}) != ''""")
+                while True:
+                    n = conn.execute(f"""UPDATE {s}.{t} AS x SET branch_id = b.id{extra} FROM main.branches b
+                        WHERE b.name = x.branch_name AND x.id IN (SELECT id FROM {s}.{t} WHERE branch_id IS NULL
+                            AND branch_name IN (SELECT name FROM main.branches) LIMIT ?)""", (BACKFILL_CHUNK_SIZE,)).rowcount
+                    conn.commit()
+                    if n: filled[f"{s}.{t}"] = filled.get(f"{s}.{t}", 0) + n
+                    if n < BACKFILL_CHUNK_SIZE: break
+                    time.sleep(BACKFILL_CHUNK_PAUSE)
+        left = dimension_backlog(conn)
+        if not left:
+            DIM_READY = True
+            bump_shared_version(conn, "dimensions"); conn.commit()
+            for s in chain(["main"], each_archive(conn)):
+                for t in SECTION_TABLES: conn.execute(f"DROP INDEX IF EXISTS {s}.idx_{t}_branch")
+                conn.commit()
+    if filled or not left: logger.info(f"🔑 Ключи измерений: заполнено {filled or 0}, {'миграция завершена' if not left else f'осталось {left}'}")
+    return {"filled": filled, "left": left, "ready": DIM_READY}
+
+# ============= MASTER ROLLUP =============
+# Сводка по мастеру из field_visits, master_plans и one_on_one (только горячая БД).
+# Пересчитывается точечно при записи в эти таблицы.
+MASTER_TABLES = ["field_visits", "master_plans", "one_on_one"]
+
+def pct(fact, plan): return round(fact / plan * 100, 1) if plan else None
+
+def latest_date(rows, field):
+    dates = [(parse_date_flexible(r[field]), r[field]) for r in rows]
+    dates = [d for d in dates if d[0]]
+    return max(dates)[1] if dates else None
+
+def refresh_master_rollup(conn, branch_name, masters):
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    bid = branch_id(conn, branch_name)
+    for m in {str(x).strip() for x in masters if x and str(x).strip()}:
+        where, key = ("master_id=(SELECT id FROM masters WHERE branch_id=? AND name=?)", (bid, m)) if DIM_READY else ("branch_name=? AND TRIM(master_name)=?", (branch_name, m))
+        q = lambda t, cols: conn.execute(f"SELECT {cols} FROM {t} WHERE {where} ORDER BY submitted_at DESC, id DESC", key).fetchall()
+        visits = q("field_visits", "date, average_rating")
+        plans = q("master_plans", "month, average_check_plan, average_check_fact, additional_services_plan, additional_services_fact, sales_plan, sales_fact, salary_plan, salary_fact")
+        meetings = q("one_on_one", "date")
+        if not (visits or plans or meetings):
+            conn.execute("DELETE FROM master_rollup WHERE branch_name=? AND master_name=?", (branch_name, m)); continue
+        p = plans[0] if plans else None
+        conn.execute("""INSERT OR REPLACE INTO master_rollup (branch_name,master_name,visits_count,last_visit_date,last_average_rating,avg_rating,
+            plan_month,average_check_pct,additional_services_pct,sales_pct,salary_pct,one_on_one_count,last_one_on_one_date,updated_at)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (branch_name, m, len(visits), visits[0]['date'] if visits else None, visits[0]['average_rating'] if visits else None,
+             round(sum(v['average_rating'] for v in visits) / len(visits), 1) if visits else None,
+             p['month'] if p else None, pct(p['average_check_fact'], p['average_check_plan']) if p else None,
+             pct(p['additional_services_fact'], p['additional_services_plan']) if p else None,
+             pct(p['sales_fact'], p['sales_plan']) if p else None, pct(p['salary_fact'], p['salary_plan']) if p else None,
+             len(meetings), latest_date(meetings, 'date'), ts))
+
+def rebuild_master_rollup(conn):
+    conn.execute("DELETE FROM master_rollup")
+    pairs = {}
+    for t in MASTER_TABLES:
+        for r in conn.execute(f"SELECT DISTINCT branch_name, master_name FROM {t}").fetchall():
+            pairs.setdefault(r['branch_name'], set()).add(r['master_name'])
+    for bn, masters in pairs.items(): refresh_master_rollup(conn, bn, masters)
+
+# ============= ARCHIVE =============
+# Старые записи переносятся в archive_YYYY.db (по году submitted_at) с теми же id.
+# Запросы, чей период заходит в архивные годы, подключают эти файлы через ATTACH. К одному соединению SQLite
+# подключает не больше ATTACH_LIMIT баз (обычно 10, в шарде одну занимает catalog): обходы по архивам идут
+# по одному (each_archive), чтения строк — пачками (archive_batches), а один общий запрос на больше лет — 400.
+ATTACH_LIMIT = sqlite3.connect(":memory:").getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+def archive_path(year): return os.path.join(ARCHIVE_DIR, f"archive_{year}.db")
+
+def archive_years(start=None, end=None):
+    """Годы архивов на диске, пересекающиеся с периодом (без периода — все)"""
+    years = []
+    for f in glob.glob(os.path.join(ARCHIVE_DIR, "archive_*.db")):
+        m = re.match(r"archive_(\d{4})\.db$", os.path.basename(f))
+        if m and (not start or start.year <= int(m.group(1))) and (not end or int(m.group(1)) <= end.year): years.append(int(m.group(1)))
+    return sorted(years)
+
+def attached_names(conn):
+    return [r[1] for r in conn.execute("PRAGMA database_list").fetchall()]
+
+def archive_slots(conn):
+    """Сколько ещё баз можно подключить к соединению"""
+    return ATTACH_LIMIT - len([n for n in attached_names(conn) if n not in ("main", "temp")])
+
+def attach_archive(conn, year):
+    alias = f"arc_{year}"
+    if alias not in attached_names(conn):
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (archive_path(year),))
+    return alias
+
+def detach_archives(conn, aliases):
+    have = attached_names(conn)
+    for a in aliases:
+        if a in have: conn.execute(f"DETACH DATABASE {a}")
+
+def attached_archives(conn, start=None, end=None):
+    """Подключает архивы, пересекающиеся с периодом (без периода — все), возвращает их алиасы — для одного общего запроса"""
+    years = archive_years(start, end)
+    have = attached_names(conn)
+    fresh = [y for y in years if f"arc_{y}" not in have]
+    if len(fresh) > archive_slots(conn):
+        raise HTTPException(400, f"Период захватывает {len(years)} архивных лет, а к одному запросу подключается не больше {archive_slots(conn) + len(years) - len(fresh)} — сузьте период")
+    return [attach_archive(conn, y) for y in years]
+
+def each_archive(conn, start=None, end=None):
+    """Архивы периода по одному: подключает и отдаёт алиас, после обработки отключает (если подключил сам).
+    Число лет не ограничено. DETACH невозможен внутри транзакции — записи в архив коммитятся в теле обхода.
+    Прерванный обход оставляет текущий архив подключённым"""
+    for y in archive_years(start, end):
+        alias = f"arc_{y}"
+        own = alias not in attached_names(conn)
+        attach_archive(conn, y)
+        yield alias
+        if own: detach_archives(conn, [alias])
+
+def archive_batches(conn, start=None, end=None):
+    """Годы архивов периода пачками, которые помещаются в соединение: [(годы, с горячей таблицей)]; архивы пачки
+    отключаются после её обработки. Для чтений строк, которые склеиваются из нескольких запросов"""
+    years = archive_years(start, end)
+    n = max(1, archive_slots(conn))
+    for i in range(0, max(len(years), 1), n):
+        batch = years[i:i + n]
+        own = [f"arc_{y}" for y in batch if f"arc_{y}" not in attached_names(conn)]
+        yield batch, i == 0
+        detach_archives(conn, own)
+
+def section_source(conn, table, start=None, end=None, years=None, hot=True):
+    """FROM-выражение для таблицы: горячая таблица плюс UNION ALL нужных архивов (years — явный список лет из archive_batches,
+    hot=False — без горячей таблицы). Архивы общие для всех шардов, поэтому в шарде из них берутся только строки его филиала"""
+    aliases = attached_archives(conn, start, end) if years is None else [attach_archive(conn, y) for y in years]
+    aliases = [a for a in aliases if table_columns(conn, table, a)]
+    if not aliases and hot: return table
+    shard = _shard.get() if SHARD_DIR else None
+    own = f" WHERE branch_id = {branch_id(conn, shard) or 0}" if shard else ""
+    cols = table_columns(conn, table)
+    parts = [f"SELECT {','.join(cols)} FROM main.{table}"] if hot else []
+    if not parts and not aliases: parts = [f"SELECT {','.join(cols)} FROM main.{table} WHERE 0"]
+    for a in aliases:
+        have = set(table_columns(conn, table, a))
+        parts.append(f"SELECT {','.join(c if c in have else f'NULL AS {c}' for c in cols)} FROM {a}.{table}{own}")
+    return f"({' UNION ALL '.join(parts)}) AS {table}"
+
+def sync_archive_schema(conn, alias):
+    for t in SECTION_TABLES:
+        sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (t,)).fetchone()[0]
+        conn.execute(sql.replace(f"CREATE TABLE {t}", f"CREATE TABLE IF NOT EXISTS {alias}.{t}", 1))
+        have = table_columns(conn, t, alias)
+        for r in conn.execute(f"PRAGMA main.table_info({t})").fetchall():
+            if r[1] not in have: conn.execute(f"ALTER TABLE {alias}.{t} ADD COLUMN {r[1]} {r[2]}")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_{t}_bid ON {t}(branch_id, submitted_at)")
+        if not DIM_READY: conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_{t}_branch ON {t}(branch_name, submitted_at)")
+
+def archive_cutoff():
+    now = datetime.now()
+    months = now.year * 12 + now.month - 1 - ARCHIVE_AFTER_MONTHS
+    return datetime(months // 12, months % 12 + 1, 1)
+
+def archive_conn(conn, cs, moved):
+    """Перенос в одной БД — общей или шарде; moved копит счётчики по всем"""
+    rollup = False
+    years = sorted({r[0] for t in SECTION_TABLES for r in conn.execute(f"SELECT DISTINCT substr(submitted_at,1,4) FROM {t} WHERE submitted_at < ?", (cs,)).fetchall()})
+    for y in years:
+        alias = attach_archive(conn, y)
+        sync_archive_schema(conn, alias); conn.commit()
+        for t in SECTION_TABLES:
+            cols = ','.join(table_columns(conn, t))
+            chunk = f"SELECT id FROM main.{t} WHERE submitted_at < ? AND substr(submitted_at,1,4)=? ORDER BY id LIMIT ?"
+            while True:
+                ids = [r[0] for r in conn.execute(chunk, (cs, y, ARCHIVE_CHUNK_SIZE)).fetchall()]
+                if not ids: break
+                seq0 = conn.execute("SELECT COALESCE(MAX(seq),0) FROM main.changes").fetchone()[0]
+                marks = ','.join('?' * len(ids))
+                conn.execute(f"INSERT INTO {alias}.{t} ({cols}) SELECT {cols} FROM main.{t} WHERE id IN ({marks})", ids)
+                conn.execute(f"DELETE FROM main.{t} WHERE id IN ({marks})", ids)
+                # перенос в архив — не удаление: записи остаются доступны, в ленту изменений не пишем
+                conn.execute(f"DELETE FROM main.changes WHERE table_name=? AND op='delete' AND record_id IN ({marks}) AND seq > ?", [t, *ids, seq0])
+                conn.commit()
+                moved[f"{y}/{t}"] = moved.get(f"{y}/{t}", 0) + len(ids)
+                rollup |= t in MASTER_TABLES
+        detach_archives(conn, [alias])
+    if rollup: rebuild_master_rollup(conn)
+
+def locate_record(conn, table, record_id):
+    """Схема (main или архив), в которой лежит запись; найденный архив остаётся подключённым"""
+    for schema in chain(["main"], each_archive(conn)):
+        if table_columns(conn, table, schema) and conn.execute(f"SELECT id FROM {schema}.{table} WHERE id=?", (record_id,)).fetchone():
+            return schema
+    return None
@@ -0,0 +1,113 @@
+"""Выгрузка секций потоком NDJSON/CSV.
+
+Сырая выгрузка секции без сборки в памяти: курсор читается порциями по EXPORT_BATCH_SIZE (fetchmany в DB_EXECUTOR),
+каждая порция сразу уходит клиенту. Колонки — как в XLSX плюс «Филиал», поэтому CSV можно загрузить обратно через /import.
+"""
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from urllib.parse import quote
+from typing import Optional
+import asyncio, csv, io, json, threading
+from contextlib import ExitStack
+from config import *
+from utils import get_period_dates, period_bounds, report_filename
+from db import (DBRoute, DB_EXECUTOR, run_db, get_db, use_shard, live_branch_names, branch_id, branch_key,
+                network_branch_key, section_source, archive_years, ATTACH_LIMIT)
+from limits import admit
+
+router = APIRouter(route_class=DBRoute)
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+def export_cursor(conn, section, branch, start, end, years=None, hot=True):
+    cfg = SECTION_CONFIG[section]
+    if branch:
+        if branch_id(conn, branch) is None: raise HTTPException(404, f"Филиал '{branch}' не найден")
+        col, key = branch_key(conn, branch)
+        where, params = f"{col}=?", [key]
+    else:
+        where, params = network_branch_key()[1], []
+    if start: where += " AND submitted_at >= ? AND submitted_at < ?"; params += period_bounds(start, end)
+    # без ORDER BY: сортировка UNION ALL с архивами держала бы в памяти всю выборку
+    return conn.execute(f"SELECT branch_name AS 'Филиал', {cfg['select']} FROM {section_source(conn, cfg['table'], start, end, years, hot)} WHERE {where}", params)
+
+def export_chunk(cur, fmt, first):
+    """Следующая порция выгрузки в байтах; None — курсор исчерпан"""
+    rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+    if not rows and not first: return None
+    if fmt == "ndjson": return "".join(json.dumps(dict(r), ensure_ascii=False) + "\n" for r in rows).encode()
+    buf = io.StringIO(); w = csv.writer(buf, delimiter=";")
+    if first: buf.write("\ufeff"); w.writerow([d[0] for d in cur.description])  # BOM — чтобы Excel узнал UTF-8
+    w.writerows(tuple(r) for r in rows)
+    return buf.getvalue().encode()
+
+def export_parts(branches, start, end):
+    """Части выгрузки: (филиал, годы архивов, с горячей таблицей). Архивов больше, чем подключается к одному
+    соединению, — тогда у филиала несколько частей, каждая своим соединением"""
+    years, size = archive_years(start, end), ATTACH_LIMIT - (1 if SHARD_DIR else 0)
+    batches = [years[i:i + size] for i in range(0, len(years), size)] or [[]]
+    return [(b, batch, i == 0) for b in branches for i, batch in enumerate(batches)]
+
+def open_export(section, part, start, end):
+    """Соединение только для чтения (переходит между потоками DB_EXECUTOR) и курсор выгрузки части"""
+    branch, years, hot = part
+    with ExitStack() as stack:
+        with use_shard(branch):
+            conn = stack.enter_context(get_db(readonly=True, check_same_thread=False))
+        cur = export_cursor(conn, section, branch, start, end, years, hot)
+        return stack.pop_all(), cur
+
+def export_reader(section, parts, start, end, fmt):
+    """(read, close) выгрузки частей подряд (с шардами — филиал за филиалом); обе вызываются в DB_EXECUTOR и берут
+    один замок: close после обрыва клиента дожидается порции, которую read ещё читает, и только потом закрывает соединение"""
+    lock, left = threading.Lock(), list(parts[1:])
+    st = dict(zip(("stack", "cur"), open_export(section, parts[0], start, end)), first=True, closed=False)
+    def read():
+        with lock:
+            while not st["closed"]:
+                if st["cur"] is not None:
+                    chunk = export_chunk(st["cur"], fmt, st["first"])
+                    if chunk is not None:
+                        st["first"] = False
+                        return chunk
+                    st["stack"].close(); st["cur"] = None
+                if not left: return None
+                try: st["stack"], st["cur"] = open_export(section, left.pop(0), start, end)
+                except HTTPException: pass  # филиал удалили, пока шла выгрузка
+    def close():
+        """True — закрыл этот вызов (повторные ничего не делают)"""
+        with lock:
+            if st["closed"]: return False
+            st["closed"] = True
+            if st["cur"] is not None: st["cur"] = None; st["stack"].close()
+            return True
+    return read, close
+
+@router.get("/stream/{section}")
+async def export_section(section: str, branch: Optional[str] = None, period: str = Query("all"), format: str = Query("ndjson")):
+    """Выгрузка секции одного филиала или всех потоком NDJSON/CSV; память не зависит от числа строк"""
+    if section not in SECTION_CONFIG: raise HTTPException(400, f"Неизвестная секция: {section}")
+    if format not in EXPORT_FORMATS: raise HTTPException(400, f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    start, end, label = get_period_dates(period)
+    if period == "all": start = end = None
+    # с шардами «все филиалы» — это шарды подряд, каждый своим курсором; заголовок CSV только у первого
+    branches = [branch] if branch or not SHARD_DIR else await run_db(live_branch_names)
+    if not branches: raise HTTPException(404, "Нет филиалов для выгрузки")
+    parts = export_parts(branches, start, end)
+    loop, sem = asyncio.get_running_loop(), await admit("export")
+    try: read, close = await run_db(export_reader, section, parts, start, end, format)
+    except BaseException:
+        sem.release(); raise
+    def finish():
+        # и из body, и фоновой задачей ответа (в потоке): body может так и не стартовать, если клиент ушёл сразу.
+        # Отмена body не останавливает read в DB_EXECUTOR, поэтому и закрытие идёт туда же — после неё
+        DB_EXECUTOR.submit(close).add_done_callback(lambda f: f.result() and loop.call_soon_threadsafe(sem.release))
+    async def body():
+        try:
+            while (chunk := await run_db(read)) is not None:
+                if chunk: yield chunk
+        finally: finish()
+    filename = report_filename(f"{section}_{branch or 'все'}", label, format)
+    return StreamingResponse(body(), media_type=EXPORT_FORMATS[format], background=BackgroundTask(finish),
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}", "X-Accel-Buffering": "no"})
@@ -0,0 +1,49 @@
+"""Ограничение тяжёлых запросов.
+
+single_flight: одинаковые запросы (маршрут + параметры), пришедшие во время вычисления, ждут его результат.
+limit_concurrency: не больше ROUTE_LIMITS[name] одновременно, чтобы отчёты не занимали весь пул потоков.
+"""
+from fastapi import HTTPException
+from pydantic import BaseModel
+import asyncio, functools
+from config import *
+from db import run_db
+
+_inflight = {}
+_route_semaphores = {}
+
+def _call_key(fn, kwargs):
+    return (fn.__module__, fn.__qualname__) + tuple((k, v.model_dump_json() if isinstance(v, BaseModel) else v) for k, v in sorted(kwargs.items()))
+
+async def _call(fn, kwargs):
+    return await fn(**kwargs) if asyncio.iscoroutinefunction(fn) else await run_db(fn, **kwargs)
+
+def single_flight(fn):
+    @functools.wraps(fn)
+    async def wrapper(**kwargs):
+        key = _call_key(fn, kwargs)
+        task = _inflight.get(key)
+        if task is None:
+            task = _inflight[key] = asyncio.ensure_future(_call(fn, kwargs))
+            task.add_done_callback(lambda _: _inflight.pop(key, None))
+        # shield: отключившийся клиент не отменяет вычисление, которого ждут другие
+        return await asyncio.shield(task)
+    return wrapper
+
+async def admit(name):
+    """Занимает слот ROUTE_LIMITS[name]; не освободился за ADMISSION_WAIT_SECONDS — 429"""
+    sem = _route_semaphores.setdefault(name, asyncio.Semaphore(ROUTE_LIMITS[name]))
+    try: await asyncio.wait_for(sem.acquire(), ADMISSION_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(429, "Сервер занят формированием отчётов, повторите позже", headers={"Retry-After": str(max(1, round(ADMISSION_WAIT_SECONDS)))})
+    return sem
+
+def limit_concurrency(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(**kwargs):
+            sem = await admit(name)
+            try: return await _call(fn, kwargs)
+            finally: sem.release()
+        return wrapper
+    return decorator
@@ -0,0 +1,243 @@
+"""Нагрузочный тест BarberCRM API.
+
+Воспроизводит трафик фронтенда и бота: отправку форм филиалами, чтение дашборда и секций ботом,
+опрос /admin/all-dashboards и выгрузку отчётов. Конкурентность растёт ступенями; по каждой ступени
+считаются RPS, p50/p95/p99, доля ошибок и число «database is locked».
+
+    python loadtest.py --start --steps 5,10,20,40 --duration 15 --json result.json
+    python loadtest.py --url http://127.0.0.1:8100 --mix submit=50,bot=30,admin=15,report=5
+
+С --start поднимает uvicorn на временной базе и считает «database is locked» по логу сервера;
+для внешнего сервера такие ошибки видны только как HTTP 500.
+"""
+import argparse, asyncio, json, os, random, socket, subprocess, sys, tempfile, time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, quote
+
+LOCKED = "database is locked"
+DEFAULT_MIX = "submit=30,bot=40,admin=20,report=10"
+SECTIONS = ["morning-events", "field-visits", "one-on-one", "master-plans", "reviews", "weekly-metrics"]
+MASTERS = ["Иван Петров", "Алексей Смирнов", "Дмитрий Кузнецов", "Сергей Попов", "Максим Волков"]
+
+# ============= HTTP =============
+class Connection:
+    """Одно keep-alive соединение HTTP/1.1 — у каждого виртуального пользователя своё"""
+    def __init__(self, host, port):
+        self.host, self.port, self.reader, self.writer = host, port, None, None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        data = json.dumps(body).encode() if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\nContent-Length: {len(data)}\r\n"
+        if body is not None: head += "Content-Type: application/json\r\n"
+        try:
+            self.writer.write((head + "\r\n").encode() + data)
+            await self.writer.drain()
+            status = int((await self.reader.readline()).split()[1])
+            headers = {}
+            while (line := await self.reader.readline()) not in (b"\r\n", b""):
+                k, _, v = line.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            if headers.get("transfer-encoding") == "chunked":
+                payload = b""
+                while (size := int((await self.reader.readline()).strip(), 16)):
+                    payload += await self.reader.readexactly(size); await self.reader.readline()
+                await self.reader.readline()
+            else:
+                payload = await self.reader.readexactly(int(headers.get("content-length", 0)))
+            if headers.get("connection") == "close": self.close()
+            return status, payload
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer: self.writer.close()
+        self.reader = self.writer = None
+
+# ============= TRAFFIC =============
+def random_date(days=25):
+    return (datetime.now() - timedelta(days=random.randint(0, days))).strftime("%Y-%m-%d")
+
+def submit_payload():
+    """Случайная форма из тех, что филиалы отправляют чаще всего"""
+    kind = random.choice(["morning-events", "field-visits", "one-on-one", "reviews"])
+    if kind == "morning-events":
+        rows = [{"week": random.randint(1, 52), "date": random_date(), "event_type": random.choice(["Планёрка", "Тренинг", "Разбор"]),
+                 "participants": random.randint(2, 12), "efficiency": random.randint(1, 5), "comment": "Нагрузочный тест"} for _ in range(random.randint(1, 3))]
+    elif kind == "field-visits":
+        r = lambda: random.randint(1, 10)
+        rows = [{"date": random_date(), "master_name": random.choice(MASTERS), "haircut_quality": r(), "service_quality": r(),
+                 "additional_services_rating": r(), "cosmetics_rating": r(), "standards_rating": r(), "errors_comment": "Без замечаний"}]
+    elif kind == "one-on-one":
+        rows = [{"date": random_date(), "master_name": random.choice(MASTERS), "goal": "Рост среднего чека", "results": "Обсудили продажи",
+                 "development_plan": "Курс по окрашиванию", "indicator": "Средний чек"}]
+    else:
+        rows = [{"week": str(random.randint(1, 52)), "manager_name": "Управляющий", "fact": random.randint(0, 20)}]
+    return kind, rows
+
+async def op_submit(conn, branch):
+    kind, rows = submit_payload()
+    return [await conn.request("POST", f"/{kind}/{quote(branch)}", rows)]
+
+async def op_bot(conn, branch):
+    # бот сначала показывает дашборд, затем открывает одну из секций
+    return [await conn.request("GET", f"/dashboard-summary/{quote(branch)}"),
+            await conn.request("GET", f"/{random.choice(SECTIONS)}/{quote(branch)}")]
+
+async def op_admin(conn, branch):
+    return [await conn.request("GET", f"/admin/all-dashboards?period={random.choice(['month', 'week', 'quarter'])}")]
+
+async def op_report(conn, branch):
+    return [await conn.request("GET", f"/report/{quote(branch)}?period_type={random.choice(['month', 'quarter'])}")]
+
+OPERATIONS = {"submit": op_submit, "bot": op_bot, "admin": op_admin, "report": op_report}
+
+def parse_mix(s):
+    mix = {}
+    for part in s.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS: raise SystemExit(f"Неизвестная операция в --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+# ============= RUN =============
+async def prepare(host, port, branches, seed):
+    """Регистрирует тестовые филиалы и наполняет их историей, чтобы чтения были реалистичными"""
+    conn = Connection(host, port)
+    for b in branches:
+        await conn.request("POST", "/register", {"name": b, "address": "ул. Тестовая, 1", "manager_name": "Управляющий",
+                                                 "manager_phone": "+70000000000", "password": "loadtest"})
+        for _ in range(seed):
+            await op_submit(conn, b)
+    conn.close()
+
+async def worker(host, port, branches, mix, stop_at, samples):
+    conn = Connection(host, port)
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < stop_at:
+        name = random.choices(names, weights)[0]
+        t0 = time.monotonic()
+        try:
+            responses = await OPERATIONS[name](conn, random.choice(branches))
+            status = max(s for s, _ in responses)
+            locked = any(LOCKED.encode() in body for s, body in responses if s >= 500)
+            samples.append((name, time.monotonic() - t0, status, locked, None))
+        except Exception as e:
+            samples.append((name, time.monotonic() - t0, 0, False, type(e).__name__))
+            await asyncio.sleep(0.1)
+    conn.close()
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 1)
+
+def summarize(samples, elapsed):
+    lat = [s[1] for s in samples]
+    errors = sum(1 for s in samples if s[2] == 0 or s[2] >= 500)
+    return {"requests": len(samples), "rps": round(len(samples) / elapsed, 1) if elapsed else 0,
+            "p50_ms": percentile(lat, 50), "p95_ms": percentile(lat, 95), "p99_ms": percentile(lat, 99),
+            "errors": errors, "error_rate": round(errors / len(samples) * 100, 2) if samples else 0.0,
+            "locked": sum(1 for s in samples if s[3])}
+
+def count_locked_in_log(path, offset):
+    """Число «database is locked» в логе сервера начиная с offset → (count, новый offset)"""
+    if not path: return 0, offset
+    with open(path, "rb") as f:
+        f.seek(offset); chunk = f.read()
+    return chunk.count(LOCKED.encode()), offset + len(chunk)
+
+async def run_steps(args, host, port, log_path):
+    mix, branches = parse_mix(args.mix), [f"loadtest-{i + 1}" for i in range(args.branches)]
+    await prepare(host, port, branches, args.seed)
+    steps, log_offset = [], os.path.getsize(log_path) if log_path else 0
+    for concurrency in [int(c) for c in args.steps.split(",")]:
+        samples, t0 = [], time.monotonic()
+        stop_at = t0 + args.duration
+        await asyncio.gather(*(worker(host, port, branches, mix, stop_at, samples) for _ in range(concurrency)))
+        elapsed = time.monotonic() - t0
+        step = {"concurrency": concurrency, **summarize(samples, elapsed),
+                "by_operation": {name: summarize([s for s in samples if s[0] == name], elapsed) for name in mix}}
+        server_locked, log_offset = count_locked_in_log(log_path, log_offset)
+        step["locked"] = max(step["locked"], server_locked)
+        steps.append(step)
+        print_step(step, header=len(steps) == 1)
+    return steps
+
+def breaking_point(steps, max_error_rate, max_p99):
+    """Первая ступень, где доля ошибок или p99 выходят за порог"""
+    for s in steps:
+        if s["error_rate"] > max_error_rate or s["locked"] or (max_p99 and (s["p99_ms"] or 0) > max_p99):
+            return s["concurrency"]
+    return None
+
+# ============= OUTPUT =============
+COLUMNS = [("concurrency", "Конк."), ("requests", "Запросов"), ("rps", "RPS"), ("p50_ms", "p50 мс"), ("p95_ms", "p95 мс"),
+           ("p99_ms", "p99 мс"), ("error_rate", "Ошибки %"), ("locked", "locked")]
+
+def print_step(step, header=False):
+    if header:
+        print(" ".join(f"{title:>10}" for _, title in COLUMNS))
+    print(" ".join(f"{str(step[key]):>10}" for key, _ in COLUMNS))
+    for name, s in step["by_operation"].items():
+        print(f"{'':>10} {name:>10} {s['requests']:>10} {s['rps']:>10} {str(s['p50_ms']):>10} {str(s['p95_ms']):>10} {str(s['p99_ms']):>10} {s['error_rate']:>10}")
+
+# ============= SERVER =============
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def start_server(extra_args):
+    """Поднимает uvicorn main:app на временной базе; лог пишется в файл для подсчёта locked"""
+    tmp = tempfile.mkdtemp(prefix="barbercrm_load_")
+    port, log_path = free_port(), os.path.join(tmp, "server.log")
+    env = {**os.environ, "DB_PATH": os.path.join(tmp, "barbercrm.db"), "BACKUP_HOUR": "", "ARCHIVE_AFTER_MONTHS": "0"}
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", *extra_args]
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            stdout=open(log_path, "wb"), stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2): return proc, port, log_path
+        except OSError:
+            if proc.poll() is not None: raise SystemExit(f"Сервер не запустился, см. {log_path}")
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("Сервер не ответил за 20 секунд")
+
+def main():
+    p = argparse.ArgumentParser(description="Нагрузочный тест BarberCRM API")
+    p.add_argument("--url", default="http://127.0.0.1:8000", help="адрес запущенного бэкенда")
+    p.add_argument("--start", action="store_true", help="поднять свой uvicorn на временной базе")
+    p.add_argument("--server-args", default="", help="доп. аргументы uvicorn для --start, например '--workers 4'")
+    p.add_argument("--steps", default="5,10,20,40,80", help="ступени конкурентности через запятую")
+    p.add_argument("--duration", type=float, default=20, help="длительность ступени, секунд")
+    p.add_argument("--mix", default=DEFAULT_MIX, help="веса операций submit/bot/admin/report")
+    p.add_argument("--branches", type=int, default=10, help="число тестовых филиалов")
+    p.add_argument("--seed", type=int, default=20, help="форм на филиал перед стартом")
+    p.add_argument("--max-error-rate", type=float, default=1.0, help="порог ошибок, %%, для точки отказа")
+    p.add_argument("--max-p99", type=float, default=0, help="порог p99, мс, для точки отказа (0 — не учитывать)")
+    p.add_argument("--json", help="сохранить результат в JSON")
+    args = p.parse_args()
+
+    proc = log_path = None
+    if args.start:
+        proc, port, log_path = start_server(args.server_args.split())
+        host = "127.0.0.1"
+    else:
+        u = urlsplit(args.url)
+        host, port = u.hostname, u.port or 80
+    try:
+        steps = asyncio.run(run_steps(args, host, port, log_path))
+    finally:
+        if proc: proc.terminate(); proc.wait()
+    knee = breaking_point(steps, args.max_error_rate, args.max_p99)
+    print(f"\nТочка отказа: {knee} одновременных пользователей" if knee else "\nТочка отказа не достигнута")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"started_at": datetime.now().isoformat(timespec="seconds"), "mix": parse_mix(args.mix),
+                       "duration": args.duration, "breaking_point": knee, "steps": steps}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
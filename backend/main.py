@@ -1,198 +1,41 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from urllib.parse import quote
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
-import json, os, hashlib, secrets, logging, time, smtplib, io, sqlite3
+import json, csv, os, hashlib, logging, time, smtplib, io, threading, glob, re, asyncio, zipfile, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import numpy as np
 from datetime import datetime, timedelta
-from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from config import *
+from utils import (hash_password, generate_token, parse_date_flexible, get_month_ru, current_month_ru, count_for_month,
+                   sum_reviews_month, get_period_dates, period_bounds, month_label_range, report_filename)
+import db
+from db import (get_db, run_db, DBRoute, use_shard, shard_path, live_branch_names, file_lock, try_lead, is_leader,
+                init_catalog, table_columns, log_change, log_branch_change, bump_data_version, DIM_COLUMNS, require_branch_id, network_branch_key, branch_names,
+                forget_branch_id, branch_key, dim_id, row_keys, dimension_backlog, backfill_dimensions, MASTER_TABLES, refresh_master_rollup,
+                archive_years, attached_archives, each_archive, archive_batches, section_source, archive_cutoff, archive_conn, locate_record)
+from shards import init_shard, record_branch, each_branch, data_parts, fan_rows, split_into_shards, drop_shard
+from backup import router as backup_router, create_backup, list_backups, restore_backup
+from search import router as search_router
+from limits import single_flight, limit_concurrency
+from export import router as export_router
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="BarberCRM API", version="5.1.0")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-
-# ============= CONFIG =============
-REPORT_EMAIL_TO = os.getenv('REPORT_EMAIL_TO', '')
-SMTP_HOST = os.getenv('SMTP_HOST', '')
-SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
-SMTP_USER = os.getenv('SMTP_USER', '')
-SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
-SMTP_USE_SSL = os.getenv('SMTP_USE_SSL', 'false').lower() == 'true'
-ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
-ADMIN_PASSWORD_HASH = hashlib.sha256(os.getenv('ADMIN_PASSWORD', 'admin').encode()).hexdigest()
-DB_PATH = os.getenv('DB_PATH', '/app/data/barbercrm.db')
-
-BRANCH_GOALS = {"morning_events": 16, "field_visits": 4, "one_on_one": 6, "weekly_reports": 4, "master_plans": 10, "reviews": 52, "new_employees": 10}
-
-# ============= DATABASE =============
-@contextmanager
-def get_db():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    try:
-        yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
-
-def init_db():
-    with get_db() as conn:
-        conn.executescript("""
-        CREATE TABLE IF NOT EXISTS branches (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL, address TEXT NOT NULL,
-            manager_name TEXT NOT NULL, manager_phone TEXT NOT NULL,
-            password_hash TEXT NOT NULL, token TEXT NOT NULL, created_at TEXT NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS morning_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, date TEXT NOT NULL, week INTEGER NOT NULL,
-            event_type TEXT NOT NULL, participants INTEGER NOT NULL,
-            efficiency INTEGER NOT NULL, comment TEXT DEFAULT ''
-        );
-        CREATE TABLE IF NOT EXISTS field_visits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, date TEXT NOT NULL, master_name TEXT NOT NULL,
-            haircut_quality INTEGER NOT NULL, service_quality INTEGER NOT NULL,
-            additional_services_comment TEXT DEFAULT '', additional_services_rating INTEGER NOT NULL,
-            cosmetics_comment TEXT DEFAULT '', cosmetics_rating INTEGER NOT NULL,
-            standards_comment TEXT DEFAULT '', standards_rating INTEGER NOT NULL,
-            errors_comment TEXT DEFAULT '', next_check_date TEXT DEFAULT '', average_rating REAL NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS one_on_one (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, date TEXT NOT NULL, master_name TEXT NOT NULL,
-            goal TEXT NOT NULL, results TEXT NOT NULL, development_plan TEXT NOT NULL,
-            indicator TEXT NOT NULL, next_meeting_date TEXT DEFAULT ''
-        );
-        CREATE TABLE IF NOT EXISTS weekly_metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, period TEXT NOT NULL,
-            average_check_plan REAL NOT NULL, average_check_fact REAL NOT NULL,
-            cosmetics_plan REAL NOT NULL, cosmetics_fact REAL NOT NULL,
-            additional_services_plan REAL NOT NULL, additional_services_fact REAL NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS master_plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, month TEXT NOT NULL, master_name TEXT NOT NULL,
-            average_check_plan REAL NOT NULL, average_check_fact REAL NOT NULL,
-            additional_services_plan INTEGER NOT NULL, additional_services_fact INTEGER NOT NULL,
-            sales_plan REAL NOT NULL, sales_fact REAL NOT NULL,
-            salary_plan REAL NOT NULL, salary_fact REAL NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS reviews (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, week TEXT NOT NULL, manager_name TEXT NOT NULL,
-            plan INTEGER NOT NULL DEFAULT 13, fact INTEGER NOT NULL, monthly_target INTEGER NOT NULL DEFAULT 52
-        );
-        CREATE TABLE IF NOT EXISTS newbie_adaptation (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, start_date TEXT NOT NULL, name TEXT NOT NULL,
-            haircut_practice TEXT NOT NULL, service_standards TEXT NOT NULL,
-            hygiene_sanitation TEXT NOT NULL, additional_services TEXT NOT NULL,
-            cosmetics_sales TEXT NOT NULL, iclient_basics TEXT NOT NULL, status TEXT NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS branch_summaries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, branch_name TEXT NOT NULL,
-            submitted_at TEXT NOT NULL, manager TEXT NOT NULL, month TEXT NOT NULL,
-            metric TEXT NOT NULL, current_value INTEGER NOT NULL,
-            goal_value INTEGER NOT NULL, percentage REAL NOT NULL
-        );
-        """)
-    logger.info("✅ БД инициализирована")
-
-# ============= UTILS =============
-def hash_password(p): return hashlib.sha256(p.encode()).hexdigest()
-def generate_token(): return secrets.token_urlsafe(32)
-
-def parse_date_flexible(date_str):
-    s = str(date_str).strip()
-    if not s: return None
-    for fmt in ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y"]:
-        try: return datetime.strptime(s.split()[0], fmt)
-        except ValueError: continue
-    return None
-
-def get_month_ru(dt):
-    m = ['Январь','Февраль','Март','Апрель','Май','Июнь','Июль','Август','Сентябрь','Октябрь','Ноябрь','Декабрь']
-    return f"{m[dt.month-1]} {dt.year}"
-
-def current_month_ru(): return get_month_ru(datetime.now())
-
-def count_for_month(rows, field, month):
-    c = 0
-    for r in rows:
-        dt = parse_date_flexible(str(r[field]))
-        if dt and get_month_ru(dt) == month: c += 1
-    return c
-
-def sum_reviews_month(rows, month):
-    t = 0
-    for r in rows:
-        dt = parse_date_flexible(str(r['submitted_at']))
-        if dt and get_month_ru(dt) == month: t += int(r['fact'] or 0)
-    return t
-
-def get_period_dates(period_type, custom_date=None):
-    """Возвращает (start, end, label) для фильтрации"""
-    now = datetime.now()
-    if period_type == "today":
-        s = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        e = now.replace(hour=23, minute=59, second=59)
-        return s, e, f"Сегодня ({now.strftime('%d.%m.%Y')})"
-    elif period_type == "yesterday":
-        y = now - timedelta(days=1)
-        s = y.replace(hour=0, minute=0, second=0, microsecond=0)
-        e = y.replace(hour=23, minute=59, second=59)
-        return s, e, f"Вчера ({y.strftime('%d.%m.%Y')})"
-    elif period_type == "week":
-        wd = now.weekday()
-        s = (now - timedelta(days=wd)).replace(hour=0, minute=0, second=0, microsecond=0)
-        e = (s + timedelta(days=6)).replace(hour=23, minute=59, second=59)
-        return s, e, f"Неделя ({s.strftime('%d.%m')}–{e.strftime('%d.%m.%Y')})"
-    elif period_type == "month":
-        s = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        e = (s + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
-        return s, e, current_month_ru()
-    elif period_type == "quarter":
-        q = (now.month - 1) // 3
-        s = datetime(now.year, q * 3 + 1, 1)
-        e_month = q * 3 + 3
-        e = datetime(now.year, e_month, 1) + timedelta(days=32)
-        e = e.replace(day=1) - timedelta(seconds=1)
-        return s, e, f"Q{q+1} {now.year}"
-    elif period_type == "year":
-        s = datetime(now.year, 1, 1)
-        e = datetime(now.year, 12, 31, 23, 59, 59)
-        return s, e, f"{now.year} год"
-    elif period_type == "day" and custom_date:
-        t = datetime.strptime(custom_date, "%Y-%m-%d")
-        return t.replace(hour=0,minute=0,second=0), t.replace(hour=23,minute=59,second=59), t.strftime("%d.%m.%Y")
-    else:
-        return datetime(2020,1,1), datetime(2099,12,31), "Весь период"
-
-def filter_by_period(rows, start, end):
-    result = []
-    for r in rows:
-        d = dict(r)
-        ds = d.get('Дата отправки','') or d.get('submitted_at','')
-        dt = parse_date_flexible(str(ds))
-        if dt and start.date() <= dt.date() <= end.date():
-            result.append(d)
-    return result
+app.router.route_class = DBRoute
 
 # ============= MODELS =============
 class BranchRegister(BaseModel):
@@ -252,9 +95,108 @@ class BranchSummary(BaseModel):
 class EmailReportRequest(BaseModel):
     period_type: str; custom_date: Optional[str] = None
 
+class NetworkReportRequest(EmailReportRequest):
+    mode: str = "consolidated"  # consolidated — одна книга, per_branch — zip с книгой на филиал
+
+# ============= SCHEDULER =============
+SCHEDULED_JOBS = []
+
+def schedule_job(name, fn, every=None, at_hour=None):
+    """Фоновая задача: каждые every секунд или раз в сутки в at_hour часов"""
+    SCHEDULED_JOBS.append({"name": name, "fn": fn, "every": every, "at_hour": at_hour,
+        "last_run": datetime.now() if every else None, "last_result": None, "last_error": None})
+
+def job_due(job, now):
+    if job["every"]: return (now - job["last_run"]).total_seconds() >= job["every"]
+    return now.hour == job["at_hour"] and (not job["last_run"] or job["last_run"].date() < now.date())
+
+def load_job_runs():
+    """Время прошлых запусков из job_runs — новый ведущий не повторяет сегодняшние ночные задачи"""
+    with get_db() as conn:
+        runs = {r['name']: r['last_run'] for r in conn.execute("SELECT name, last_run FROM job_runs").fetchall()}
+    for job in SCHEDULED_JOBS:
+        if job["name"] in runs: job["last_run"] = datetime.strptime(runs[job["name"]], "%Y-%m-%d %H:%M:%S")
+
+def save_job_run(job):
+    with get_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO job_runs (name, last_run, last_duration, last_result, last_error, pid) VALUES (?,?,?,?,?,?)",
+            (job["name"], job["last_run"].strftime("%Y-%m-%d %H:%M:%S"), job["last_duration"], json.dumps(job["last_result"], ensure_ascii=False, default=str), job["last_error"], os.getpid()))
+
+def on_lead():
+    """Обязанности, которые процесс берёт, став ведущим"""
+    load_job_runs()
+    if not db.DIM_READY: threading.Thread(target=backfill_dimensions, daemon=True).start()
+    resume_branch_deletions()
+
+def scheduler_loop():
+    leading = False
+    while True:
+        if not leading and try_lead(): leading = True; on_lead()
+        now = datetime.now()
+        for job in SCHEDULED_JOBS if leading else []:
+            if not job_due(job, now): continue
+            job["last_run"] = now
+            t0 = time.monotonic()
+            try: job["last_result"], job["last_error"] = job["fn"](), None
+            except Exception as e:
+                job["last_error"] = str(e); logger.error(f"❌ Задача {job['name']}: {e}")
+            job["last_duration"] = round(time.monotonic() - t0, 3)
+            # сбой записи (БД занята, диск) не должен останавливать планировщик — следующий запуск запишется
+            try: save_job_run(job)
+            except Exception as e: logger.error(f"❌ Запуск задачи {job['name']} не сохранён: {e}")
+        time.sleep(30)
+
+
+# ============= ОБСЛУЖИВАНИЕ SQLITE =============
+def wal_size(path=DB_PATH):
+    try: return os.path.getsize(path + "-wal")
+    except OSError: return 0
+
+def wal_checkpoint(force=False):
+    """wal_checkpoint(TRUNCATE), если с прошлой проверки не было записей (или force) — WAL не растёт между рестартами"""
+    seq = latest_change_seq()
+    quiet = seq == _maintenance_state.get("seq")
+    _maintenance_state["seq"] = seq
+    if not (quiet or force): return {"skipped": "были записи", "wal_bytes": wal_size()}
+    if not SHARD_DIR: return checkpoint_file(None)
+    # каталог и шарды — отдельные файлы со своими WAL
+    return {shard or "catalog": checkpoint_file(shard) for shard in [None] + data_parts()}
+
+def checkpoint_file(shard):
+    path = shard_path(shard) if shard else DB_PATH
+    before = wal_size(path)
+    with use_shard(shard), get_db() as conn:
+        busy, log, done = conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)").fetchone()
+    return {"busy": busy, "log_frames": log, "checkpointed_frames": done, "wal_bytes_before": before, "wal_bytes_after": wal_size(path)}
+
+def optimize_db():
+    """Ночное обслуживание: ANALYZE + PRAGMA optimize, затем принудительный checkpoint"""
+    t0 = time.monotonic()
+    for shard in data_parts() + ([None] if SHARD_DIR else []):
+        with use_shard(shard), get_db() as conn:
+            conn.execute("ANALYZE main")
+            conn.execute("PRAGMA main.optimize")
+    return {"analyze_seconds": round(time.monotonic() - t0, 3), "checkpoint": wal_checkpoint(force=True)}
+
+_maintenance_state = {}
+schedule_job("wal-checkpoint", wal_checkpoint, every=CHECKPOINT_EVERY)
+schedule_job("optimize", optimize_db, at_hour=MAINTENANCE_HOUR)
+
 # ============= STARTUP =============
+def init_db():
+    """Схема общей БД; с SHARD_DIR — каталог и файлы живых филиалов"""
+    branches = init_catalog()
+    for b in branches: init_shard(b['name'], b['id'])
+    if SHARD_DIR: logger.info(f"✅ Каталог и {len(branches)} шардов инициализированы")
+
 @app.on_event("startup")
-def startup(): init_db()
+def startup():
+    # схему создаёт и мигрирует только ведущий; остальные воркеры ждут на замке, пока он не закончит
+    with file_lock("init"):
+        if try_lead(): init_db()
+    threading.Thread(target=scheduler_loop, daemon=True).start()
+    # процессы отчётов стартуют (spawn + импорт) заранее, а не на первом запросе
+    for _ in range(REPORT_WORKERS): get_report_pool().submit(os.getpid)
 
 @app.get("/health")
 def health(): return {"status": "healthy", "version": "5.1.0"}
@@ -263,17 +205,21 @@ def health(): return {"status": "healthy", "version": "5.1.0"}
 @app.post("/register")
 def register_branch(b: BranchRegister):
     with get_db() as conn:
-        if conn.execute("SELECT id FROM branches WHERE name=?", (b.name,)).fetchone():
-            raise HTTPException(400, "Филиал с таким названием уже существует")
+        ex = conn.execute("SELECT deleted_at FROM branches WHERE name=?", (b.name,)).fetchone()
+        if ex and ex['deleted_at']: raise HTTPException(400, "Филиал с таким названием ещё удаляется, повторите позже")
+        if ex: raise HTTPException(400, "Филиал с таким названием уже существует")
         token = generate_token()
-        conn.execute("INSERT INTO branches (name,address,manager_name,manager_phone,password_hash,token,created_at) VALUES (?,?,?,?,?,?,?)",
-            (b.name, b.address, b.manager_name, b.manager_phone, hash_password(b.password), token, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        bid = conn.execute("INSERT INTO branches (name,address,manager_name,manager_phone,password_hash,token,created_at) VALUES (?,?,?,?,?,?,?)",
+            (b.name, b.address, b.manager_name, b.manager_phone, hash_password(b.password), token, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))).lastrowid
+        if SHARD_DIR: init_shard(b.name, bid)
+    if SHARD_DIR:
+        with use_shard(b.name), get_db() as conn: log_branch_change(conn, bid, "insert", b.name)
     return {"success": True, "message": "Филиал зарегистрирован", "token": token, "branch_name": b.name}
 
 @app.post("/login")
 def login(r: LoginRequest):
     with get_db() as conn:
-        br = conn.execute("SELECT * FROM branches WHERE name=?", (r.name,)).fetchone()
+        br = conn.execute("SELECT * FROM branches WHERE name=? AND deleted_at IS NULL", (r.name,)).fetchone()
         if not br: raise HTTPException(401, "Неверное название филиала")
         if br['password_hash'] != hash_password(r.password): raise HTTPException(401, "Неверный пароль")
         return {"success": True, "token": br['token'], "branch": {"name": r.name, "manager": br['manager_name']}}
@@ -287,80 +233,137 @@ def admin_login(r: AdminLoginRequest):
 @app.get("/branches")
 def get_branches():
     with get_db() as conn:
-        rows = conn.execute("SELECT name FROM branches ORDER BY name").fetchall()
+        rows = conn.execute("SELECT name FROM branches WHERE deleted_at IS NULL ORDER BY name").fetchall()
     return {"success": True, "branches": [r['name'] for r in rows]}
 
 @app.get("/branches/details")
 def get_branches_details():
     with get_db() as conn:
-        rows = conn.execute("SELECT name, address, manager_name, manager_phone, created_at FROM branches ORDER BY name").fetchall()
+        rows = conn.execute("SELECT name, address, manager_name, manager_phone, created_at FROM branches WHERE deleted_at IS NULL ORDER BY name").fetchall()
     return {"success": True, "branches": [dict(r) for r in rows]}
 
 # ============= ADMIN: УПРАВЛЕНИЕ ФИЛИАЛАМИ =============
 @app.put("/admin/branches/{branch_name}")
 def admin_update_branch(branch_name: str, data: BranchUpdate):
     with get_db() as conn:
-        br = conn.execute("SELECT id FROM branches WHERE name=?", (branch_name,)).fetchone()
+        br = conn.execute("SELECT id FROM branches WHERE name=? AND deleted_at IS NULL", (branch_name,)).fetchone()
         if not br: raise HTTPException(404, "Филиал не найден")
         if data.manager_name: conn.execute("UPDATE branches SET manager_name=? WHERE name=?", (data.manager_name, branch_name))
         if data.manager_phone: conn.execute("UPDATE branches SET manager_phone=? WHERE name=?", (data.manager_phone, branch_name))
         if data.address: conn.execute("UPDATE branches SET address=? WHERE name=?", (data.address, branch_name))
         if data.password: conn.execute("UPDATE branches SET password_hash=? WHERE name=?", (hash_password(data.password), branch_name))
+        if data.manager_name or data.manager_phone or data.address: log_branch_change(conn, br['id'], "update", branch_name)
     return {"success": True, "message": f"Филиал '{branch_name}' обновлён"}
 
 @app.delete("/admin/branches/{branch_name}")
 def admin_delete_branch(branch_name: str):
-    with get_db() as conn:
-        br = conn.execute("SELECT id FROM branches WHERE name=?", (branch_name,)).fetchone()
+    """Помечает филиал удалённым и запускает фоновое удаление данных порциями. Филиал и задача берутся из каталога:
+    повтор после сбоя срабатывает, даже если файл филиала уже удалён"""
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with use_shard(None), get_db() as conn:
+        br = conn.execute("SELECT id, deleted_at FROM branches WHERE name=?", (branch_name,)).fetchone()
         if not br: raise HTTPException(404, "Филиал не найден")
-        for t in ["morning_events","field_visits","one_on_one","weekly_metrics","master_plans","reviews","newbie_adaptation","branch_summaries"]:
-            conn.execute(f"DELETE FROM {t} WHERE branch_name=?", (branch_name,))
-        conn.execute("DELETE FROM branches WHERE name=?", (branch_name,))
-    return {"success": True, "message": f"Филиал '{branch_name}' и все его данные удалены"}
+        if br['deleted_at']:
+            job = conn.execute("SELECT id, status FROM branch_deletions WHERE branch_name=? ORDER BY id DESC LIMIT 1", (branch_name,)).fetchone()
+            if job and job['status'] != 'failed': return {"success": True, "message": f"Филиал '{branch_name}' уже удаляется", "job_id": job['id']}
+        total = branch_row_count(conn, branch_name)  # до первой записи: архивы отключаются только вне транзакции
+        conn.execute("UPDATE branches SET deleted_at=? WHERE name=?", (ts, branch_name))
+        job_id = conn.execute("INSERT INTO branch_deletions (branch_name,status,total_rows,started_at) VALUES (?,?,?,?)",
+            (branch_name, "pending", total, ts)).lastrowid
+    if SHARD_DIR and os.path.exists(shard_path(branch_name)):
+        with use_shard(branch_name), get_db() as conn: log_branch_change(conn, br['id'], "update", branch_name)
+    threading.Thread(target=run_branch_deletion, args=(job_id,), daemon=True).start()
+    return {"success": True, "message": f"Филиал '{branch_name}' скрыт, данные удаляются в фоне", "job_id": job_id}
 
-# ============= GENERIC CRUD HELPERS =============
-SECTION_CONFIG = {
-    "morning-events": {
-        "table": "morning_events",
-        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', week as 'Неделя', event_type as 'Тип мероприятия', participants as 'Участники', efficiency as 'Эффективность', comment as 'Комментарий'",
-        "update_fields": {"date":"date","week":"week","event_type":"event_type","participants":"participants","efficiency":"efficiency","comment":"comment"},
-    },
-    "field-visits": {
-        "table": "field_visits",
-        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', master_name as 'Имя мастера', haircut_quality as 'Качество стрижки', service_quality as 'Качество обслуживания', additional_services_comment as 'Доп. услуги (комм.)', additional_services_rating as 'Доп. услуги (оценка)', cosmetics_comment as 'Косметика (комм.)', cosmetics_rating as 'Косметика (оценка)', standards_comment as 'Стандарты (комм.)', standards_rating as 'Стандарты (оценка)', errors_comment as 'Ошибки', next_check_date as 'Дата след. проверки', average_rating as 'Общая оценка'",
-    },
-    "one-on-one": {
-        "table": "one_on_one",
-        "select": "id, submitted_at as 'Дата отправки', date as 'Дата', master_name as 'Имя мастера', goal as 'Цель', results as 'Результаты', development_plan as 'План развития', indicator as 'Показатель', next_meeting_date as 'Дата след. встречи'",
-    },
-    "weekly-metrics": {
-        "table": "weekly_metrics",
-        "select": "id, submitted_at as 'Дата отправки', period as 'Период', average_check_plan as 'Средний чек (план)', average_check_fact as 'Средний чек (факт)', cosmetics_plan as 'Косметика (план)', cosmetics_fact as 'Косметика (факт)', additional_services_plan as 'Доп. услуги (план)', additional_services_fact as 'Доп. услуги (факт)'",
-    },
-    "master-plans": {
-        "table": "master_plans",
-        "select": "id, submitted_at as 'Дата отправки', month as 'Месяц', master_name as 'Имя мастера', average_check_plan as 'Средний чек (план)', average_check_fact as 'Средний чек (факт)', additional_services_plan as 'Доп. услуги (план)', additional_services_fact as 'Доп. услуги (факт)', sales_plan as 'Продажи (план)', sales_fact as 'Продажи (факт)', salary_plan as 'ЗП (план)', salary_fact as 'ЗП (факт)'",
-    },
-    "reviews": {
-        "table": "reviews",
-        "select": "id, submitted_at as 'Дата отправки', week as 'Неделя', manager_name as 'Имя руководителя', plan as 'План', fact as 'Факт', monthly_target as 'Месячная цель'",
-    },
-    "newbie-adaptation": {
-        "table": "newbie_adaptation",
-        "select": "id, submitted_at as 'Дата отправки', start_date as 'Дата начала', name as 'Имя', haircut_practice as 'Практика стрижки', service_standards as 'Стандарты обслуживания', hygiene_sanitation as 'Гигиена/санитария', additional_services as 'Доп. услуги', cosmetics_sales as 'Продажи косметики', iclient_basics as 'Основы iClient', status as 'Статус'",
-    },
-    "branch-summary": {
-        "table": "branch_summaries",
-        "select": "id, submitted_at as 'Дата отправки', manager as 'Руководитель', month as 'Месяц', metric as 'Метрика', current_value as 'Текущее количество', goal_value as 'Цель на месяц', percentage as 'Выполнение %'",
-    },
-}
+def branch_row_count(conn, bn):
+    """Строки секций филиала для прогресса удаления; conn — общая БД или каталог (тогда архивы плюс файл филиала, если он ещё есть)"""
+    col, key = branch_key(conn, bn)
+    n = sum(conn.execute(f"SELECT COUNT(*) FROM {s}.{t} WHERE {col}=?", (key,)).fetchone()[0]
+            for s in chain([] if SHARD_DIR else ["main"], each_archive(conn)) for t in SECTION_TABLES if table_columns(conn, t, s))
+    if SHARD_DIR and os.path.exists(shard_path(bn)):
+        with use_shard(bn), get_db(readonly=True) as sc: n += sum(sc.execute(f"SELECT COUNT(*) FROM main.{t}").fetchone()[0] for t in SECTION_TABLES)
+    return n
+
+@app.get("/admin/branch-deletions/{job_id}")
+def get_branch_deletion(job_id: int):
+    with get_db() as conn:
+        job = conn.execute("SELECT * FROM branch_deletions WHERE id=?", (job_id,)).fetchone()
+    if not job: raise HTTPException(404, "Задача удаления не найдена")
+    job = dict(job)
+    job["progress"] = round(job["deleted_rows"] / job["total_rows"] * 100, 1) if job["total_rows"] else (100.0 if job["status"] == "done" else 0.0)
+    return {"success": True, "job": job}
+
+def run_branch_deletion(job_id):
+    """Выполняет задачу, если её уже не ведёт другой поток или воркер. Замок на задачу — flock: владелец умер —
+    ядро снимает замок, и задачу подхватывает следующий resume_branch_deletions"""
+    with file_lock(f"deletion-{job_id}", blocking=False) as claimed:
+        # замок больше не нужен: кто откроет файл позже, увидит status='done'
+        if claimed and delete_branch_data(job_id): os.remove(f"{DB_PATH}.deletion-{job_id}.lock")
 
-def get_section_data(branch_name, section):
+def delete_branch_data(job_id):
+    """Удаляет данные филиала порциями по DELETE_CHUNK_SIZE строк, каждая порция — отдельная короткая транзакция"""
+    with get_db() as conn:
+        job = conn.execute("SELECT branch_name, status FROM branch_deletions WHERE id=?", (job_id,)).fetchone()
+        if not job or job['status'] not in ('pending', 'running'): return False
+        bn = job['branch_name']
+        conn.execute("UPDATE branch_deletions SET status='running', owner_pid=? WHERE id=?", (os.getpid(), job_id)); conn.commit()
+        col, key = branch_key(conn, bn)
+        try:
+            # с шардами conn — каталог: здесь только архивы, файл филиала удаляется целиком ниже
+            for s in chain(each_archive(conn), [] if SHARD_DIR else ["main"]):
+                for t in SECTION_TABLES:
+                    if not table_columns(conn, t, s): continue
+                    while True:
+                        n = conn.execute(f"DELETE FROM {s}.{t} WHERE id IN (SELECT id FROM {s}.{t} WHERE {col}=? LIMIT ?)", (key, DELETE_CHUNK_SIZE)).rowcount
+                        conn.execute("UPDATE branch_deletions SET deleted_rows=deleted_rows+? WHERE id=?", (n, job_id)); conn.commit()
+                        if n < DELETE_CHUNK_SIZE: break
+                        time.sleep(DELETE_CHUNK_PAUSE)
+            if SHARD_DIR: drop_shard(bn, job_id)
+            else:
+                # Строки, дописанные во время удаления, добиваем вместе с самим филиалом
+                for t in SECTION_TABLES: conn.execute(f"DELETE FROM {t} WHERE {col}=?", (key,))
+                conn.execute("DELETE FROM master_rollup WHERE branch_name=?", (bn,))
+                for dim in ("masters", "managers"): conn.execute(f"DELETE FROM {dim} WHERE branch_id=(SELECT id FROM branches WHERE name=?)", (bn,))
+            # вместо тысяч удалений по строкам в ленте остаётся одно — удаление самого филиала
+            conn.execute("DELETE FROM changes WHERE branch_name=?", (bn,))
+            conn.execute("DELETE FROM branches WHERE name=? AND deleted_at IS NOT NULL", (bn,))
+            conn.execute("UPDATE branch_deletions SET status='done', finished_at=? WHERE id=?", (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+            conn.commit()
+            forget_branch_id(bn)
+            logger.info(f"🗑 Филиал '{bn}' удалён (задача {job_id})")
+            return True
+        except Exception as e:
+            conn.rollback()
+            conn.execute("UPDATE branch_deletions SET status='failed', error=? WHERE id=?", (str(e), job_id))
+            logger.error(f"❌ Удаление филиала '{bn}' (задача {job_id}): {e}")
+            return False
+
+def resume_branch_deletions():
+    """Подхватывает удаления, чей владелец (рестарт, упавший воркер) больше не держит замок задачи"""
+    with get_db() as conn:
+        jobs = conn.execute("SELECT id FROM branch_deletions WHERE status IN ('pending','running')").fetchall()
+    for j in jobs: threading.Thread(target=run_branch_deletion, args=(j['id'],), daemon=True).start()
+    return {"checked": len(jobs)}
+
+schedule_job("branch-deletions", resume_branch_deletions, every=60)
+
+# ============= GENERIC CRUD HELPERS =============
+def read_section(conn, branch_name, section, start=None, end=None):
+    """Записи секции филиала; с периодом — только за него (архивы подключаются по годам периода)"""
     cfg = SECTION_CONFIG.get(section)
     if not cfg: raise HTTPException(400, f"Неизвестная секция: {section}")
+    col, key = branch_key(conn, branch_name)
+    where, params = f"{col}=?", [key]
+    if start: where += " AND submitted_at >= ? AND submitted_at < ?"; params += period_bounds(start, end)
+    rows = []
+    for years, hot in archive_batches(conn, start, end):
+        rows += conn.execute(f"SELECT {cfg['select']} FROM {section_source(conn, cfg['table'], years=years, hot=hot)} WHERE {where}", params).fetchall()
+    return [dict(r) for r in sorted(rows, key=lambda r: r['id'], reverse=True)]
+
+def get_section_data(branch_name, section, start=None, end=None):
+    if section not in SECTION_CONFIG: raise HTTPException(400, f"Неизвестная секция: {section}")
     with get_db() as conn:
-        rows = conn.execute(f"SELECT {cfg['select']} FROM {cfg['table']} WHERE branch_name=? ORDER BY id DESC", (branch_name,)).fetchall()
-    return {"success": True, "data": [dict(r) for r in rows]}
+        return {"success": True, "data": read_section(conn, branch_name, section, start, end)}
 
 # ============= УНИВЕРСАЛЬНОЕ РЕДАКТИРОВАНИЕ И УДАЛЕНИЕ =============
 @app.put("/record/{section}/{record_id}")
@@ -393,17 +396,27 @@ def update_record(section: str, record_id: int, data: Dict[str, Any]):
     if not sets: raise HTTPException(400, "Нет полей для обновления")
     vals.append(record_id)
     
-    with get_db() as conn:
-        r = conn.execute(f"SELECT id FROM {table} WHERE id=?", (record_id,)).fetchone()
-        if not r: raise HTTPException(404, "Запись не найдена")
-        conn.execute(f"UPDATE {table} SET {','.join(sets)} WHERE id=?", vals)
+    with use_shard(record_branch(record_id)), get_db() as conn:
+        schema = locate_record(conn, table, record_id)
+        if not schema: raise HTTPException(404, "Запись не найдена")
+        before = conn.execute(f"SELECT * FROM {schema}.{table} WHERE id=?", (record_id,)).fetchone()
+        dim = DIM_COLUMNS.get(table)
+        if dim and f"{dim[0]}=?" in sets and dim[2] in before.keys():
+            vals.insert(len(sets), dim_id(conn, dim[1], before['branch_id'], vals[sets.index(f"{dim[0]}=?")])); sets.append(f"{dim[2]}=?")
+        conn.execute(f"UPDATE {schema}.{table} SET {','.join(sets)} WHERE id=?", vals)
         
         # Пересчёт средней оценки для полевых выходов
         if table == "field_visits":
-            row = conn.execute("SELECT haircut_quality,service_quality,additional_services_rating,cosmetics_rating,standards_rating FROM field_visits WHERE id=?", (record_id,)).fetchone()
+            row = conn.execute(f"SELECT haircut_quality,service_quality,additional_services_rating,cosmetics_rating,standards_rating FROM {schema}.field_visits WHERE id=?", (record_id,)).fetchone()
             if row:
                 avg = round((row[0]+row[1]+row[2]+row[3]+row[4])/5, 1)
-                conn.execute("UPDATE field_visits SET average_rating=? WHERE id=?", (avg, record_id))
+                conn.execute(f"UPDATE {schema}.field_visits SET average_rating=? WHERE id=?", (avg, record_id))
+        
+        if schema != "main":
+            bump_data_version(conn, before['branch_name'], table); log_change(conn, table, record_id, "update", before['branch_name'])
+        if table in MASTER_TABLES and schema == "main":
+            after = conn.execute(f"SELECT master_name FROM {table} WHERE id=?", (record_id,)).fetchone()
+            refresh_master_rollup(conn, before['branch_name'], [before['master_name'], after['master_name']])
     
     return {"success": True, "message": "Запись обновлена"}
 
@@ -412,26 +425,86 @@ def delete_record(section: str, record_id: int):
     """Универсальное удаление записи по id"""
     cfg = SECTION_CONFIG.get(section)
     if not cfg: raise HTTPException(400, f"Неизвестная секция: {section}")
-    with get_db() as conn:
-        r = conn.execute(f"SELECT id FROM {cfg['table']} WHERE id=?", (record_id,)).fetchone()
-        if not r: raise HTTPException(404, "Запись не найдена")
-        conn.execute(f"DELETE FROM {cfg['table']} WHERE id=?", (record_id,))
+    with use_shard(record_branch(record_id)), get_db() as conn:
+        schema = locate_record(conn, cfg['table'], record_id)
+        if not schema: raise HTTPException(404, "Запись не найдена")
+        before = conn.execute(f"SELECT * FROM {schema}.{cfg['table']} WHERE id=?", (record_id,)).fetchone()
+        conn.execute(f"DELETE FROM {schema}.{cfg['table']} WHERE id=?", (record_id,))
+        if schema != "main":
+            bump_data_version(conn, before['branch_name'], cfg['table']); log_change(conn, cfg['table'], record_id, "delete", before['branch_name'])
+        if cfg['table'] in MASTER_TABLES and schema == "main":
+            refresh_master_rollup(conn, before['branch_name'], [before['master_name']])
     return {"success": True, "message": "Запись удалена"}
 
+# ============= ЛЕНТА ИЗМЕНЕНИЙ =============
+def compact_changes():
+    """Удаляет записи ленты старше CHANGES_KEEP_DAYS дней (в шардах — и в ленте каталога)"""
+    n = 0
+    for shard in data_parts() + ([None] if SHARD_DIR else []):
+        with use_shard(shard), get_db() as conn:
+            n += conn.execute("DELETE FROM main.changes WHERE changed_at < datetime('now','localtime',?)", (f"-{CHANGES_KEEP_DAYS} days",)).rowcount
+    return {"deleted": n}
+
+schedule_job("changes-compact", compact_changes, every=3600)
+
+def changed_rows(conn, table, ids):
+    """Текущее содержимое изменённых записей {id: строка} — в том же виде, что отдают секции"""
+    if table == "branches":
+        q, schemas = "id, name, address, manager_name, manager_phone, deleted_at", [""]  # в шарде branches — из catalog
+    else:
+        q, schemas = next(c['select'] for c in SECTION_CONFIG.values() if c['table'] == table), chain(["main"], each_archive(conn))
+    found, left = {}, set(ids)
+    # архивы — только для записей, которых уже нет в горячей таблице
+    for s in schemas:
+        if s not in ("", "main") and not table_columns(conn, table, s): continue
+        for r in conn.execute(f"SELECT {q} FROM {f'{s}.' if s else ''}{table} WHERE id IN ({','.join('?'*len(left))})", list(left)).fetchall(): found[r['id']] = dict(r)
+        left -= set(found)
+        if not left: break
+    return found
+
+@app.get("/changes")
+def get_changes(since: int = Query(0, ge=0), branch: Optional[str] = None, limit: int = Query(500, ge=1, le=5000)):
+    """Изменения после seq=since. reset=true — часть ленты уже сжата, клиенту нужна полная перезагрузка"""
+    # у каждого шарда своя лента и свои seq — общего курсора по сети нет
+    if SHARD_DIR and not branch: raise HTTPException(400, "При раздельных файлах филиалов укажите branch")
+    where, params = "seq > ?", [since]
+    if branch: where += " AND branch_name=?"; params.append(branch)
+    with use_shard(branch), get_db() as conn:
+        conn.execute("BEGIN")  # один снимок: latest не должен обогнать выбранные строки
+        rows = [dict(r) for r in conn.execute(f"SELECT * FROM changes WHERE {where} ORDER BY seq LIMIT ?", params + [limit + 1]).fetchall()]
+        latest = (conn.execute("SELECT seq FROM sqlite_sequence WHERE name='changes'").fetchone() or [0])[0]
+        oldest = conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        ids = {}
+        for r in rows:
+            if r['op'] != "delete": ids.setdefault(r['table_name'], set()).add(r['record_id'])
+        # снимок ленты взят; содержимое записей читается уже вне транзакции (архивы подключаются по одному),
+        # поэтому оно может быть новее seq — следующий запрос ленты вернёт ту же запись ещё раз
+        conn.commit()
+        data = {t: changed_rows(conn, t, i) for t, i in ids.items()}
+    sections = {c['table']: k for k, c in SECTION_CONFIG.items()}
+    for r in rows:
+        r['section'] = sections.get(r['table_name'], r['table_name'])
+        r['data'] = data.get(r['table_name'], {}).get(r['record_id'])
+    return {"success": True, "changes": rows, "next": rows[-1]['seq'] if has_more else max(since, latest),
+            "has_more": has_more, "latest": latest, "reset": since < latest and since < (oldest or latest + 1) - 1}
+
 # ============= DASHBOARD =============
 @app.get("/dashboard-summary/{branch_name}")
 def get_dashboard_summary(branch_name: str):
     cm = current_month_ru()
     with get_db() as conn:
-        if not conn.execute("SELECT id FROM branches WHERE name=?", (branch_name,)).fetchone():
+        if not conn.execute("SELECT id FROM branches WHERE name=? AND deleted_at IS NULL", (branch_name,)).fetchone():
             raise HTTPException(404, f"Филиал '{branch_name}' не найден")
-        me = count_for_month(conn.execute("SELECT submitted_at FROM morning_events WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
-        fv = count_for_month(conn.execute("SELECT submitted_at FROM field_visits WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
-        oo = count_for_month(conn.execute("SELECT submitted_at FROM one_on_one WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
-        mp = count_for_month(conn.execute("SELECT submitted_at FROM master_plans WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
-        wm = count_for_month(conn.execute("SELECT submitted_at FROM weekly_metrics WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
-        rv = sum_reviews_month(conn.execute("SELECT submitted_at, fact FROM reviews WHERE branch_name=?", (branch_name,)).fetchall(), cm)
-        na = count_for_month(conn.execute("SELECT submitted_at FROM newbie_adaptation WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', cm)
+        col, key = branch_key(conn, branch_name)
+        me = count_for_month(conn.execute(f"SELECT submitted_at FROM morning_events WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
+        fv = count_for_month(conn.execute(f"SELECT submitted_at FROM field_visits WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
+        oo = count_for_month(conn.execute(f"SELECT submitted_at FROM one_on_one WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
+        mp = count_for_month(conn.execute(f"SELECT submitted_at FROM master_plans WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
+        wm = count_for_month(conn.execute(f"SELECT submitted_at FROM weekly_metrics WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
+        rv = sum_reviews_month(conn.execute(f"SELECT submitted_at, fact FROM reviews WHERE {col}=?", (key,)).fetchall(), cm)
+        na = count_for_month(conn.execute(f"SELECT submitted_at FROM newbie_adaptation WHERE {col}=?", (key,)).fetchall(), 'submitted_at', cm)
     
     summary = {
         "morning_events": {"current":me,"goal":BRANCH_GOALS["morning_events"],"percentage":0,"label":"Утренние мероприятия"},
@@ -446,15 +519,283 @@ def get_dashboard_summary(branch_name: str):
         if summary[k]["goal"] > 0: summary[k]["percentage"] = round((summary[k]["current"]/summary[k]["goal"])*100, 1)
     return {"success": True, "summary": summary}
 
+# ============= BACKUP =============
+if BACKUP_HOUR is not None and BACKUP_KEEP > 0: schedule_job("backup", create_backup, at_hour=BACKUP_HOUR)
+
+app.include_router(backup_router)
+
+# ============= ADMIN: МЕТРИКИ =============
+@app.get("/admin/metrics")
+def admin_metrics():
+    """Профиль SQLite, размеры файлов и результаты фоновых задач"""
+    with get_db() as conn:
+        pragmas = {p: conn.execute(f"PRAGMA {p}").fetchone()[0] for p in ["journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "page_size", "page_count", "freelist_count"]}
+        analyzed = bool(conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone())
+        dims = {"ready": db.DIM_READY, "backlog": {} if db.DIM_READY else dimension_backlog(conn)}
+        runs = {r['name']: dict(r) for r in conn.execute("SELECT * FROM job_runs").fetchall()}
+    # задачи выполняет ведущий воркер, поэтому результаты — из job_runs, а не из памяти этого процесса
+    jobs = [{"name": j["name"], "every": j["every"], "at_hour": j["at_hour"], **{k: runs.get(j["name"], {}).get(k) for k in ("last_run", "last_duration", "last_error", "pid")},
+             "last_result": json.loads(runs[j["name"]]["last_result"]) if runs.get(j["name"], {}).get("last_result") else None} for j in SCHEDULED_JOBS]
+    files = {"db_bytes": os.path.getsize(DB_PATH), "wal_bytes": wal_size()}
+    if SHARD_DIR:
+        shards = glob.glob(os.path.join(SHARD_DIR, "branch_*.db"))
+        files["shards"] = {"count": len(shards), "db_bytes": sum(os.path.getsize(f) for f in shards), "wal_bytes": sum(wal_size(f) for f in shards)}
+    return {"success": True, "sqlite": {**pragmas, "analyzed": analyzed}, "files": files,
+            "dimensions": dims, "workers": {"pid": os.getpid(), "leader": is_leader(), "configured": WEB_CONCURRENCY}, "jobs": jobs}
+
+# ============= ADMIN: АРХИВ =============
+def archive_old_records(cutoff=None):
+    """Переносит записи старше cutoff в archive_YYYY.db порциями по ARCHIVE_CHUNK_SIZE"""
+    cs = (cutoff or archive_cutoff()).strftime("%Y-%m-%d")
+    moved = {}
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # шарды по очереди: архив года общий, параллельные переносы только спорили бы за его блокировку
+    for shard in data_parts():
+        with use_shard(shard), get_db() as conn: archive_conn(conn, cs, moved)
+    if moved: logger.info(f"📦 Архивировано до {cs}: {moved}")
+    return {"cutoff": cs, "moved": moved}
+
+if ARCHIVE_AFTER_MONTHS > 0: schedule_job("archive", archive_old_records, at_hour=ARCHIVE_HOUR)
+
+@app.post("/admin/archive")
+def admin_archive(before: Optional[str] = Query(None)):
+    """Переносит записи старше before (YYYY-MM-DD, по умолчанию ARCHIVE_AFTER_MONTHS) в архивные файлы"""
+    cutoff = None
+    if before:
+        try: cutoff = datetime.strptime(before, "%Y-%m-%d")
+        except ValueError: raise HTTPException(400, "Дата должна быть в формате YYYY-MM-DD")
+    elif ARCHIVE_AFTER_MONTHS <= 0: raise HTTPException(400, "Архивирование выключено (ARCHIVE_AFTER_MONTHS=0)")
+    return {"success": True, **archive_old_records(cutoff), "archives": archive_years()}
+
+# ============= ПОИСК =============
+app.include_router(search_router)
+
+# ============= ТРЕНДЫ =============
+# Метрика → таблица и агрегаты по корзине (пустые корзины: COUNT/SUM → 0, AVG → null)
+TREND_METRICS = {
+    "morning_events": {"table": "morning_events", "values": {"count": "COUNT(*)", "participants": "SUM(participants)", "efficiency_avg": "AVG(efficiency)"}},
+    "field_visits": {"table": "field_visits", "values": {"count": "COUNT(*)", "average_rating": "AVG(average_rating)"}},
+    "one_on_one": {"table": "one_on_one", "values": {"count": "COUNT(*)"}},
+    "weekly_metrics": {"table": "weekly_metrics", "values": {"count": "COUNT(*)",
+        "average_check_plan": "AVG(average_check_plan)", "average_check_fact": "AVG(average_check_fact)",
+        "cosmetics_plan": "SUM(cosmetics_plan)", "cosmetics_fact": "SUM(cosmetics_fact)",
+        "additional_services_plan": "SUM(additional_services_plan)", "additional_services_fact": "SUM(additional_services_fact)"}},
+    "master_plans": {"table": "master_plans", "values": {"count": "COUNT(*)",
+        "average_check_plan": "AVG(average_check_plan)", "average_check_fact": "AVG(average_check_fact)",
+        "sales_plan": "SUM(sales_plan)", "sales_fact": "SUM(sales_fact)", "salary_plan": "SUM(salary_plan)", "salary_fact": "SUM(salary_fact)"}},
+    "reviews": {"table": "reviews", "values": {"count": "COUNT(*)", "plan": "SUM(plan)", "fact": "SUM(fact)"}},
+    "newbie_adaptation": {"table": "newbie_adaptation", "values": {"count": "COUNT(*)"}},
+}
+TREND_BUCKETS = {"week": "date(submitted_at, 'weekday 0', '-6 days')", "month": "strftime('%Y-%m-01', submitted_at)"}
+
+def trend_range(bucket, date_from, date_to):
+    try:
+        end = datetime.strptime(date_to, "%Y-%m-%d") if date_to else datetime.now()
+        start = datetime.strptime(date_from, "%Y-%m-%d") if date_from else None
+    except ValueError: raise HTTPException(400, "Даты from/to должны быть в формате YYYY-MM-DD")
+    if not start:
+        if bucket == "week": start = end - timedelta(weeks=12)
+        else: months = end.year * 12 + end.month - 1 - 11; start = datetime(months // 12, months % 12 + 1, 1)
+    if start > end: raise HTTPException(400, "from позже to")
+    return start, end
+
+def trend_buckets(bucket, start, end):
+    """Все корзины диапазона — чтобы в ряду не было пропусков"""
+    cur = start - timedelta(days=start.weekday()) if bucket == "week" else start.replace(day=1)
+    out = []
+    while cur.date() <= end.date():
+        out.append(cur.strftime("%Y-%m-%d"))
+        cur = cur + timedelta(weeks=1) if bucket == "week" else (cur + timedelta(days=32)).replace(day=1)
+    return out
+
+def trend_series(rows, values, buckets):
+    found = {r['bucket']: r for r in rows}
+    empty = {k: (None if expr.startswith("AVG") else 0) for k, expr in values.items()}
+    return [{"bucket": b, **({k: (round(found[b][k], 2) if isinstance(found[b][k], float) else found[b][k]) for k in values} if b in found else empty)} for b in buckets]
+
+def query_trends(metric, bucket, date_from, date_to, branch_name=None):
+    cfg = TREND_METRICS.get(metric)
+    if not cfg: raise HTTPException(400, f"Неизвестная метрика: {metric}. Доступны: {', '.join(TREND_METRICS)}")
+    if bucket not in TREND_BUCKETS: raise HTTPException(400, "bucket должен быть week или month")
+    start, end = trend_range(bucket, date_from, date_to)
+    lo, hi = period_bounds(start, end)
+    aggs = ', '.join(f"{expr} AS {k}" for k, expr in cfg['values'].items())
+    if branch_name:
+        with get_db() as conn:
+            col, key = branch_key(conn, branch_name)
+            rows = conn.execute(f"SELECT {TREND_BUCKETS[bucket]} AS bucket, {aggs} FROM {section_source(conn, cfg['table'], start, end)} WHERE {col}=? AND submitted_at >= ? AND submitted_at < ? GROUP BY bucket",
+                (key, lo, hi)).fetchall()
+    else:
+        bcol, live = network_branch_key()
+        rows = fan_rows(lambda conn: conn.execute(f"""SELECT {bcol} AS branch, {TREND_BUCKETS[bucket]} AS bucket, {aggs} FROM {section_source(conn, cfg['table'], start, end)}
+            WHERE submitted_at >= ? AND submitted_at < ? AND {live} GROUP BY {bcol}, bucket""", (lo, hi)).fetchall())
+    buckets = trend_buckets(bucket, start, end)
+    result = {"success": True, "metric": metric, "bucket": bucket, "from": start.strftime("%Y-%m-%d"), "to": end.strftime("%Y-%m-%d")}
+    if branch_name: return {**result, "branch_name": branch_name, "series": trend_series(rows, cfg['values'], buckets)}
+    by_branch = {}
+    for r in rows: by_branch.setdefault(r['branch'], []).append(r)
+    with get_db() as conn: by_branch = dict(zip(branch_names(conn, by_branch), by_branch.values()))
+    return {**result, "series": {bn: trend_series(rs, cfg['values'], buckets) for bn, rs in sorted(by_branch.items())}}
+
+@app.get("/trends")
+def get_trends_all(metric: str = Query(...), bucket: str = Query("month"), date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to")):
+    """Тренд метрики по всем филиалам: {филиал: ряд по корзинам}"""
+    return query_trends(metric, bucket, date_from, date_to)
+
+@app.get("/trends/{branch_name}")
+def get_trends(branch_name: str, metric: str = Query(...), bucket: str = Query("month"), date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to")):
+    """Тренд метрики филиала по неделям/месяцам, одним GROUP BY-запросом"""
+    return query_trends(metric, bucket, date_from, date_to, branch_name)
+
+# ============= МАСТЕРА =============
+def master_rollup_rows(rows):
+    today = datetime.now().date()
+    out = []
+    for r in rows:
+        d = dict(r); last = parse_date_flexible(d['last_one_on_one_date'] or '')
+        d['days_since_one_on_one'] = (today - last.date()).days if last else None
+        out.append(d)
+    return out
+
+@app.get("/masters/{branch_name}")
+def get_masters(branch_name: str):
+    """Сводка по мастерам филиала: последние оценки, выполнение плана, дни с последнего One-on-One"""
+    with get_db() as conn:
+        if not conn.execute("SELECT id FROM branches WHERE name=? AND deleted_at IS NULL", (branch_name,)).fetchone():
+            raise HTTPException(404, f"Филиал '{branch_name}' не найден")
+        rows = conn.execute("""SELECT m.* FROM master_rollup m JOIN branches b ON b.name = m.branch_name
+            WHERE m.branch_name=? AND b.deleted_at IS NULL ORDER BY m.master_name""", (branch_name,)).fetchall()
+    return {"success": True, "data": master_rollup_rows(rows)}
+
+@app.get("/admin/masters")
+def admin_get_masters():
+    rows = fan_rows(lambda conn: conn.execute("""SELECT m.* FROM master_rollup m JOIN branches b ON b.name = m.branch_name
+        WHERE b.deleted_at IS NULL ORDER BY m.branch_name, m.master_name""").fetchall())
+    if SHARD_DIR: rows.sort(key=lambda r: (r['branch_name'], r['master_name']))
+    return {"success": True, "data": master_rollup_rows(rows)}
+
+# ============= РЕЙТИНГ =============
+# Метрика → таблица и префикс колонок plan/fact. По master_plans ранжируются ещё и мастера внутри филиала.
+LEADERBOARD_METRICS = {
+    "average_check": ("weekly_metrics", "average_check"), "cosmetics": ("weekly_metrics", "cosmetics"),
+    "additional_services": ("weekly_metrics", "additional_services"), "sales": ("master_plans", "sales"), "salary": ("master_plans", "salary"),
+}
+SHIFT_MONTHS = {"month": 1, "quarter": 3, "year": 12}
+
+def previous_period(period, start, end):
+    """Предыдущий период той же длины; для 'all' — None"""
+    if period not in SHIFT_MONTHS and period not in ("today", "yesterday", "week"): return None
+    if period in SHIFT_MONTHS:
+        m = start.year * 12 + start.month - 1 - SHIFT_MONTHS[period]
+        s = datetime(m // 12, m % 12 + 1, 1)
+        return s, start - timedelta(seconds=1)
+    days = (end.date() - start.date()).days + 1
+    return start - timedelta(days=days), start - timedelta(seconds=1)
+
+def group_sums(keys, plan, fact):
+    """Суммы plan/fact по ключам: (уникальные ключи, Σplan, Σfact, % выполнения или NaN без плана)"""
+    uniq, inv = np.unique(keys, return_inverse=True)
+    p, f = np.bincount(inv, weights=plan, minlength=len(uniq)), np.bincount(inv, weights=fact, minlength=len(uniq))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        att = np.where(p > 0, f / p * 100, np.nan)
+    return uniq, p, f, att
+
+def previous_on(keys, prev_keys, prev_att):
+    """% выполнения прошлого периода, выровненный по keys (оба массива ключей отсортированы); NaN — ключа не было"""
+    out = np.full(len(keys), np.nan)
+    if len(prev_keys):
+        at = np.searchsorted(prev_keys, keys).clip(max=len(prev_keys) - 1)
+        hit = prev_keys[at] == keys
+        out[hit] = prev_att[at[hit]]
+    return out
+
+def rank_stats(values, groups=None):
+    """Место (1 — лучший), перцентиль и z-оценка; с groups — внутри каждой группы. NaN не ранжируются"""
+    n = len(values)
+    groups = np.zeros(n, dtype=int) if groups is None else groups
+    ok = ~np.isnan(values)
+    rank, pctl, z = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+    idx = np.flatnonzero(ok)
+    if not len(idx): return rank, pctl, z
+    v, g = values[idx], groups[idx]
+    order = np.lexsort((-v, g))  # внутри группы — по убыванию
+    gs = g[order]
+    first = np.r_[0, np.flatnonzero(np.diff(gs)) + 1]
+    sizes = np.diff(np.r_[first, len(gs)])
+    pos = np.arange(len(gs)) - np.repeat(first, sizes)
+    size = np.repeat(sizes, sizes)
+    rank[idx[order]] = pos + 1
+    pctl[idx[order]] = np.where(size > 1, (size - 1 - pos) / np.maximum(size - 1, 1) * 100, 100.0)
+    cnt = np.bincount(g, minlength=g.max() + 1)
+    mean = np.bincount(g, weights=v) / np.maximum(cnt, 1)
+    std = np.sqrt(np.bincount(g, weights=(v - mean[g]) ** 2) / np.maximum(cnt, 1))
+    z[idx] = np.where(std[g] > 0, (v - mean[g]) / np.where(std[g] > 0, std[g], 1), 0.0)
+    return rank, pctl, z
+
+def num(x, digits=1):
+    return None if x is None or np.isnan(x) else round(float(x), digits)
+
+@app.get("/admin/leaderboard")
+def admin_leaderboard(period: str = Query("month"), metric: str = Query("sales")):
+    """Рейтинг филиалов (и мастеров внутри филиалов) по выполнению плана: место, перцентиль, z-оценка, изменение к прошлому периоду"""
+    if metric not in LEADERBOARD_METRICS: raise HTTPException(400, f"Неизвестная метрика: {metric}. Доступны: {', '.join(LEADERBOARD_METRICS)}")
+    table, col = LEADERBOARD_METRICS[metric]
+    start, end, label = get_period_dates(period)
+    prev = previous_period(period, start, end)
+    lo, hi = period_bounds(start, end)
+    plo = period_bounds(*prev)[0] if prev else lo
+    master = "TRIM(master_name)" if table == "master_plans" else "''"
+    bcol, live = network_branch_key()
+    rows = fan_rows(lambda conn: conn.execute(f"""SELECT {bcol}, {master}, {col}_plan, {col}_fact, submitted_at >= ? FROM {section_source(conn, table, prev[0] if prev else start, end)}
+        WHERE submitted_at >= ? AND submitted_at < ? AND {live}""", (lo, plo, hi)).fetchall())
+    if not rows: return {"success": True, "metric": metric, "period_label": label, "branches": [], "network": None}
+    branch, masters, plan, fact, current = (np.array(c) for c in zip(*rows))
+    plan, fact, current = plan.astype(float), fact.astype(float), current.astype(bool)
+    keys = np.unique(branch)
+    with get_db() as conn: names = dict(zip(keys.tolist(), branch_names(conn, keys.tolist())))
+
+    cur_b, cur_p, cur_f, cur_att = group_sums(branch[current], plan[current], fact[current])
+    prev_on_cur = previous_on(cur_b, *group_sums(branch[~current], plan[~current], fact[~current])[::3]) if prev else np.full(len(cur_b), np.nan)
+    rank, pctl, z = rank_stats(cur_att)
+
+    by_master = {}
+    if table == "master_plans" and current.any():
+        # ключ (филиал, мастер) одним числом — по строкам обоих периодов, чтобы мастера сопоставлялись с прошлым периодом
+        ub, ib = np.unique(branch, return_inverse=True)
+        um, im = np.unique(masters, return_inverse=True)
+        key = ib * len(um) + im
+        mk, mp, mf, matt = group_sums(key[current], plan[current], fact[current])
+        mprev = previous_on(mk, *group_sums(key[~current], plan[~current], fact[~current])[::3]) if prev else np.full(len(mk), np.nan)
+        mrank, mpctl, mz = rank_stats(matt, mk // len(um))
+        for i, k in enumerate(mk):
+            by_master.setdefault(names[ub[k // len(um)].item()], []).append({"master_name": str(um[k % len(um)]), "plan": num(mp[i], 2), "fact": num(mf[i], 2), "attainment": num(matt[i]),
+                "previous_attainment": num(mprev[i]), "delta": num(matt[i] - mprev[i]),
+                "rank_in_branch": None if np.isnan(mrank[i]) else int(mrank[i]), "percentile_in_branch": num(mpctl[i]), "z_score": num(mz[i], 2)})
+        for ms in by_master.values(): ms.sort(key=lambda m: (m["rank_in_branch"] is None, m["rank_in_branch"] or 0))
+
+    result = [{"branch_name": names[bk.item()], "plan": num(cur_p[i], 2), "fact": num(cur_f[i], 2), "attainment": num(cur_att[i]),
+               "previous_attainment": num(prev_on_cur[i]), "delta": num(cur_att[i] - prev_on_cur[i]),
+               "rank": None if np.isnan(rank[i]) else int(rank[i]), "percentile": num(pctl[i]), "z_score": num(z[i], 2),
+               **({"masters": by_master.get(names[bk.item()], [])} if table == "master_plans" else {})} for i, bk in enumerate(cur_b)]
+    result.sort(key=lambda b: (b["rank"] is None, b["rank"] or 0))
+    valid = cur_att[~np.isnan(cur_att)]
+    total_p, total_f = cur_p.sum(), cur_f.sum()
+    network = {"plan": num(total_p, 2), "fact": num(total_f, 2), "attainment": num(total_f / total_p * 100) if total_p > 0 else None,
+               **({f"p{q}": num(v) for q, v in zip((25, 50, 75, 90), np.percentile(valid, (25, 50, 75, 90)))} if len(valid) else {})}
+    return {"success": True, "metric": metric, "period_label": label,
+            "previous_period": [prev[0].strftime("%Y-%m-%d"), prev[1].strftime("%Y-%m-%d")] if prev else None,
+            "branches": result, "network": network}
+
 # ============= CRUD ENDPOINTS =============
 # --- Morning Events ---
 @app.post("/morning-events/{branch_name}")
 def submit_morning_events(branch_name: str, events: List[MorningEvent]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for e in events:
-            conn.execute("INSERT INTO morning_events (branch_name,submitted_at,date,week,event_type,participants,efficiency,comment) VALUES (?,?,?,?,?,?,?,?)",
-                (branch_name,ts,e.date,e.week,e.event_type,e.participants,e.efficiency,e.comment or ""))
+            conn.execute("INSERT INTO morning_events (branch_name,branch_id,submitted_at,date,week,event_type,participants,efficiency,comment) VALUES (?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,e.date,e.week,e.event_type,e.participants,e.efficiency,e.comment or ""))
     return {"success": True, "message": f"Добавлено {len(events)} мероприятий"}
 
 @app.get("/morning-events/{branch_name}")
@@ -466,10 +807,12 @@ def get_morning_events(branch_name: str):
 def submit_field_visits(branch_name: str, visits: List[FieldVisit]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for v in visits:
             avg = round((v.haircut_quality+v.service_quality+v.additional_services_rating+v.cosmetics_rating+v.standards_rating)/5, 1)
-            conn.execute("INSERT INTO field_visits (branch_name,submitted_at,date,master_name,haircut_quality,service_quality,additional_services_comment,additional_services_rating,cosmetics_comment,cosmetics_rating,standards_comment,standards_rating,errors_comment,next_check_date,average_rating) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (branch_name,ts,v.date,v.master_name,v.haircut_quality,v.service_quality,v.additional_services_comment,v.additional_services_rating,v.cosmetics_comment,v.cosmetics_rating,v.standards_comment,v.standards_rating,v.errors_comment,v.next_check_date or "",avg))
+            conn.execute("INSERT INTO field_visits (branch_name,branch_id,submitted_at,date,master_name,master_id,haircut_quality,service_quality,additional_services_comment,additional_services_rating,cosmetics_comment,cosmetics_rating,standards_comment,standards_rating,errors_comment,next_check_date,average_rating) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,v.date,v.master_name,dim_id(conn,"masters",bid,v.master_name),v.haircut_quality,v.service_quality,v.additional_services_comment,v.additional_services_rating,v.cosmetics_comment,v.cosmetics_rating,v.standards_comment,v.standards_rating,v.errors_comment,v.next_check_date or "",avg))
+        refresh_master_rollup(conn, branch_name, [v.master_name for v in visits])
     return {"success": True, "message": f"Добавлено {len(visits)} посещений"}
 
 @app.get("/field-visits/{branch_name}")
@@ -481,9 +824,11 @@ def get_field_visits(branch_name: str):
 def submit_one_on_one(branch_name: str, meetings: List[OneOnOneMeeting]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for m in meetings:
-            conn.execute("INSERT INTO one_on_one (branch_name,submitted_at,date,master_name,goal,results,development_plan,indicator,next_meeting_date) VALUES (?,?,?,?,?,?,?,?,?)",
-                (branch_name,ts,m.date,m.master_name,m.goal,m.results,m.development_plan,m.indicator,m.next_meeting_date or ""))
+            conn.execute("INSERT INTO one_on_one (branch_name,branch_id,submitted_at,date,master_name,master_id,goal,results,development_plan,indicator,next_meeting_date) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,m.date,m.master_name,dim_id(conn,"masters",bid,m.master_name),m.goal,m.results,m.development_plan,m.indicator,m.next_meeting_date or ""))
+        refresh_master_rollup(conn, branch_name, [m.master_name for m in meetings])
     return {"success": True, "message": f"Добавлено {len(meetings)} встреч"}
 
 @app.get("/one-on-one/{branch_name}")
@@ -495,9 +840,10 @@ def get_one_on_one(branch_name: str):
 def submit_weekly_metrics(branch_name: str, metrics: List[WeeklyMetrics]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for m in metrics:
-            conn.execute("INSERT INTO weekly_metrics (branch_name,submitted_at,period,average_check_plan,average_check_fact,cosmetics_plan,cosmetics_fact,additional_services_plan,additional_services_fact) VALUES (?,?,?,?,?,?,?,?,?)",
-                (branch_name,ts,m.period,m.average_check_plan,m.average_check_fact,m.cosmetics_plan,m.cosmetics_fact,m.additional_services_plan,m.additional_services_fact))
+            conn.execute("INSERT INTO weekly_metrics (branch_name,branch_id,submitted_at,period,average_check_plan,average_check_fact,cosmetics_plan,cosmetics_fact,additional_services_plan,additional_services_fact) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,m.period,m.average_check_plan,m.average_check_fact,m.cosmetics_plan,m.cosmetics_fact,m.additional_services_plan,m.additional_services_fact))
     return {"success": True, "message": f"Добавлено {len(metrics)} показателей"}
 
 @app.get("/weekly-metrics/{branch_name}")
@@ -509,9 +855,10 @@ def get_weekly_metrics(branch_name: str):
 def submit_newbie_adaptation(branch_name: str, newbies: List[NewbieAdaptation]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for n in newbies:
-            conn.execute("INSERT INTO newbie_adaptation (branch_name,submitted_at,start_date,name,haircut_practice,service_standards,hygiene_sanitation,additional_services,cosmetics_sales,iclient_basics,status) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                (branch_name,ts,n.start_date,n.name,n.haircut_practice,n.service_standards,n.hygiene_sanitation,n.additional_services,n.cosmetics_sales,n.iclient_basics,n.status))
+            conn.execute("INSERT INTO newbie_adaptation (branch_name,branch_id,submitted_at,start_date,name,haircut_practice,service_standards,hygiene_sanitation,additional_services,cosmetics_sales,iclient_basics,status) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,n.start_date,n.name,n.haircut_practice,n.service_standards,n.hygiene_sanitation,n.additional_services,n.cosmetics_sales,n.iclient_basics,n.status))
     return {"success": True, "message": f"Добавлено {len(newbies)} записей"}
 
 @app.get("/newbie-adaptation/{branch_name}")
@@ -523,9 +870,11 @@ def get_newbie_adaptation(branch_name: str):
 def submit_master_plans(branch_name: str, plans: List[MasterPlan]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for p in plans:
-            conn.execute("INSERT INTO master_plans (branch_name,submitted_at,month,master_name,average_check_plan,average_check_fact,additional_services_plan,additional_services_fact,sales_plan,sales_fact,salary_plan,salary_fact) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
-                (branch_name,ts,p.month,p.master_name,p.average_check_plan,p.average_check_fact,p.additional_services_plan,p.additional_services_fact,p.sales_plan,p.sales_fact,p.salary_plan,p.salary_fact))
+            conn.execute("INSERT INTO master_plans (branch_name,branch_id,submitted_at,month,master_name,master_id,average_check_plan,average_check_fact,additional_services_plan,additional_services_fact,sales_plan,sales_fact,salary_plan,salary_fact) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,p.month,p.master_name,dim_id(conn,"masters",bid,p.master_name),p.average_check_plan,p.average_check_fact,p.additional_services_plan,p.additional_services_fact,p.sales_plan,p.sales_fact,p.salary_plan,p.salary_fact))
+        refresh_master_rollup(conn, branch_name, [p.master_name for p in plans])
     return {"success": True, "message": f"Добавлено {len(plans)} планов"}
 
 @app.get("/master-plans/{branch_name}")
@@ -537,9 +886,10 @@ def get_master_plans(branch_name: str):
 def submit_reviews(branch_name: str, reviews_list: List[Reviews]):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with get_db() as conn:
+        bid = require_branch_id(conn, branch_name)
         for r in reviews_list:
-            conn.execute("INSERT INTO reviews (branch_name,submitted_at,week,manager_name,plan,fact,monthly_target) VALUES (?,?,?,?,?,?,?)",
-                (branch_name,ts,r.week,r.manager_name,r.plan,r.fact,r.monthly_target))
+            conn.execute("INSERT INTO reviews (branch_name,branch_id,submitted_at,week,manager_name,manager_id,plan,fact,monthly_target) VALUES (?,?,?,?,?,?,?,?,?)",
+                (branch_name,bid,ts,r.week,r.manager_name,dim_id(conn,"managers",bid,r.manager_name),r.plan,r.fact,r.monthly_target))
     return {"success": True, "message": f"Добавлено {len(reviews_list)} отзывов"}
 
 @app.get("/reviews/{branch_name}")
@@ -547,67 +897,316 @@ def get_reviews(branch_name: str):
     return get_section_data(branch_name, "reviews")
 
 # --- Branch Summary ---
+# Показатель сводки → таблица, агрегат и цель из BRANCH_GOALS
+SUMMARY_METRICS = [
+    ("Утренние мероприятия", "morning_events", "COUNT(*)", "morning_events"),
+    ("Полевые выходы", "field_visits", "COUNT(*)", "field_visits"),
+    ("One-on-One", "one_on_one", "COUNT(*)", "one_on_one"),
+    ("Планы мастеров", "master_plans", "COUNT(*)", "master_plans"),
+    ("Еженедельные отчёты", "weekly_metrics", "COUNT(*)", "weekly_reports"),
+    ("Отзывы", "reviews", "COALESCE(SUM(fact),0)", "reviews"),
+    ("Новые сотрудники", "newbie_adaptation", "COUNT(*)", "new_employees"),
+]
+
+def summary_counts(conn, start, end, branch_name=None):
+    """{(филиал, 'YYYY-MM'): {показатель: значение}} — по одному GROUP BY на таблицу за весь диапазон"""
+    lo, hi = period_bounds(start, end)
+    where, params = "submitted_at >= ? AND submitted_at < ?", [lo, hi]
+    bcol = network_branch_key()[0]
+    if branch_name:
+        col, key = branch_key(conn, branch_name)
+        where += f" AND {col}=?"; params.append(key)
+    counts = {}
+    for name, table, agg, _ in SUMMARY_METRICS:
+        for r in conn.execute(f"SELECT {bcol} AS branch, substr(submitted_at,1,7) AS ym, {agg} AS v FROM {section_source(conn, table, start, end)} WHERE {where} GROUP BY {bcol}, ym", params):
+            counts.setdefault((r['branch'], r['ym']), {})[name] = r['v']
+    keys = list({b for b, _ in counts})
+    names = dict(zip(keys, branch_names(conn, keys)))
+    return {(names[b], ym): v for (b, ym), v in counts.items()}
+
+def summary_rows(conn, branch_name, manager, month, values, ts):
+    keys = row_keys(conn, "branch_summaries", branch_name, {"manager": manager})
+    for name, _, _, goal_key in SUMMARY_METRICS:
+        cur, goal = values.get(name, 0), BRANCH_GOALS[goal_key]
+        yield (branch_name, keys["branch_id"], ts, manager, keys["manager_id"], month, name, cur, goal, round((cur/goal)*100,1) if goal>0 else 0)
+
+def delete_summaries(conn, where, params, since=None):
+    """Удаляет сводки по условию и из горячей таблицы, и из архивов: в архив они уходят по дате сборки, а не по месяцу.
+    Сводка собирается не раньше своего месяца, поэтому архивы до года since не смотрятся"""
+    for s in ["main"] + [a for a in attached_archives(conn, since) if table_columns(conn, "branch_summaries", a)]:
+        conn.execute(f"DELETE FROM {s}.branch_summaries WHERE {where}", params)
+
+def rebuild_branch_summaries(conn, start, end, branch_name=None):
+    """Пересобирает branch_summaries всех живых филиалов (или одного branch_name) за каждый месяц диапазона"""
+    months = []
+    cur = start.replace(day=1)
+    while cur <= end:
+        months.append(cur); cur = (cur + timedelta(days=32)).replace(day=1)
+    month_end = (months[-1] + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+    only, params = (" AND name=?", [branch_name]) if branch_name else ("", [])
+    branches = conn.execute(f"SELECT name, manager_name FROM branches WHERE deleted_at IS NULL{only} ORDER BY name", params).fetchall()
+    counts = summary_counts(conn, months[0], month_end, branch_name)
+    labels = [get_month_ru(m) for m in months]
+    delete_summaries(conn, f"month IN ({','.join('?'*len(labels))}) AND branch_name IN (SELECT name FROM branches WHERE deleted_at IS NULL{only})", labels + params, months[0])
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [row for b in branches for m, label in zip(months, labels)
+            for row in summary_rows(conn, b['name'], b['manager_name'], label, counts.get((b['name'], m.strftime("%Y-%m")), {}), ts)]
+    conn.executemany("INSERT INTO branch_summaries (branch_name,branch_id,submitted_at,manager,manager_id,month,metric,current_value,goal_value,percentage) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+    return {"branches": len(branches), "months": labels, "rows": len(rows)}
+
 @app.post("/branch-summary/{branch_name}")
 def generate_branch_summary(branch_name: str, summary: BranchSummary):
     with get_db() as conn:
-        conn.execute("DELETE FROM branch_summaries WHERE branch_name=? AND month=?", (branch_name, summary.month))
-        me = count_for_month(conn.execute("SELECT submitted_at FROM morning_events WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        fv = count_for_month(conn.execute("SELECT submitted_at FROM field_visits WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        oo = count_for_month(conn.execute("SELECT submitted_at FROM one_on_one WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        mp = count_for_month(conn.execute("SELECT submitted_at FROM master_plans WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        wm = count_for_month(conn.execute("SELECT submitted_at FROM weekly_metrics WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        rv = sum_reviews_month(conn.execute("SELECT submitted_at, fact FROM reviews WHERE branch_name=?", (branch_name,)).fetchall(), summary.month)
-        na = count_for_month(conn.execute("SELECT submitted_at FROM newbie_adaptation WHERE branch_name=?", (branch_name,)).fetchall(), 'submitted_at', summary.month)
-        
-        metrics = {"Утренние мероприятия":(me,BRANCH_GOALS["morning_events"]),"Полевые выходы":(fv,BRANCH_GOALS["field_visits"]),"One-on-One":(oo,BRANCH_GOALS["one_on_one"]),"Планы мастеров":(mp,BRANCH_GOALS["master_plans"]),"Еженедельные отчёты":(wm,BRANCH_GOALS["weekly_reports"]),"Отзывы":(rv,BRANCH_GOALS["reviews"]),"Новые сотрудники":(na,BRANCH_GOALS["new_employees"])}
+        col, key = branch_key(conn, branch_name)
+        ms, me = month_label_range(summary.month)
+        delete_summaries(conn, f"{col}=? AND month=?", (key, summary.month), ms)
+        values = summary_counts(conn, ms, me, branch_name).get((branch_name, ms.strftime("%Y-%m")), {}) if ms else {}
         ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for name,(cur,goal) in metrics.items():
-            pct = round((cur/goal)*100,1) if goal>0 else 0
-            conn.execute("INSERT INTO branch_summaries (branch_name,submitted_at,manager,month,metric,current_value,goal_value,percentage) VALUES (?,?,?,?,?,?,?,?)",
-                (branch_name,ts,summary.manager,summary.month,name,cur,goal,pct))
+        conn.executemany("INSERT INTO branch_summaries (branch_name,branch_id,submitted_at,manager,manager_id,month,metric,current_value,goal_value,percentage) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            list(summary_rows(conn, branch_name, summary.manager, summary.month, values, ts)))
     return {"success": True, "message": "Отчёт создан"}
 
+@app.post("/admin/branch-summaries/rebuild")
+def admin_rebuild_branch_summaries(date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to")):
+    """Сводки всех филиалов за месяцы from..to (YYYY-MM, по умолчанию текущий месяц) одной транзакцией (с шардами — транзакция на филиал)"""
+    try:
+        end = datetime.strptime(date_to[:7], "%Y-%m") if date_to else datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        start = datetime.strptime(date_from[:7], "%Y-%m") if date_from else end
+    except ValueError: raise HTTPException(400, "Месяцы from/to должны быть в формате YYYY-MM")
+    if start > end: raise HTTPException(400, "from позже to")
+    if SHARD_DIR:
+        parts = each_branch(lambda conn, bn: rebuild_branch_summaries(conn, start, end, bn), live_branch_names())
+        return {"success": True, "branches": sum(p["branches"] for p in parts), "months": parts[0]["months"] if parts else [], "rows": sum(p["rows"] for p in parts)}
+    with get_db() as conn:
+        result = rebuild_branch_summaries(conn, start, end)
+    return {"success": True, **result}
+
 @app.get("/branch-summary/{branch_name}")
 def get_branch_summary(branch_name: str):
     return get_section_data(branch_name, "branch-summary")
 
 # ============= ADMIN: DASHBOARDS =============
+def branch_dashboard(conn, bn, manager, start, end, label):
+    """Показатели филиала за период — одна строка /admin/all-dashboards"""
+    lo, hi = period_bounds(start, end)
+    col, key = branch_key(conn, bn)
+    def cnt(table):
+        return conn.execute(f"SELECT COUNT(*) FROM {section_source(conn, table, start, end)} WHERE {col}=? AND submitted_at >= ? AND submitted_at < ?", (key, lo, hi)).fetchone()[0]
+    def rv_sum():
+        return conn.execute(f"SELECT COALESCE(SUM(fact),0) FROM {section_source(conn, 'reviews', start, end)} WHERE {col}=? AND submitted_at >= ? AND submitted_at < ?", (key, lo, hi)).fetchone()[0]
+    return {
+        "branch_name": bn, "manager": manager, "period_label": label,
+        "morning_events": {"current": cnt("morning_events"), "goal": BRANCH_GOALS["morning_events"]},
+        "field_visits": {"current": cnt("field_visits"), "goal": BRANCH_GOALS["field_visits"]},
+        "one_on_one": {"current": cnt("one_on_one"), "goal": BRANCH_GOALS["one_on_one"]},
+        "master_plans": {"current": cnt("master_plans"), "goal": BRANCH_GOALS["master_plans"]},
+        "weekly_reports": {"current": cnt("weekly_metrics"), "goal": BRANCH_GOALS["weekly_reports"]},
+        "reviews": {"current": rv_sum(), "goal": BRANCH_GOALS["reviews"]},
+        "new_employees": {"current": cnt("newbie_adaptation"), "goal": BRANCH_GOALS["new_employees"]},
+    }
+
 @app.get("/admin/all-dashboards")
+@single_flight
 def admin_all_dashboards(period: str = Query("month")):
     start, end, label = get_period_dates(period)
-    result = []
     with get_db() as conn:
-        branches = conn.execute("SELECT name, manager_name FROM branches ORDER BY name").fetchall()
-        for b in branches:
-            bn = b['name']
-            def cnt(table):
-                rows = conn.execute(f"SELECT submitted_at FROM {table} WHERE branch_name=?", (bn,)).fetchall()
-                return len([r for r in rows if parse_date_flexible(str(r['submitted_at'])) and start.date() <= parse_date_flexible(str(r['submitted_at'])).date() <= end.date()])
-            def rv_sum():
-                rows = conn.execute("SELECT submitted_at, fact FROM reviews WHERE branch_name=?", (bn,)).fetchall()
-                return sum(int(r['fact'] or 0) for r in rows if parse_date_flexible(str(r['submitted_at'])) and start.date() <= parse_date_flexible(str(r['submitted_at'])).date() <= end.date())
-            
-            result.append({
-                "branch_name": bn, "manager": b['manager_name'], "period_label": label,
-                "morning_events": {"current": cnt("morning_events"), "goal": BRANCH_GOALS["morning_events"]},
-                "field_visits": {"current": cnt("field_visits"), "goal": BRANCH_GOALS["field_visits"]},
-                "one_on_one": {"current": cnt("one_on_one"), "goal": BRANCH_GOALS["one_on_one"]},
-                "master_plans": {"current": cnt("master_plans"), "goal": BRANCH_GOALS["master_plans"]},
-                "weekly_reports": {"current": cnt("weekly_metrics"), "goal": BRANCH_GOALS["weekly_reports"]},
-                "reviews": {"current": rv_sum(), "goal": BRANCH_GOALS["reviews"]},
-                "new_employees": {"current": cnt("newbie_adaptation"), "goal": BRANCH_GOALS["new_employees"]},
-            })
+        managers = {r['name']: r['manager_name'] for r in conn.execute("SELECT name, manager_name FROM branches WHERE deleted_at IS NULL ORDER BY name").fetchall()}
+    result = each_branch(lambda conn, bn: branch_dashboard(conn, bn, managers[bn], start, end, label), list(managers))
     return {"success": True, "data": result, "period_label": label}
 
+# ============= ADMIN: SSE-ПОТОК =============
+# Подписчики /admin/stream: (очередь, период). Один фоновый опросчик на процесс следит за лентой
+# changes и рассылает пересчитанные строки только изменившихся филиалов.
+STREAM_SUBSCRIBERS = set()
+_stream_task = None
+
+def latest_change_seq():
+    """Последний seq ленты; с шардами — {филиал: seq} и "" для ленты каталога"""
+    q = "SELECT seq FROM main.sqlite_sequence WHERE name='changes'"
+    with get_db() as conn: catalog = (conn.execute(q).fetchone() or [0])[0]
+    if not SHARD_DIR: return catalog
+    names = live_branch_names()
+    return {"": catalog, **dict(zip(names, each_branch(lambda conn, _: (conn.execute(q).fetchone() or [0])[0], names)))}
+
+def stream_deltas(last, seq, periods):
+    """{период: дельта} по филиалам, изменившимся в (last, seq]"""
+    with get_db() as conn:
+        if SHARD_DIR:
+            # шард со сдвинувшимся seq, пропавший шард и филиалы из ленты каталога (правка или удаление филиала)
+            names = {n for n in seq.keys() | last.keys() if n and seq.get(n) != last.get(n)}
+            names |= {r[0] for r in conn.execute("SELECT DISTINCT branch_name FROM changes WHERE seq > ? AND seq <= ?", (last.get("", 0), seq[""])).fetchall()}
+            names = list(names)
+        else:
+            names = [r[0] for r in conn.execute("SELECT DISTINCT branch_name FROM changes WHERE seq > ? AND seq <= ?", (last, seq)).fetchall()]
+        live = {r['name']: r['manager_name'] for r in conn.execute(
+            f"SELECT name, manager_name FROM branches WHERE deleted_at IS NULL AND name IN ({','.join('?'*len(names))})", names).fetchall()}
+    dates = {p: get_period_dates(p) for p in periods}
+    rows = dict(zip(sorted(live), each_branch(lambda conn, n: {p: branch_dashboard(conn, n, live[n], *dates[p]) for p in periods}, sorted(live))))
+    return {p: {"seq": seq, "period_label": dates[p][2], "removed": sorted(n for n in names if n not in live),
+                "branches": [rows[n][p] for n in sorted(live)]} for p in periods}
+
+def stream_publish(sub, event, data):
+    q = sub[0]
+    if q.full():  # клиент не успевает — сбрасываем очередь, он перечитает дашборд целиком
+        while not q.empty(): q.get_nowait()
+        event, data = "reset", {}
+    q.put_nowait({"event": event, "data": data})
+
+async def stream_broadcaster():
+    global _stream_task
+    try:
+        last = await run_db(latest_change_seq)
+        while STREAM_SUBSCRIBERS:
+            await asyncio.sleep(STREAM_POLL_SECONDS)
+            seq = await run_db(latest_change_seq)
+            if seq == last: continue
+            subs = list(STREAM_SUBSCRIBERS)
+            deltas = await run_db(stream_deltas, last, seq, {p for _, p in subs})
+            last = seq
+            for sub in subs:
+                if deltas[sub[1]]["branches"] or deltas[sub[1]]["removed"]: stream_publish(sub, "delta", deltas[sub[1]])
+    except Exception as e:
+        logger.error(f"❌ SSE-рассылка: {e}")
+        for sub in list(STREAM_SUBSCRIBERS): stream_publish(sub, "reset", {})
+    finally: _stream_task = None
+
+@app.get("/admin/stream")
+async def admin_stream(request: Request, period: str = Query("month")):
+    """SSE: событие delta с пересчитанными строками дашборда после каждой записи, ping раз в STREAM_HEARTBEAT_SECONDS"""
+    global _stream_task
+    sub = (asyncio.Queue(maxsize=100), period)
+    STREAM_SUBSCRIBERS.add(sub)
+    if _stream_task is None: _stream_task = asyncio.create_task(stream_broadcaster())
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try: msg = await asyncio.wait_for(sub[0].get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"; continue
+                yield f"event: {msg['event']}\ndata: {json.dumps(msg['data'], ensure_ascii=False)}\n\n"
+        finally: STREAM_SUBSCRIBERS.discard(sub)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/admin/branch-data/{branch_name}/{section}")
 def admin_get_branch_data(branch_name: str, section: str, period: str = Query("all")):
-    data = get_section_data(branch_name, section)
-    if period != "all":
-        start, end, label = get_period_dates(period)
-        data["data"] = filter_by_period(data["data"], start, end)
-        data["period_label"] = label
+    if period == "all": return get_section_data(branch_name, section)
+    start, end, label = get_period_dates(period)
+    data = get_section_data(branch_name, section, start, end)
+    data["period_label"] = label
     return data
 
+# ============= ВЫГРУЗКА NDJSON/CSV =============
+app.include_router(export_router)
+
+# ============= ИМПОРТ ИЗ XLSX/CSV =============
+IMPORT_MODELS = {"morning-events": MorningEvent, "field-visits": FieldVisit, "one-on-one": OneOnOneMeeting, "weekly-metrics": WeeklyMetrics,
+                 "master-plans": MasterPlan, "reviews": Reviews, "newbie-adaptation": NewbieAdaptation}
+
+def import_headers(section):
+    """Русский заголовок из SECTION_CONFIG (и имя колонки) → колонка таблицы"""
+    headers = {col: col for col in IMPORT_MODELS[section].model_fields}
+    for col, label in re.findall(r"(\w+) as '([^']+)'", SECTION_CONFIG[section]['select']):
+        headers[label] = col
+    headers.update({"submitted_at": "submitted_at", "Филиал": "branch_name", "branch_name": "branch_name"})
+    return headers
+
+def read_import_rows(upload):
+    """Строки файла по одной: XLSX — openpyxl read_only, CSV — csv с автоопределением разделителя"""
+    name = (upload.filename or "").lower()
+    if name.endswith((".xlsx", ".xlsm")):
+        wb = load_workbook(upload.file, read_only=True, data_only=True)
+        try:
+            for row in wb.worksheets[0].iter_rows(values_only=True): yield row
+        finally: wb.close()
+    elif name.endswith(".csv"):
+        text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+        sample = text.read(4096); text.seek(0)
+        try: dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        except csv.Error: dialect = csv.excel
+        yield from csv.reader(text, dialect)
+    else: raise HTTPException(400, "Поддерживаются файлы .xlsx и .csv")
+
+def import_value(value, field):
+    if isinstance(value, datetime): return value.strftime("%Y-%m-%d %H:%M:%S" if field == "submitted_at" else "%Y-%m-%d")
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    if isinstance(value, str): value = value.strip()
+    return value
+
+def import_record(model, raw, default_branch, default_ts):
+    """Сырая строка → (branch_name, submitted_at, проверенная модель); ошибка — ValueError"""
+    fields = {k: import_value(v, k) for k, v in raw.items() if v is not None and v != ""}
+    branch = fields.pop("branch_name", None) or default_branch
+    if not branch: raise ValueError("не указан филиал")
+    ts = fields.pop("submitted_at", None)
+    if ts:
+        try: dt = datetime.strptime(str(ts), "%Y-%m-%d %H:%M:%S")
+        except ValueError: dt = parse_date_flexible(ts)
+        if not dt: raise ValueError(f"некорректная дата отправки: {ts}")
+        ts = dt.strftime("%Y-%m-%d %H:%M:%S")
+    for k, f in model.model_fields.items():
+        if k in fields and f.annotation in (str, Optional[str]) and not isinstance(fields[k], str): fields[k] = str(fields[k])
+    return str(branch), ts or default_ts, model.model_validate(fields)
+
+def insert_import_batch(section, batch, masters):
+    """Одна транзакция на пачку (с шардами — на часть пачки в каждом шарде); мастеров копит в masters для пересчёта master_rollup в конце"""
+    table = SECTION_CONFIG[section]['table']
+    rows = []
+    for branch, ts, m in batch:
+        d = m.model_dump()
+        if section == "field-visits":
+            d["average_rating"] = round((m.haircut_quality+m.service_quality+m.additional_services_rating+m.cosmetics_rating+m.standards_rating)/5, 1)
+        rows.append({"branch_name": branch, "submitted_at": ts, **{k: ("" if v is None else v) for k, v in d.items()}})
+    parts = {}
+    for r in rows: parts.setdefault(r["branch_name"] if SHARD_DIR else None, []).append(r)
+    for shard, part in parts.items():
+        with use_shard(shard), get_db() as conn:
+            for r in part: r.update(row_keys(conn, table, r["branch_name"], r))
+            cols = list(part[0])
+            conn.executemany(f"INSERT INTO {table} ({','.join(cols)}) VALUES ({','.join('?'*len(cols))})", [tuple(r[c] for c in cols) for r in part])
+    if table in MASTER_TABLES:
+        for r in rows: masters.setdefault(r["branch_name"], set()).add(r["master_name"])
+
+@app.post("/import/{section}")
+def import_section(section: str, file: UploadFile = File(...), branch: Optional[str] = Query(None)):
+    """Потоковый импорт истории из XLSX/CSV: проверка моделями пачками по IMPORT_BATCH_SIZE, вставка — транзакцией на пачку"""
+    model = IMPORT_MODELS.get(section)
+    if not model: raise HTTPException(400, f"Импорт недоступен для секции: {section}. Доступны: {', '.join(IMPORT_MODELS)}")
+    with get_db() as conn:
+        live = {r['name'] for r in conn.execute("SELECT name FROM branches WHERE deleted_at IS NULL")}
+    if branch and branch not in live: raise HTTPException(404, f"Филиал '{branch}' не найден")
+    rows = read_import_rows(file)
+    header = next(rows, None)
+    if not header: raise HTTPException(400, "Файл пуст")
+    known = import_headers(section)
+    columns = [known.get(str(h).strip()) if h is not None else None for h in header]
+    required = [k for k, f in model.model_fields.items() if f.is_required()]
+    missing = [k for k in required if k not in columns]
+    if missing: raise HTTPException(400, f"В файле нет колонок: {', '.join(missing)}")
+    if not branch and "branch_name" not in columns: raise HTTPException(400, "Укажите ?branch= или колонку «Филиал»")
+
+    default_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    imported, rejected, errors, batch, masters = 0, 0, [], [], {}
+    for line, values in enumerate(rows, start=2):
+        if all(v is None or str(v).strip() == "" for v in values): continue
+        raw = {col: v for col, v in zip(columns, values) if col}
+        try:
+            rec = import_record(model, raw, branch, default_ts)
+            if rec[0] not in live: raise ValueError(f"филиал '{rec[0]}' не найден")
+            batch.append(rec)
+        except ValueError as e:
+            rejected += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                msg = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()) if hasattr(e, "errors") else str(e)
+                errors.append({"row": line, "error": msg})
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            insert_import_batch(section, batch, masters); imported += len(batch); batch = []
+    if batch: insert_import_batch(section, batch, masters); imported += len(batch)
+    for bn, names in masters.items():
+        with use_shard(bn), get_db() as conn: refresh_master_rollup(conn, bn, list(names))
+    logger.info(f"📥 Импорт {section} ({file.filename}): {imported} строк, отклонено {rejected}")
+    return {"success": True, "imported": imported, "rejected": rejected, "errors": errors, "errors_truncated": rejected > len(errors)}
+
 # ============= EMAIL =============
 def build_multi_sheet_xlsx(sheets_data):
     wb = Workbook(); wb.remove(wb.active)
@@ -641,7 +1240,7 @@ def send_email_with_attachments(to_email, subject, body_html, attachments):
     msg.attach(MIMEText(body_html, 'html', 'utf-8'))
     for att in attachments:
         if att["content"]:
-            part = MIMEBase('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            part = MIMEBase('application', 'zip') if att["filename"].endswith(".zip") else MIMEBase('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet')
             part.set_payload(att["content"]); encoders.encode_base64(part)
             part.add_header('Content-Disposition', f'attachment; filename="{att["filename"]}"'); msg.attach(part)
     try:
@@ -651,24 +1250,185 @@ def send_email_with_attachments(to_email, subject, body_html, attachments):
             with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s: s.starttls(); s.login(SMTP_USER, SMTP_PASSWORD); s.send_message(msg)
     except Exception as e: raise HTTPException(500, f"Ошибка отправки: {e}")
 
-@app.post("/send-report/{branch_name}")
-def send_report_email(branch_name: str, request: EmailReportRequest):
-    start, end, label = get_period_dates(request.period_type, request.custom_date)
-    sections_map = {"Утренние мероприятия":"morning-events","Полевые выходы":"field-visits","One-on-One":"one-on-one","Планы мастеров":"master-plans","Еженедельные показатели":"weekly-metrics","Отзывы":"reviews","Адаптация новичков":"newbie-adaptation","Итоговые отчеты":"branch-summary"}
+REPORT_SECTIONS = {"Утренние мероприятия":"morning-events","Полевые выходы":"field-visits","One-on-One":"one-on-one","Планы мастеров":"master-plans","Еженедельные показатели":"weekly-metrics","Отзывы":"reviews","Адаптация новичков":"newbie-adaptation","Итоговые отчеты":"branch-summary"}
+
+def collect_report_sheets(conn, branch_name, period_type, start, end):
     sheets_data = {}; total = 0
-    for name, section in sections_map.items():
-        recs = get_section_data(branch_name, section).get("data", [])
-        if request.period_type != "all": recs = filter_by_period(recs, start, end)
+    for name, section in REPORT_SECTIONS.items():
+        recs = read_section(conn, branch_name, section, *((start, end) if period_type != "all" else ()))
         if recs: sheets_data[name] = recs; total += len(recs)
-    if total == 0: return {"success": False, "message": f"Нет данных за: {label}"}
-    xlsx = build_multi_sheet_xlsx(sheets_data)
-    fn = f"Отчёт_{branch_name.replace(' ','_')}_{label.replace(' ','_').replace('.','_')}.xlsx"
-    html = f"<html><body><h2>Отчёт: {branch_name}</h2><p>Период: {label}</p><p>{len(sheets_data)} вкладок, {total} записей</p></body></html>"
-    send_email_with_attachments(REPORT_EMAIL_TO, f"Отчёт {branch_name} — {label}", html, [{"filename":fn,"content":xlsx}])
-    return {"success": True, "message": f"Отправлен на {REPORT_EMAIL_TO}", "period": label, "sheets_count": len(sheets_data), "total_records": total}
+    return sheets_data, total
+
+@app.post("/send-report/all")
+@single_flight
+@limit_concurrency("network-report")
+async def send_report_all(request: NetworkReportRequest):
+    """Отчёт по всем филиалам: данные и книги собираются в пуле процессов, уходит одним письмом"""
+    if request.mode not in ("consolidated", "per_branch"): raise HTTPException(400, "mode должен быть consolidated или per_branch")
+    start, end, label = get_period_dates(request.period_type, request.custom_date)
+    branches = await run_db(live_branch_names)
+    loop, pool = asyncio.get_running_loop(), get_report_pool()
+    if request.mode == "per_branch":
+        parts = await asyncio.gather(*[loop.run_in_executor(pool, build_branch_report, bn, request.period_type, request.custom_date) for bn in branches])
+        parts = [p for p in parts if p["total"]]
+        total = sum(p["total"] for p in parts)
+        if total == 0: return {"success": False, "message": f"Нет данных за: {label}"}
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for p in parts: zf.writestr(report_filename(f"Отчёт_{p['branch_name']}", label), p["xlsx"])
+        attachment = {"filename": report_filename("Отчёты_сеть", label, "zip"), "content": buf.getvalue()}
+        sheets_count = sum(p["sheets"] for p in parts)
+    else:
+        parts = await asyncio.gather(*[loop.run_in_executor(pool, collect_branch_sheets, bn, request.period_type, request.custom_date) for bn in branches])
+        merged = {}
+        for sheets in parts:
+            for name, recs in sheets.items(): merged.setdefault(name, []).extend(recs)
+        total = sum(len(r) for r in merged.values())
+        if total == 0: return {"success": False, "message": f"Нет данных за: {label}"}
+        attachment = {"filename": report_filename("Отчёт_сеть", label), "content": await loop.run_in_executor(pool, build_multi_sheet_xlsx, merged)}
+        sheets_count = len(merged)
+    html = f"<html><body><h2>Отчёт по сети: {len(branches)} филиалов</h2><p>Период: {label}</p><p>{sheets_count} вкладок, {total} записей</p></body></html>"
+    await run_in_threadpool(send_email_with_attachments, REPORT_EMAIL_TO, f"Отчёт по сети — {label}", html, [attachment])
+    return {"success": True, "message": f"Отправлен на {REPORT_EMAIL_TO}", "period": label, "mode": request.mode,
+            "branches_count": len(branches), "sheets_count": sheets_count, "total_records": total}
+
+@app.post("/send-report/{branch_name}")
+@single_flight
+@limit_concurrency("report")
+async def send_report_email(branch_name: str, request: EmailReportRequest):
+    r = await asyncio.get_running_loop().run_in_executor(get_report_pool(), build_branch_report, branch_name, request.period_type, request.custom_date)
+    label = r["label"]
+    if r["total"] == 0: return {"success": False, "message": f"Нет данных за: {label}"}
+    fn = report_filename(f"Отчёт_{branch_name}", label)
+    html = f"<html><body><h2>Отчёт: {branch_name}</h2><p>Период: {label}</p><p>{r['sheets']} вкладок, {r['total']} записей</p></body></html>"
+    await run_in_threadpool(send_email_with_attachments, REPORT_EMAIL_TO, f"Отчёт {branch_name} — {label}", html, [{"filename":fn,"content":r["xlsx"]}])
+    return {"success": True, "message": f"Отправлен на {REPORT_EMAIL_TO}", "period": label, "sheets_count": r["sheets"], "total_records": r["total"]}
+
+@app.get("/report/{branch_name}")
+@single_flight
+@limit_concurrency("report")
+async def download_report(branch_name: str, period_type: str = Query("month"), custom_date: Optional[str] = Query(None)):
+    """Скачать XLSX-отчёт филиала за период; книга собирается в пуле процессов"""
+    r = await asyncio.get_running_loop().run_in_executor(get_report_pool(), build_branch_report, branch_name, period_type, custom_date)
+    label = r["label"]
+    if r["total"] == 0: raise HTTPException(404, f"Нет данных за: {label}")
+    return Response(r["xlsx"], media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(report_filename(f'Отчёт_{branch_name}', label))}"})
+
+# ============= ОТЧЁТЫ: КЭШ =============
+# Готовые книги лежат в REPORT_CACHE_DIR под ключом (филиал, границы периода, версии таблиц).
+# Любая запись в таблицу филиала меняет версию, так что устаревший файл просто перестаёт находиться.
+def report_cache_key(conn, branch_name, period_type, start, end):
+    versions = {r['table_name']: r['version'] for r in conn.execute("SELECT table_name, version FROM data_versions WHERE branch_name=?", (branch_name,)).fetchall()}
+    bounds = None if period_type == "all" else period_bounds(start, end)
+    return hashlib.sha256(json.dumps([branch_name, bounds, sorted(versions.items())], ensure_ascii=False).encode()).hexdigest()
+
+def report_cache_get(key):
+    path = os.path.join(REPORT_CACHE_DIR, key)
+    try:
+        with open(path + ".json") as f: meta = json.load(f)
+        with open(path + ".xlsx", "rb") as f: xlsx = f.read()
+        os.utime(path + ".xlsx")  # LRU: время последнего использования
+    except (OSError, ValueError): return None  # в том числе файл, вытесненный другим процессом между чтением и utime
+    return xlsx, meta["sheets"], meta["total"]
+
+def report_cache_put(key, xlsx, sheets, total):
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(REPORT_CACHE_DIR, key)
+    for ext, data, mode in [(".xlsx", xlsx, "wb"), (".json", json.dumps({"sheets": sheets, "total": total}), "w")]:
+        tmp = f"{path}{ext}.{os.getpid()}.tmp"
+        with open(tmp, mode) as f: f.write(data)
+        os.replace(tmp, path + ext)
+    evict_report_cache()
+
+def evict_report_cache():
+    files = []
+    for f in glob.glob(os.path.join(REPORT_CACHE_DIR, "*.xlsx")):
+        try: st = os.stat(f); files.append((st.st_mtime, st.st_size, f))
+        except OSError: pass
+    size = sum(f[1] for f in files)
+    for _, sz, f in sorted(files):
+        if size <= REPORT_CACHE_MAX_MB * 1024 * 1024: break
+        for p in (f, f[:-5] + ".json"):
+            try: os.remove(p)
+            except OSError: pass
+        size -= sz
+
+def branch_report(branch_name, period_type, custom_date=None, readonly=False):
+    """(xlsx, листов, записей, подпись периода); книга берётся из кэша, если данные не менялись"""
+    start, end, label = get_period_dates(period_type, custom_date)
+    with use_shard(branch_name), get_db(readonly) as conn:
+        conn.execute("BEGIN")  # версии и данные — из одного снимка
+        key = report_cache_key(conn, branch_name, period_type, start, end)
+        hit = report_cache_get(key)
+        if hit: return (*hit, label)
+        sheets_data, total = collect_report_sheets(conn, branch_name, period_type, start, end)
+    xlsx = build_multi_sheet_xlsx(sheets_data) if total else b""
+    if total: report_cache_put(key, xlsx, len(sheets_data), total)
+    return xlsx, len(sheets_data), total, label
+
+def prebuild_reports():
+    """Ночная сборка стандартных отчётов (месяц, квартал) по всем филиалам"""
+    branches = live_branch_names()
+    built = 0
+    for period_type in ("month", "quarter"):
+        for r in get_report_pool().map(build_branch_report, branches, [period_type] * len(branches)): built += bool(r["total"])
+    logger.info(f"📊 Отчёты предсобраны: {built}")
+    return {"built": built}
+
+if REPORT_PREBUILD_HOUR is not None: schedule_job("report-prebuild", prebuild_reports, at_hour=REPORT_PREBUILD_HOUR)
+
+# ============= ОТЧЁТЫ: ПУЛ ПРОЦЕССОВ =============
+# Функции ниже выполняются в процессах пула: у каждого своё read-only соединение.
+_report_pool = None
+
+def get_report_pool():
+    global _report_pool
+    if _report_pool is None:
+        _report_pool = ProcessPoolExecutor(max_workers=REPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _report_pool
+
+@app.on_event("shutdown")
+def shutdown_report_pool():
+    if _report_pool: _report_pool.shutdown(wait=False, cancel_futures=True)
+
+def build_branch_report(branch_name, period_type, custom_date=None):
+    xlsx, sheets, total, label = branch_report(branch_name, period_type, custom_date, readonly=True)
+    return {"branch_name": branch_name, "total": total, "sheets": sheets, "xlsx": xlsx, "label": label}
+
+def collect_branch_sheets(branch_name, period_type, custom_date=None):
+    """Листы филиала для сводной книги — с колонкой «Филиал» первой"""
+    start, end, _ = get_period_dates(period_type, custom_date)
+    with use_shard(branch_name), get_db(readonly=True) as conn:
+        sheets_data, _ = collect_report_sheets(conn, branch_name, period_type, start, end)
+    return {name: [{"Филиал": branch_name, **r} for r in recs] for name, recs in sheets_data.items()}
 
 @app.get("/email-config")
 def get_email_config():
     return {"configured": bool(SMTP_USER and SMTP_PASSWORD and REPORT_EMAIL_TO),
         "smtp_host": SMTP_HOST, "smtp_user": (SMTP_USER[:3]+"***") if SMTP_USER else "",
         "report_email": (REPORT_EMAIL_TO[:3]+"***") if REPORT_EMAIL_TO else ""}
+
+# ============= CLI =============
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="BarberCRM — служебные команды")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ap_archive = sub.add_parser("archive", help="перенести старые записи в archive_YYYY.db")
+    ap_archive.add_argument("--before", help="граница YYYY-MM-DD (по умолчанию ARCHIVE_AFTER_MONTHS месяцев назад)")
+    sub.add_parser("backup", help="снять онлайн-бэкап в BACKUP_DIR")
+    ap_restore = sub.add_parser("restore", help="восстановить БД из бэкапа (сервис лучше остановить)")
+    ap_restore.add_argument("file", nargs="?", help="файл .db.gz или .tar.gz (по умолчанию последний в BACKUP_DIR)")
+    sub.add_parser("shard", help="разнести данные общей БД по файлам филиалов в SHARD_DIR (сервис остановить)")
+    args = ap.parse_args()
+    if args.cmd == "restore":
+        path = args.file or next(iter(list_backups()), None)
+        if not path: raise SystemExit("Бэкапов нет")
+        print(json.dumps(restore_backup(path), ensure_ascii=False, indent=2)); raise SystemExit(0)
+    init_db()
+    if args.cmd == "backup": print(json.dumps(create_backup(), ensure_ascii=False, indent=2))
+    if args.cmd == "shard":
+        if not SHARD_DIR: raise SystemExit("Задайте SHARD_DIR")
+        print(json.dumps(split_into_shards(), ensure_ascii=False, indent=2))
+    if args.cmd == "archive":
+        print(json.dumps(archive_old_records(datetime.strptime(args.before, "%Y-%m-%d") if args.before else None), ensure_ascii=False, indent=2))
@@ -0,0 +1,45 @@
+"""Полнотекстовый поиск по FTS5-индексам секций (схема индексов — init_search в db.py).
+Ищет только по горячим данным: при переносе в archive_YYYY.db триггер удаления убирает запись из индекса"""
+from fastapi import APIRouter, HTTPException, Query
+from typing import Optional
+import re, sqlite3
+from config import *
+from db import DBRoute, get_db, use_shard, live_branch_names
+from shards import each_branch
+
+router = APIRouter(route_class=DBRoute)
+
+def fts_query(q):
+    """Пользовательский текст → запрос FTS5: все слова, каждое как префикс"""
+    return ' '.join(f'"{w}"*' for w in re.findall(r"\w+", q))
+
+@router.get("/search")
+def search(q: str = Query(..., min_length=2), branch: Optional[str] = None, section: Optional[str] = None,
+           page: int = Query(1, ge=1), limit: int = Query(20, ge=1, le=100)):
+    """Поиск по текстовым полям One-on-One, полевых выходов и утренних мероприятий (без архива)"""
+    match = fts_query(q)
+    if not match: raise HTTPException(400, "Пустой поисковый запрос")
+    if section and section not in SEARCH_CONFIG: raise HTTPException(400, f"Поиск по секции недоступен: {section}")
+    parts, params = [], []
+    for sec in ([section] if section else SEARCH_CONFIG):
+        cfg = SEARCH_CONFIG[sec]; t = cfg['table']
+        parts.append(f"""SELECT '{sec}' AS section, x.id AS id, x.branch_name AS branch_name, x.submitted_at AS submitted_at,
+            x.{cfg['date']} AS date, x.{cfg['title']} AS title, snippet({t}_fts, -1, '<mark>', '</mark>', '…', 16) AS snippet,
+            bm25({t}_fts) AS rank FROM {t}_fts JOIN {t} x ON x.id = {t}_fts.rowid
+            WHERE {t}_fts MATCH ? AND x.branch_name NOT IN (SELECT name FROM branches WHERE deleted_at IS NOT NULL)""" + (" AND x.branch_name=?" if branch else ""))
+        params += [match] + ([branch] if branch else [])
+    sql = " UNION ALL ".join(parts)
+    def run(conn, offset, n):
+        try:
+            return (conn.execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0],
+                    conn.execute(f"SELECT * FROM ({sql}) ORDER BY rank LIMIT ? OFFSET ?", params + [n, offset]).fetchall())
+        except sqlite3.OperationalError as e: raise HTTPException(400, f"Некорректный запрос: {e}")
+    if not SHARD_DIR or branch:
+        with use_shard(branch), get_db() as conn: total, rows = run(conn, (page - 1) * limit, limit)
+    else:
+        # из каждого шарда — его первые page*limit, общий порядок — слиянием по rank (bm25 считается по словарю шарда)
+        found = each_branch(lambda conn, _: run(conn, 0, page * limit), live_branch_names())
+        total = sum(n for n, _ in found)
+        rows = sorted((r for _, rs in found for r in rs), key=lambda r: r['rank'])[(page - 1) * limit:page * limit]
+    return {"success": True, "query": q, "total": total, "page": page, "pages": (total + limit - 1) // limit,
+            "results": [{k: r[k] for k in r.keys() if k != 'rank'} for r in rows]}
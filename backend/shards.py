@@ -0,0 +1,106 @@
+"""Файл базы на филиал (SHARD_DIR)
+
+С SHARD_DIR у каждого филиала свой файл с таблицами секций, лентой изменений, версиями и FTS, а в DB_PATH —
+каталог: branches и служебные таблицы. Запись в один филиал не держит блокировку остальных. Маршрут выбирается
+по {branch_name} из пути (DBRoute) или явно через use_shard; сборы по всей сети идут по шардам параллельно.
+id записи в шарде = (id филиала << SHARD_ID_BITS) + номер, так что /record/{id} находит свой шард по id.
+"""
+import logging, os, shutil, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import chain
+from fastapi import HTTPException
+from config import *
+from db import (get_db, use_shard, shard_path, init_data, live_branch_names, each_archive, sync_archive_schema,
+                table_columns, rebuild_master_rollup, DIM_COLUMNS)
+
+logger = logging.getLogger(__name__)
+
+SHARD_ID_BITS = 32
+SHARD_EXECUTOR = ThreadPoolExecutor(max_workers=SHARD_FANOUT, thread_name_prefix="shard")
+
+def init_shard(branch_name, bid):
+    """Файл филиала со схемой секций; последовательности id начинаются с bid << SHARD_ID_BITS"""
+    path = shard_path(branch_name)
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    open(path, "a").close()
+    with use_shard(branch_name), get_db() as conn:
+        init_data(conn, shard=True)
+        for t in SECTION_TABLES:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)", (t, bid << SHARD_ID_BITS, t))
+
+def record_branch(record_id):
+    """Филиал записи по её id (только в режиме шардов)"""
+    if not SHARD_DIR: return None
+    with get_db() as conn:
+        r = conn.execute("SELECT name FROM branches WHERE id=?", (record_id >> SHARD_ID_BITS,)).fetchone()
+    if not r: raise HTTPException(404, "Запись не найдена")
+    return r['name']
+
+def each_branch(fn, names, readonly=False):
+    """[fn(conn, филиал)] по списку филиалов: без шардов — по очереди в одном соединении, с шардами — параллельно"""
+    if not SHARD_DIR:
+        with get_db(readonly) as conn: return [fn(conn, n) for n in names]
+    def one(n):
+        with use_shard(n), get_db(readonly) as conn: return fn(conn, n)
+    return list(SHARD_EXECUTOR.map(one, names))
+
+def data_parts():
+    """Шарды для обхода по очереди; без шардов — [None], то есть общая БД"""
+    return live_branch_names() if SHARD_DIR else [None]
+
+def fan_rows(fn):
+    """Строки fn(conn) по всей сети: один запрос к общей БД или тот же запрос к каждому шарду, результаты подряд"""
+    if not SHARD_DIR:
+        with get_db() as conn: return fn(conn)
+    return [r for rows in each_branch(lambda conn, _: fn(conn), live_branch_names()) for r in rows]
+
+def split_into_shards():
+    """Переносит строки секций из общей БД в файлы филиалов (сервис остановлен). id становятся
+    (id филиала << SHARD_ID_BITS) + прежний id — и в шардах, и в архивах; справочники строятся заново по шарду"""
+    with get_db() as conn:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='morning_events'").fetchone(): return {"moved": {}}
+        branches = conn.execute("SELECT id, name FROM branches WHERE deleted_at IS NULL ORDER BY id").fetchall()
+    moved = {}
+    for b in branches:
+        init_shard(b['name'], b['id'])
+        base = b['id'] << SHARD_ID_BITS
+        with use_shard(b['name']), get_db() as conn:
+            for s in chain(["catalog"], each_archive(conn)):
+                if s != "catalog": sync_archive_schema(conn, s)
+                for t in SECTION_TABLES:
+                    if not table_columns(conn, t, s): continue
+                    col, dim, key = DIM_COLUMNS.get(t, (None, None, None))
+                    if dim:
+                        conn.execute(f"INSERT OR IGNORE INTO main.{dim} (branch_id, name) SELECT DISTINCT ?, TRIM({col}) FROM {s}.{t} WHERE branch_name=? AND TRIM({col}) != ''", (b['id'], b['name']))
+                    lookup = f"(SELECT d.id FROM main.{dim} d WHERE d.name = TRIM({col}))" if dim else None
+                    if s == "catalog":
+                        cols = [c for c in table_columns(conn, t, s) if c in table_columns(conn, t) and c not in ("id", "branch_id", key)]
+                        n = conn.execute(f"""INSERT INTO main.{t} (id, branch_id{f', {key}' if dim else ''}, {','.join(cols)})
+                            SELECT ? + id, ?{f', {lookup}' if dim else ''}, {','.join(cols)} FROM catalog.{t} WHERE branch_name=?""", (base, b['id'], b['name'])).rowcount
+                    else:
+                        n = conn.execute(f"UPDATE {s}.{t} SET id = ? + id, branch_id = ?{f', {key} = {lookup}' if dim else ''} WHERE branch_name=? AND id < ?",
+                            (base, b['id'], b['name'], 1 << SHARD_ID_BITS)).rowcount
+                    if n: moved[f"{s}.{t}"] = moved.get(f"{s}.{t}", 0) + n
+                conn.commit()  # архив отключается только вне транзакции
+            conn.execute("DELETE FROM main.changes")  # перенос — не изменения: лента шарда начинается с нуля
+            rebuild_master_rollup(conn)
+        logger.info(f"🗂 Шард '{b['name']}' заполнен")
+    # в каталоге остаются branches и служебные таблицы; строки удалённых филиалов уходят вместе с таблицами
+    with get_db() as conn:
+        for cfg in SEARCH_CONFIG.values(): conn.execute(f"DROP TABLE IF EXISTS {cfg['table']}_fts")
+        for t in SECTION_TABLES + ["master_rollup", "data_versions", "masters", "managers"]: conn.execute(f"DROP TABLE IF EXISTS {t}")
+        conn.execute("DELETE FROM changes WHERE table_name != 'branches'")
+    with closing(sqlite3.connect(DB_PATH)) as conn: conn.execute("VACUUM")
+    shutil.rmtree(REPORT_CACHE_DIR, ignore_errors=True)  # в закэшированных книгах прежние id
+    return {"branches": len(branches), "moved": moved}
+
+def drop_shard(bn, job_id):
+    """Файл филиала удаляется целиком — без построчных DELETE и роста WAL"""
+    path = shard_path(bn)
+    if not os.path.exists(path): return
+    with use_shard(bn), get_db(readonly=True) as conn:
+        n = sum(conn.execute(f"SELECT COUNT(*) FROM main.{t}").fetchone()[0] for t in SECTION_TABLES)
+    for f in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(f): os.remove(f)
+    with get_db() as conn: conn.execute("UPDATE branch_deletions SET deleted_rows=deleted_rows+? WHERE id=?", (n, job_id))
@@ -0,0 +1,44 @@
+"""Общие фикстуры: приложение на временной БД, с шардами и без"""
+import os, sys
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# настройки читаются при импорте, поэтому модули backend перезагружаются в каждом тесте
+MODULES = ("config", "utils", "db", "shards", "backup", "search", "limits", "export", "main")
+
+EVENT = {"week": 1, "date": "2026-10-01", "event_type": "Планёрка", "participants": 5, "efficiency": 4, "comment": ""}
+
+def plan(month, fact):
+    """Строка master_plans мастера «Иван»: план продаж 100, факт fact"""
+    return {"month": month, "master_name": "Иван", "average_check_plan": 1, "average_check_fact": 1, "additional_services_plan": 1,
+            "additional_services_fact": 1, "sales_plan": 100, "sales_fact": fact, "salary_plan": 1, "salary_fact": 1}
+
+def load_app(tmp_path, monkeypatch, sharded=False, **env):
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "barbercrm.db"))
+    monkeypatch.setenv("BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setenv("ADMIN_USERNAME", "admin"); monkeypatch.setenv("ADMIN_PASSWORD", "admin")
+    if sharded: monkeypatch.setenv("SHARD_DIR", str(tmp_path / "shards"))
+    else: monkeypatch.delenv("SHARD_DIR", raising=False)
+    for k, v in env.items(): monkeypatch.setenv(k, str(v))
+    for m in MODULES: sys.modules.pop(m, None)
+    import main
+    main.init_db()
+    return main
+
+@pytest.fixture(params=[False, True], ids=["single", "sharded"])
+def crm(request, tmp_path, monkeypatch):
+    """Модуль main на пустой БД в tmp_path — общей и с SHARD_DIR"""
+    return load_app(tmp_path, monkeypatch, sharded=request.param)
+
+@pytest.fixture
+def client(crm):
+    return TestClient(crm.app)
+
+@pytest.fixture
+def branch(client):
+    """Зарегистрированный филиал 'Центр'"""
+    r = client.post("/register", json={"name": "Центр", "address": "ул. Ленина, 1", "manager_name": "Иван", "manager_phone": "+7900", "password": "secret"})
+    assert r.status_code == 200, r.text
+    return "Центр"
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+from conftest import EVENT, plan
+
+BRANCHES = ("Центр", "Север", "Юг")
+
+def backdate(crm, branch, table, ts):
+    with crm.use_shard(branch), crm.get_db() as conn: conn.execute(f"UPDATE {table} SET submitted_at=? WHERE submitted_at > ?", (ts, "2025"))
+
+def test_archived_rows_counted_once(crm, client):
+    for b in BRANCHES:
+        client.post("/register", json={"name": b, "address": "a", "manager_name": "М", "manager_phone": "1", "password": "p"})
+    client.post("/master-plans/Центр", json=[plan("Март", 50)]); backdate(crm, "Центр", "master_plans", "2021-03-10 10:00:00")
+    client.post("/master-plans/Центр", json=[plan("Март", 30)]); backdate(crm, "Центр", "master_plans", "2021-03-20 10:00:00")
+    # граница посреди месяца: в корзине марта 2021 одна строка из архива и одна горячая
+    assert crm.archive_old_records(datetime(2021, 3, 15))["moved"]
+    board = client.get("/admin/leaderboard", params={"period": "all", "metric": "sales"}).json()
+    assert [(b["branch_name"], b["plan"], b["fact"]) for b in board["branches"]] == [("Центр", 200.0, 80.0)]
+    assert (board["network"]["plan"], board["network"]["fact"]) == (200.0, 80.0)
+    trends = client.get("/trends", params={"metric": "master_plans", "bucket": "month", "from": "2021-03-01", "to": "2021-03-31"}).json()["series"]
+    assert list(trends) == ["Центр"] and trends["Центр"][0]["sales_fact"] == 80 and trends["Центр"][0]["count"] == 2
+    assert len(client.get("/master-plans/Центр").json()["data"]) == 2 and client.get("/master-plans/Север").json()["data"] == []
+
+def test_rebuilt_summaries_replace_archived_ones(crm, client, branch):
+    client.post(f"/morning-events/{branch}", json=[{**EVENT, "date": "2022-03-05"}]); backdate(crm, branch, "morning_events", "2022-03-05 10:00:00")
+    assert client.post("/admin/branch-summaries/rebuild", params={"from": "2022-03", "to": "2022-03"}).json()["rows"] == 7
+    # сводки уходят в архив по дате сборки
+    assert crm.archive_old_records(datetime.now() + timedelta(days=1))["moved"]
+    client.post("/admin/branch-summaries/rebuild", params={"from": "2022-03", "to": "2022-03"})
+    client.post(f"/branch-summary/{branch}", json={"manager": "Иван", "month": "Март 2022"})
+    rows = client.get(f"/branch-summary/{branch}").json()["data"]
+    assert len(rows) == 7 and {r["Месяц"] for r in rows} == {"Март 2022"}
+    assert next(r for r in rows if r["Метрика"] == "Утренние мероприятия")["Текущее количество"] == 1
+
+def test_more_archive_years_than_attach_limit(crm, client, branch, monkeypatch):
+    years = range(2008, 2008 + crm.db.ATTACH_LIMIT + 2)
+    for y in years:
+        client.post(f"/morning-events/{branch}", json=[{**EVENT, "comment": str(y)}]); backdate(crm, branch, "morning_events", f"{y}-06-01 10:00:00")
+    assert crm.archive_old_records(datetime(2022, 1, 1))["moved"] and crm.db.archive_years() == list(years)
+    rows = client.get(f"/morning-events/{branch}").json()["data"]
+    assert sorted(r["Комментарий"] for r in rows) == [str(y) for y in years]
+    assert len(client.get("/stream/morning-events", params={"branch": branch}).text.splitlines()) == len(years)
+    oldest = min(rows, key=lambda r: r["id"])
+    r = client.put(f"/record/morning-events/{oldest['id']}", json={"Комментарий": "старое"}); assert r.status_code == 200, r.text
+    assert "старое" in [r["Комментарий"] for r in client.get(f"/morning-events/{branch}").json()["data"]]
+    # агрегат одним запросом по всем годам не помещается в соединение — просим сузить период
+    wide = {"metric": "morning_events", "bucket": "month", "from": "2008-01-01", "to": "2021-12-31"}
+    r = client.get("/trends", params=wide)
+    assert r.status_code == 400 and "сузьте период" in r.json()["detail"]
+    assert client.get("/trends", params={**wide, "from": "2016-01-01"}).status_code == 200
+    run = crm.run_branch_deletion
+    monkeypatch.setattr(crm, "run_branch_deletion", lambda job_id: None)
+    job_id = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    run(job_id)
+    j = client.get(f"/admin/branch-deletions/{job_id}").json()["job"]
+    assert j["status"] == "done" and j["deleted_rows"] == len(years)
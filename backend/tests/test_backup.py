@@ -0,0 +1,75 @@
+import gzip, os, sqlite3, tarfile
+import pytest
+from datetime import datetime
+from conftest import EVENT
+
+def test_backup_restore_roundtrip(crm, client, branch):
+    assert client.post(f"/morning-events/{branch}", json=[EVENT]).status_code == 200
+    r = client.post("/admin/backup").json()
+    assert r["success"] and r["integrity"] == "ok"
+    assert [b["file"] for b in client.get("/admin/backups").json()["backups"]] == [r["file"]]
+
+    client.post(f"/morning-events/{branch}", json=[EVENT, EVENT])
+    assert len(client.get(f"/morning-events/{branch}").json()["data"]) == 3
+    restored = crm.restore_backup(crm.list_backups()[0])
+    assert restored["integrity"] == "ok" and restored["files"] == (2 if crm.SHARD_DIR else 1)
+    assert len(client.get(f"/morning-events/{branch}").json()["data"]) == 1
+
+def test_backup_archive_is_self_contained(crm, client, branch, tmp_path):
+    client.post(f"/morning-events/{branch}", json=[EVENT])
+    path = os.path.join(crm.BACKUP_DIR, crm.create_backup()["file"])
+    out = tmp_path / "unpacked"; out.mkdir()
+    if crm.SHARD_DIR:
+        with tarfile.open(path) as tar: tar.extractall(out, filter="data")
+        files = [out / "catalog.db"] + list((out / "shards").glob("branch_*.db"))
+        assert len(files) == 2
+    else:
+        files = [out / "snapshot.db"]
+        with gzip.open(path) as g: files[0].write_bytes(g.read())
+    for f in files:
+        assert not os.path.exists(f"{f}-wal")
+        with sqlite3.connect(f) as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+            assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+
+def test_backup_rotation(crm, monkeypatch):
+    import backup
+    monkeypatch.setattr(backup, "BACKUP_KEEP", 2)
+    os.makedirs(crm.BACKUP_DIR, exist_ok=True)
+    for day in ("01", "02", "03"): open(os.path.join(crm.BACKUP_DIR, f"barbercrm_202001{day}_020000.db.gz"), "wb").close()
+    new = crm.create_backup()["file"]
+    assert [os.path.basename(p) for p in crm.list_backups()] == [new, "barbercrm_20200103_020000.db.gz"]
+
+def test_restore_rejects_corrupt_backup(crm, client, branch, tmp_path):
+    client.post(f"/morning-events/{branch}", json=[EVENT])
+    bad = tmp_path / ("barbercrm_bad.tar.gz" if crm.SHARD_DIR else "barbercrm_bad.db.gz")
+    if crm.SHARD_DIR:
+        junk = tmp_path / "catalog.db"; junk.write_bytes(b"SQLite format 3\0" + b"\xff" * 4096)
+        with tarfile.open(bad, "w:gz") as tar: tar.add(junk, arcname="catalog.db")
+    else:
+        with gzip.open(bad, "wb") as g: g.write(b"SQLite format 3\0" + b"\xff" * 4096)
+    with pytest.raises(Exception):
+        crm.restore_backup(str(bad))
+    assert len(client.get(f"/morning-events/{branch}").json()["data"]) == 1
+
+def test_backup_includes_archives(crm, client, branch):
+    client.post(f"/morning-events/{branch}", json=[EVENT] * 2)
+    with crm.use_shard(branch), crm.get_db() as conn: conn.execute("UPDATE morning_events SET submitted_at='2020-05-01 10:00:00'")
+    crm.archive_old_records(datetime(2021, 1, 1))
+    r = crm.create_backup()
+    assert r["file"].endswith(".tar.gz") and r["files"] == (3 if crm.SHARD_DIR else 2)
+    with tarfile.open(os.path.join(crm.BACKUP_DIR, r["file"])) as tar: assert "archives/archive_2020.db" in tar.getnames()
+    os.remove(crm.db.archive_path(2020))
+    assert client.get(f"/morning-events/{branch}").json()["data"] == []
+    crm.restore_backup(crm.list_backups()[0])
+    assert len(client.get(f"/morning-events/{branch}").json()["data"]) == 2
+
+def test_latest_backup_download_requires_admin(crm, client):
+    assert client.get("/admin/backups/latest", auth=("admin", "admin")).status_code == 404
+    name = crm.create_backup()["file"]
+    assert client.get("/admin/backups/latest").status_code == 401
+    r = client.get("/admin/backups/latest", auth=("admin", "неверный"))
+    assert r.status_code == 401 and r.headers["www-authenticate"] == "Basic"
+    r = client.get("/admin/backups/latest", auth=("admin", "admin"))
+    assert r.status_code == 200 and name in r.headers["content-disposition"]
+    with open(os.path.join(crm.BACKUP_DIR, name), "rb") as f: assert r.content == f.read()
@@ -0,0 +1,71 @@
+import os, time
+import pytest
+from conftest import EVENT
+
+@pytest.fixture
+def run_job(crm, monkeypatch):
+    """DELETE только ставит задачу; выполняет её тест вызовом run_job(job_id)"""
+    run = crm.run_branch_deletion
+    monkeypatch.setattr(crm, "run_branch_deletion", lambda job_id: None)
+    monkeypatch.setattr(crm, "DELETE_CHUNK_SIZE", 2)
+    monkeypatch.setattr(crm, "DELETE_CHUNK_PAUSE", 0)
+    return run
+
+def job(client, job_id):
+    return client.get(f"/admin/branch-deletions/{job_id}").json()["job"]
+
+def test_deletion_pending_then_done(crm, client, branch, run_job):
+    client.post(f"/morning-events/{branch}", json=[EVENT] * 5)
+    r = client.delete(f"/admin/branches/{branch}").json()
+    assert job(client, r["job_id"])["status"] == "pending" and job(client, r["job_id"])["total_rows"] == 5
+    assert client.get("/branches").json()["branches"] == []
+    run_job(r["job_id"])
+    j = job(client, r["job_id"])
+    assert (j["status"], j["deleted_rows"], j["progress"], j["owner_pid"]) == ("done", 5, 100.0, os.getpid())
+    assert not os.path.exists(f"{crm.DB_PATH}.deletion-{r['job_id']}.lock")
+    assert not crm.SHARD_DIR or not os.path.exists(crm.shard_path(branch))
+    with crm.get_db() as conn: assert not conn.execute("SELECT 1 FROM branches WHERE name=?", (branch,)).fetchone()
+    assert client.delete(f"/admin/branches/{branch}").status_code == 404
+    run_job(r["job_id"])  # завершённая задача повторно не выполняется
+    assert job(client, r["job_id"])["deleted_rows"] == 5
+
+def test_repeated_delete_reuses_job(client, branch, run_job):
+    first = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    assert client.delete(f"/admin/branches/{branch}").json()["job_id"] == first
+
+def test_claimed_job_is_skipped(crm, client, branch, run_job):
+    client.post(f"/morning-events/{branch}", json=[EVENT])
+    job_id = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    with crm.file_lock(f"deletion-{job_id}"):
+        run_job(job_id)  # задачу держит другой владелец
+        assert job(client, job_id)["status"] == "pending"
+    run_job(job_id)
+    assert job(client, job_id)["status"] == "done"
+
+def test_failed_job_can_be_restarted(crm, client, branch, run_job, monkeypatch):
+    client.post(f"/morning-events/{branch}", json=[EVENT] * 3)
+    job_id = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    def broken(conn): raise RuntimeError("диск недоступен")
+    with monkeypatch.context() as m:
+        m.setattr(crm, "each_archive", broken)
+        run_job(job_id)
+    j = job(client, job_id)
+    assert j["status"] == "failed" and "диск недоступен" in j["error"]
+    retry = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    assert retry != job_id
+    run_job(retry)
+    assert job(client, retry)["status"] == "done" and job(client, retry)["deleted_rows"] == 3
+
+def test_resume_picks_up_unowned_jobs(crm, client, branch, run_job, monkeypatch):
+    client.post(f"/morning-events/{branch}", json=[EVENT] * 3)
+    job_id = client.delete(f"/admin/branches/{branch}").json()["job_id"]
+    monkeypatch.setattr(crm, "run_branch_deletion", run_job)
+    assert crm.resume_branch_deletions() == {"checked": 1}
+    deadline = time.time() + 5
+    while job(client, job_id)["status"] != "done" and time.time() < deadline: time.sleep(0.02)
+    assert job(client, job_id)["status"] == "done"
+    assert crm.resume_branch_deletions() == {"checked": 0}
+
+def test_unknown_job_and_branch(client):
+    assert client.get("/admin/branch-deletions/999").status_code == 404
+    assert client.delete("/admin/branches/Нет такого").status_code == 404
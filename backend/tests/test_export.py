@@ -0,0 +1,54 @@
+import asyncio, json, threading, time
+import httpx
+from conftest import EVENT
+
+def fill(client, branch):
+    client.post("/register", json={"name": "Север", "address": "пр. Мира, 5", "manager_name": "Олег", "manager_phone": "+7901", "password": "secret"})
+    for b in (branch, "Север"): client.post(f"/morning-events/{b}", json=[{**EVENT, "comment": b}] * 3)
+
+def test_export_csv_all_branches_in_batches(crm, client, branch, monkeypatch):
+    import export
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+    fill(client, branch)
+    r = client.get("/stream/morning-events", params={"format": "csv"})
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/csv")
+    lines = r.content.decode().splitlines()
+    assert lines[0].startswith("﻿Филиал;id;") and len(lines) == 7
+    assert sorted(l.split(";")[0] for l in lines[1:]) == sorted([branch] * 3 + ["Север"] * 3)
+
+def test_export_ndjson_one_branch(client, branch):
+    fill(client, branch)
+    r = client.get("/stream/morning-events", params={"branch": "Север"})
+    rows = [json.loads(l) for l in r.text.splitlines()]
+    assert len(rows) == 3 and {x["Филиал"] for x in rows} == {"Север"} and rows[0]["Комментарий"] == "Север"
+
+def test_export_rejects_bad_request(client, branch):
+    assert client.get("/stream/nope").status_code == 400
+    assert client.get("/stream/reviews", params={"format": "xml"}).status_code == 400
+    assert client.get("/stream/reviews", params={"branch": "Нет такого"}).status_code == 404
+
+def test_export_releases_admission_slot(crm, client, branch):
+    import limits
+    fill(client, branch)
+    async def go():
+        # один цикл событий на все запросы: слот возвращается в него из DB_EXECUTOR после закрытия выгрузки
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=crm.app), base_url="http://test") as c:
+            for _ in range(3): assert (await c.get("/stream/morning-events")).status_code == 200
+            sem = limits._route_semaphores["export"]
+            for _ in range(200):
+                if sem._value == crm.ROUTE_LIMITS["export"]: break
+                await asyncio.sleep(0.01)
+            return sem._value
+    assert asyncio.run(go()) == crm.ROUTE_LIMITS["export"]
+
+def test_export_close_waits_for_chunk_in_flight(client, branch, monkeypatch):
+    import export
+    fill(client, branch)
+    read, close = export.export_reader("morning-events", export.export_parts([branch], None, None), None, None, "ndjson")
+    chunk = export.export_chunk
+    monkeypatch.setattr(export, "export_chunk", lambda *a: (time.sleep(0.3), chunk(*a))[1])
+    out = []
+    t = threading.Thread(target=lambda: out.append(read())); t.start(); time.sleep(0.05)
+    assert close() is True and out and out[0].count(b"\n") == 3
+    assert read() is None and close() is False
+    t.join()
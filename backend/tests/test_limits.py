@@ -0,0 +1,68 @@
+import asyncio, threading
+import pytest
+from fastapi import HTTPException
+from conftest import load_app
+
+@pytest.fixture
+def limits(tmp_path, monkeypatch):
+    load_app(tmp_path, monkeypatch)
+    import limits
+    return limits
+
+def test_single_flight_coalesces_equal_calls(limits):
+    calls = []
+    async def build(branch_name, period_type):
+        calls.append((branch_name, period_type)); await asyncio.sleep(0.05)
+        return f"{branch_name}/{period_type}"
+    report = limits.single_flight(build)
+    async def go(): return await asyncio.gather(report(branch_name="A", period_type="month"), report(branch_name="A", period_type="month"), report(branch_name="A", period_type="week"))
+    assert asyncio.run(go()) == ["A/month", "A/month", "A/week"]
+    assert calls == [("A", "month"), ("A", "week")] and limits._inflight == {}
+
+def test_single_flight_runs_sync_handler_once_in_db_pool(limits):
+    calls, gate = [], threading.Event()
+    def build(branch_name):
+        calls.append(threading.current_thread().name); gate.wait(2); return branch_name
+    report = limits.single_flight(build)
+    async def go():
+        waiters = [asyncio.ensure_future(report(branch_name="A")) for _ in range(5)]
+        await asyncio.sleep(0.05); gate.set()
+        return await asyncio.gather(*waiters)
+    assert asyncio.run(go()) == ["A"] * 5 and len(calls) == 1 and calls[0] != threading.main_thread().name
+
+def test_single_flight_survives_cancelled_waiter(limits):
+    calls = []
+    async def build(x):
+        calls.append(x); await asyncio.sleep(0.05); return x
+    report = limits.single_flight(build)
+    async def go():
+        first, second = asyncio.ensure_future(report(x=1)), asyncio.ensure_future(report(x=1))
+        await asyncio.sleep(0.01); first.cancel()
+        return await second
+    assert asyncio.run(go()) == 1 and calls == [1]
+
+def test_limit_concurrency_answers_429_when_full(limits, monkeypatch):
+    monkeypatch.setitem(limits.ROUTE_LIMITS, "report", 1)
+    monkeypatch.setattr(limits, "ADMISSION_WAIT_SECONDS", 0.05)
+    async def go():
+        gate = asyncio.Event()
+        async def build(): await gate.wait(); return "ok"
+        report = limits.limit_concurrency("report")(build)
+        first = asyncio.ensure_future(report()); await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as e: await report()
+        assert e.value.status_code == 429 and e.value.headers["Retry-After"] == "1"
+        gate.set()
+        return await first, await report()
+    assert asyncio.run(go()) == ("ok", "ok")
+
+def test_limit_concurrency_releases_slot_on_error(limits, monkeypatch):
+    monkeypatch.setitem(limits.ROUTE_LIMITS, "report", 1)
+    monkeypatch.setattr(limits, "ADMISSION_WAIT_SECONDS", 0.05)
+    async def build(fail):
+        if fail: raise HTTPException(404, "Филиал не найден")
+        return "ok"
+    report = limits.limit_concurrency("report")(build)
+    async def go():
+        with pytest.raises(HTTPException): await report(fail=True)
+        return await report(fail=False)
+    assert asyncio.run(go()) == "ok"
@@ -0,0 +1,15 @@
+from conftest import EVENT, plan
+
+def test_network_views_group_by_branch_id(crm, client, branch):
+    client.post("/register", json={"name": "Север", "address": "a", "manager_name": "Олег", "manager_phone": "1", "password": "p"})
+    for b, fact in ((branch, 90), ("Север", 40)):
+        client.post(f"/master-plans/{b}", json=[plan("Октябрь", fact)]); client.post(f"/morning-events/{b}", json=[EVENT])
+    crm.backfill_dimensions()
+    assert crm.db.network_branch_key()[0] == "branch_id"
+    board = client.get("/admin/leaderboard", params={"metric": "sales"}).json()["branches"]
+    assert [(b["branch_name"], b["rank"], [m["master_name"] for m in b["masters"]]) for b in board] == [(branch, 1, ["Иван"]), ("Север", 2, ["Иван"])]
+    series = client.get("/trends", params={"metric": "morning_events"}).json()["series"]
+    assert sorted(series) == sorted([branch, "Север"]) and all(s[-1]["count"] == 1 for s in series.values())
+    assert client.post("/admin/branch-summaries/rebuild").json()["rows"] == 14
+    rows = client.get(f"/branch-summary/{branch}").json()["data"]
+    assert next(r for r in rows if r["Метрика"] == "Утренние мероприятия")["Текущее количество"] == 1
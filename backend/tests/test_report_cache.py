@@ -0,0 +1,6 @@
+def test_cache_entry_evicted_during_read_is_a_miss(crm, monkeypatch):
+    crm.report_cache_put("k", b"xlsx", ["Лист"], 3)
+    assert crm.report_cache_get("k") == (b"xlsx", ["Лист"], 3)
+    def evicted(path): raise FileNotFoundError(path)  # соседний процесс удалил файл после чтения
+    monkeypatch.setattr(crm.os, "utime", evicted)
+    assert crm.report_cache_get("k") is None
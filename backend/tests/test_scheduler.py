@@ -0,0 +1,15 @@
+from datetime import datetime
+
+def test_scheduler_survives_failed_run_save(crm, monkeypatch):
+    runs = []
+    def sleep(_): raise KeyboardInterrupt  # цикл дошёл до паузы — поток жив
+    def broken(job): raise RuntimeError("database is locked")
+    monkeypatch.setattr(crm, "SCHEDULED_JOBS", [{"name": "тест", "fn": lambda: runs.append(1), "every": 1, "at_hour": None,
+                                                 "last_run": datetime(2020, 1, 1), "last_result": None, "last_error": None, "last_duration": None}])
+    monkeypatch.setattr(crm, "try_lead", lambda: True)
+    monkeypatch.setattr(crm, "on_lead", lambda: None)
+    monkeypatch.setattr(crm, "save_job_run", broken)
+    monkeypatch.setattr(crm.time, "sleep", sleep)
+    try: crm.scheduler_loop()
+    except KeyboardInterrupt: pass
+    assert runs == [1] and crm.SCHEDULED_JOBS[0]["last_error"] is None
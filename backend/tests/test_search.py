@@ -0,0 +1,38 @@
+from datetime import datetime
+from conftest import EVENT
+
+def test_search_prefix_and_branch_filter(client, branch):
+    client.post("/register", json={"name": "Север", "address": "пр. Мира, 5", "manager_name": "Олег", "manager_phone": "+7901", "password": "secret"})
+    client.post(f"/morning-events/{branch}", json=[{**EVENT, "comment": "разбор стрижек фейд"}, {**EVENT, "comment": "продажи косметики"}])
+    client.post("/morning-events/Север", json=[{**EVENT, "comment": "стрижка машинкой"}])
+    r = client.get("/search", params={"q": "стриж"}).json()
+    assert r["total"] == 2 and {x["branch_name"] for x in r["results"]} == {branch, "Север"}
+    assert all("<mark>" in x["snippet"] for x in r["results"])
+    r = client.get("/search", params={"q": "стриж", "branch": branch}).json()
+    assert r["total"] == 1 and r["results"][0]["section"] == "morning-events"
+
+def test_search_pages_across_branches(client, branch):
+    client.post("/register", json={"name": "Север", "address": "пр. Мира, 5", "manager_name": "Олег", "manager_phone": "+7901", "password": "secret"})
+    for b in (branch, "Север"): client.post(f"/morning-events/{b}", json=[{**EVENT, "comment": f"стандарты {i}"} for i in range(3)])
+    pages = [client.get("/search", params={"q": "стандарты", "limit": 4, "page": p}).json() for p in (1, 2)]
+    assert [len(p["results"]) for p in pages] == [4, 2] and pages[0]["pages"] == 2
+    assert len({(x["branch_name"], x["id"]) for p in pages for x in p["results"]}) == 6
+
+def test_search_hides_deleted_branch_and_rejects_bad_input(crm, client, branch, monkeypatch):
+    monkeypatch.setattr(crm, "run_branch_deletion", lambda job_id: None)
+    client.post(f"/morning-events/{branch}", json=[{**EVENT, "comment": "стрижка"}])
+    assert client.delete(f"/admin/branches/{branch}").status_code == 200
+    assert client.get("/search", params={"q": "стрижка"}).json()["total"] == 0
+    assert client.get("/search", params={"q": "!!"}).status_code == 400
+    assert client.get("/search", params={"q": "стрижка", "section": "reviews"}).status_code == 400
+
+def test_search_covers_hot_data_only(crm, client, branch):
+    client.post(f"/morning-events/{branch}", json=[{**EVENT, "comment": "старый разбор фейда"}])
+    with crm.use_shard(branch), crm.get_db() as conn: conn.execute("UPDATE morning_events SET submitted_at='2021-05-01 10:00:00'")
+    client.post(f"/morning-events/{branch}", json=[{**EVENT, "comment": "новый разбор фейда"}])
+    assert client.get("/search", params={"q": "фейд"}).json()["total"] == 2
+    assert crm.archive_old_records(datetime(2022, 1, 1))["moved"]
+    r = client.get("/search", params={"q": "фейд"}).json()
+    assert r["total"] == 1 and "новый" in r["results"][0]["snippet"]
+    # запись по-прежнему читается из архива, просто не ищется
+    assert len(client.get(f"/morning-events/{branch}").json()["data"]) == 2
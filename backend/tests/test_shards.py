@@ -0,0 +1,49 @@
+import os, sqlite3
+from conftest import EVENT, load_app
+from fastapi.testclient import TestClient
+
+NORTH = {"name": "Север", "address": "пр. Мира, 5", "manager_name": "Олег", "manager_phone": "+7901", "password": "secret"}
+
+def branch_ids(crm):
+    with crm.get_db() as conn: return {r['name']: r['id'] for r in conn.execute("SELECT id, name FROM branches")}
+
+def test_record_id_encodes_branch(tmp_path, monkeypatch):
+    crm = load_app(tmp_path, monkeypatch, sharded=True)
+    client = TestClient(crm.app)
+    client.post("/register", json={**NORTH, "name": "Центр"}); client.post("/register", json=NORTH)
+    ids = branch_ids(crm)
+    for b in ids: client.post(f"/morning-events/{b}", json=[EVENT, EVENT])
+    rows = {b: client.get(f"/morning-events/{b}").json()["data"] for b in ids}
+    for b, data in rows.items():
+        assert sorted(r["id"] for r in data) == [(ids[b] << 32) + 1, (ids[b] << 32) + 2]
+        assert os.path.exists(crm.shard_path(b))
+    rid = rows["Север"][0]["id"]
+    assert client.put(f"/record/morning-events/{rid}", json={"comment": "исправлено"}).status_code == 200
+    assert [r["Комментарий"] for r in client.get("/morning-events/Север").json()["data"] if r["id"] == rid] == ["исправлено"]
+    assert client.delete(f"/record/morning-events/{rid}").status_code == 200
+    assert len(client.get("/morning-events/Север").json()["data"]) == 1 and len(client.get("/morning-events/Центр").json()["data"]) == 2
+    assert client.delete(f"/record/morning-events/{(99 << 32) + 1}").status_code == 404
+
+def test_split_into_shards_moves_rows(tmp_path, monkeypatch):
+    crm = load_app(tmp_path, monkeypatch)
+    client = TestClient(crm.app)
+    client.post("/register", json={**NORTH, "name": "Центр"}); client.post("/register", json=NORTH)
+    client.post("/morning-events/Центр", json=[{**EVENT, "comment": "стрижка фейд"}] * 3)
+    client.post("/morning-events/Север", json=[{**EVENT, "comment": "косметика"}] * 2)
+    before = {b: sorted(r["id"] for r in client.get(f"/morning-events/{b}").json()["data"]) for b in ("Центр", "Север")}
+
+    crm = load_app(tmp_path, monkeypatch, sharded=True)
+    client = TestClient(crm.app)
+    result = crm.split_into_shards()
+    assert result["branches"] == 2 and result["moved"]["catalog.morning_events"] == 5
+    ids = branch_ids(crm)
+    for b, old in before.items():
+        assert sorted(r["id"] for r in client.get(f"/morning-events/{b}").json()["data"]) == [(ids[b] << 32) + i for i in old]
+    with sqlite3.connect(crm.DB_PATH) as conn:
+        assert not conn.execute("SELECT 1 FROM sqlite_master WHERE name IN ('morning_events', 'morning_events_fts')").fetchone()
+    found = client.get("/search", params={"q": "стрижк"}).json()
+    assert found["total"] == 3 and {r["branch_name"] for r in found["results"]} == {"Центр"}
+    # новые записи продолжают последовательность шарда
+    client.post("/morning-events/Север", json=[EVENT])
+    assert max(r["id"] for r in client.get("/morning-events/Север").json()["data"]) > ids["Север"] << 32
+    assert crm.split_into_shards() == {"moved": {}}
@@ -0,0 +1,87 @@
+"""Пароли, токены и разбор дат/периодов"""
+import hashlib, secrets
+from datetime import datetime, timedelta
+
+def hash_password(p): return hashlib.sha256(p.encode()).hexdigest()
+def generate_token(): return secrets.token_urlsafe(32)
+
+def parse_date_flexible(date_str):
+    s = str(date_str).strip()
+    if not s: return None
+    for fmt in ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y"]:
+        try: return datetime.strptime(s.split()[0], fmt)
+        except ValueError: continue
+    return None
+
+def get_month_ru(dt):
+    m = ['Январь','Февраль','Март','Апрель','Май','Июнь','Июль','Август','Сентябрь','Октябрь','Ноябрь','Декабрь']
+    return f"{m[dt.month-1]} {dt.year}"
+
+def current_month_ru(): return get_month_ru(datetime.now())
+
+def count_for_month(rows, field, month):
+    c = 0
+    for r in rows:
+        dt = parse_date_flexible(str(r[field]))
+        if dt and get_month_ru(dt) == month: c += 1
+    return c
+
+def sum_reviews_month(rows, month):
+    t = 0
+    for r in rows:
+        dt = parse_date_flexible(str(r['submitted_at']))
+        if dt and get_month_ru(dt) == month: t += int(r['fact'] or 0)
+    return t
+
+def get_period_dates(period_type, custom_date=None):
+    """Возвращает (start, end, label) для фильтрации"""
+    now = datetime.now()
+    if period_type == "today":
+        s = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        e = now.replace(hour=23, minute=59, second=59)
+        return s, e, f"Сегодня ({now.strftime('%d.%m.%Y')})"
+    elif period_type == "yesterday":
+        y = now - timedelta(days=1)
+        s = y.replace(hour=0, minute=0, second=0, microsecond=0)
+        e = y.replace(hour=23, minute=59, second=59)
+        return s, e, f"Вчера ({y.strftime('%d.%m.%Y')})"
+    elif period_type == "week":
+        wd = now.weekday()
+        s = (now - timedelta(days=wd)).replace(hour=0, minute=0, second=0, microsecond=0)
+        e = (s + timedelta(days=6)).replace(hour=23, minute=59, second=59)
+        return s, e, f"Неделя ({s.strftime('%d.%m')}–{e.strftime('%d.%m.%Y')})"
+    elif period_type == "month":
+        s = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        e = (s + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+        return s, e, current_month_ru()
+    elif period_type == "quarter":
+        q = (now.month - 1) // 3
+        s = datetime(now.year, q * 3 + 1, 1)
+        e_month = q * 3 + 3
+        e = datetime(now.year, e_month, 1) + timedelta(days=32)
+        e = e.replace(day=1) - timedelta(seconds=1)
+        return s, e, f"Q{q+1} {now.year}"
+    elif period_type == "year":
+        s = datetime(now.year, 1, 1)
+        e = datetime(now.year, 12, 31, 23, 59, 59)
+        return s, e, f"{now.year} год"
+    elif period_type == "day" and custom_date:
+        t = datetime.strptime(custom_date, "%Y-%m-%d")
+        return t.replace(hour=0,minute=0,second=0), t.replace(hour=23,minute=59,second=59), t.strftime("%d.%m.%Y")
+    else:
+        return datetime(2020,1,1), datetime(2099,12,31), "Весь период"
+
+def period_bounds(start, end):
+    """Границы периода для сравнения с submitted_at: [start, день после end)"""
+    return start.strftime("%Y-%m-%d"), (end.date() + timedelta(days=1)).strftime("%Y-%m-%d")
+
+def month_label_range(label):
+    """'Январь 2025' → (начало, конец месяца) или (None, None)"""
+    m = ['Январь','Февраль','Март','Апрель','Май','Июнь','Июль','Август','Сентябрь','Октябрь','Ноябрь','Декабрь']
+    parts = str(label).split()
+    if len(parts) != 2 or parts[0] not in m or not parts[1].isdigit(): return None, None
+    s = datetime(int(parts[1]), m.index(parts[0]) + 1, 1)
+    return s, (s + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
+
+def report_filename(prefix, label, ext="xlsx"):
+    return f"{prefix.replace(' ','_')}_{label.replace(' ','_').replace('.','_')}.{ext}"
@@ -56,6 +56,7 @@ const Icons = {
   ChatAlt: ({className}) => (<svg className={className} fill="none" viewBox="0 0 24 24" stroke="currentColor"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M8 10h.01M12 10h.01M16 10h.01M9 16H5a2 2 0 01-2-2V6a2 2 0 012-2h14a2 2 0 012 2v8a2 2 0 01-2 2h-5l-5 5v-5z" /></svg>),
   ClipboardList: ({className}) => (<svg className={className} fill="none" viewBox="0 0 24 24" stroke="currentColor"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 5H7a2 2 0 00-2 2v12a2 2 0 002 2h10a2 2 0 002-2V7a2 2 0 00-2-2h-2M9 5a2 2 0 002 2h2a2 2 0 002-2M9 5a2 2 0 012-2h2a2 2 0 012 2m-6 9l2 2 4-4" /></svg>),
   Dashboard: ({className}) => (<svg className={className} fill="none" viewBox="0 0 24 24" stroke="currentColor"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 5a1 1 0 011-1h4a1 1 0 011 1v7a1 1 0 01-1 1H5a1 1 0 01-1-1V5zM14 5a1 1 0 011-1h4a1 1 0 011 1v4a1 1 0 01-1 1h-4a1 1 0 01-1-1V5zM4 16a1 1 0 011-1h4a1 1 0 011 1v3a1 1 0 01-1 1H5a1 1 0 01-1-1v-3zM14 13a1 1 0 011-1h4a1 1 0 011 1v6a1 1 0 01-1 1h-4a1 1 0 01-1-1v-6z" /></svg>),
+  Search: ({className}) => (<svg className={className} fill="none" viewBox="0 0 24 24" stroke="currentColor"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M21 21l-6-6m2-5a7 7 0 11-14 0 7 7 0 0114 0z" /></svg>),
   Shield: ({className}) => (<svg className={className} fill="none" viewBox="0 0 24 24" stroke="currentColor"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 12l2 2 4-4m5.618-4.016A11.955 11.955 0 0112 2.944a11.955 11.955 0 01-8.618 3.04A12.02 12.02 0 003 9c0 5.591 3.824 10.29 9 11.622 5.176-1.332 9-6.03 9-11.622 0-1.042-.133-2.052-.382-3.016z" /></svg>),
 };
 
@@ -201,7 +202,7 @@ const AuthPage = ({ onAuth, onAdminAuth }) => {
 
 // ==================== ADMIN PANEL ====================
 const AdminPanel = ({ onLogout }) => {
-  const [tab, setTab] = useState('dashboard'); // dashboard | branches | data
+  const [tab, setTab] = useState('dashboard'); // dashboard | branches | search | data
   const [dashboards, setDashboards] = useState([]);
   const [branches, setBranches] = useState([]);
   const [period, setPeriod] = useState('month');
@@ -213,6 +214,7 @@ const AdminPanel = ({ onLogout }) => {
   const [editBranch, setEditBranch] = useState(null);
   const [editForm, setEditForm] = useState({});
   const [toast, setToast] = useState(null);
+  const [reportSending, setReportSending] = useState(false);
 
   const sections = [
     { id: 'morning-events', label: 'Утренние мероприятия' },
@@ -233,6 +235,24 @@ const AdminPanel = ({ onLogout }) => {
   ];
 
   useEffect(() => { loadDashboards(); }, [period]);
+  // Живые обновления: сервер присылает пересчитанные строки изменившихся филиалов
+  useEffect(() => {
+    if (!window.EventSource) return;
+    const es = new EventSource(`${API_BASE_URL}/admin/stream?period=${period}`);
+    let opened = false;
+    es.onopen = () => { if (opened) loadDashboards(); opened = true; };
+    es.addEventListener('reset', () => loadDashboards());
+    es.addEventListener('delta', (e) => {
+      const d = JSON.parse(e.data);
+      setDashboards(prev => {
+        const byName = new Map(prev.map(b => [b.branch_name, b]));
+        d.removed.forEach(n => byName.delete(n));
+        d.branches.forEach(b => byName.set(b.branch_name, b));
+        return [...byName.values()].sort((a, b) => a.branch_name.localeCompare(b.branch_name));
+      });
+    });
+    return () => es.close();
+  }, [period]);
   useEffect(() => { if (tab === 'branches') loadBranches(); }, [tab]);
 
   const showToastMsg = (message, type = 'success') => { setToast({ message, type }); };
@@ -278,12 +298,22 @@ const AdminPanel = ({ onLogout }) => {
   const handleDeleteBranch = async (name) => {
     if (!confirm(`Удалить филиал "${name}" и ВСЕ его данные? Это необратимо!`)) return;
     try {
-      await api.request(`/admin/branches/${name}`, { method: 'DELETE' });
-      showToastMsg(`Филиал "${name}" удалён`);
+      const data = await api.request(`/admin/branches/${name}`, { method: 'DELETE' });
+      showToastMsg(data.message || `Филиал "${name}" удалён`);
       loadBranches(); loadDashboards();
     } catch (err) { showToastMsg(err.message, 'error'); }
   };
 
+  const handleSendNetworkReport = async () => {
+    setReportSending(true);
+    try {
+      const data = await api.request('/send-report/all', { method: 'POST', body: JSON.stringify({ period_type: period, mode: 'consolidated' }) });
+      if (data.success) showToastMsg(`Отчёт по сети отправлен (${data.branches_count} филиалов, ${data.total_records} записей)`);
+      else showToastMsg(data.message || 'Нет данных за выбранный период', 'error');
+    } catch (err) { showToastMsg(err.message, 'error'); }
+    setReportSending(false);
+  };
+
   const getPct = (item, key) => { const d = item[key]; return (!d || d.goal <= 0) ? 0 : Math.round((d.current / d.goal) * 100); };
 
   return (
@@ -297,6 +327,7 @@ const AdminPanel = ({ onLogout }) => {
         <div className="flex items-center gap-3">
           <button onClick={() => { setTab('dashboard'); setSelectedBranch(null); }} className={`px-3 py-1.5 rounded-lg text-sm font-medium ${tab === 'dashboard' ? 'bg-white/30' : 'bg-white/10 hover:bg-white/20'}`}>Сводка</button>
           <button onClick={() => setTab('branches')} className={`px-3 py-1.5 rounded-lg text-sm font-medium ${tab === 'branches' ? 'bg-white/30' : 'bg-white/10 hover:bg-white/20'}`}>Филиалы</button>
+          <button onClick={() => setTab('search')} className={`px-3 py-1.5 rounded-lg text-sm font-medium ${tab === 'search' ? 'bg-white/30' : 'bg-white/10 hover:bg-white/20'}`}>Поиск</button>
           <button onClick={onLogout} className="px-3 py-1.5 bg-white/20 rounded-lg hover:bg-white/30 text-sm font-medium ml-2">Выйти</button>
         </div>
       </header>
@@ -307,6 +338,7 @@ const AdminPanel = ({ onLogout }) => {
           <button key={p.id} onClick={() => setPeriod(p.id)} className={`px-3 py-1.5 rounded-full text-sm font-medium transition ${period === p.id ? 'bg-purple-600 text-white' : 'bg-white text-gray-700 hover:bg-gray-100 border'}`}>{p.label}</button>
         ))}
         {periodLabel && <span className="self-center text-sm text-gray-500 ml-2">{periodLabel}</span>}
+        <button onClick={handleSendNetworkReport} disabled={reportSending} className="ml-auto px-3 py-1.5 rounded-full text-sm font-medium bg-green-600 text-white hover:bg-green-700 disabled:opacity-50">{reportSending ? 'Отправка...' : '📧 Отчёт по сети'}</button>
       </div>
 
       <div className="p-6">
@@ -334,6 +366,12 @@ const AdminPanel = ({ onLogout }) => {
               </div>
             )}
           </div>
+        ) : tab === 'search' ? (
+          /* TAB: Full-text search */
+          <div>
+            <h2 className="text-2xl font-bold mb-6">Поиск по записям</h2>
+            <SearchPanel branches={dashboards.map(d => d.branch_name)} />
+          </div>
         ) : tab === 'branches' ? (
           /* TAB: Branch management */
           <div className="animate-fade-in">
@@ -423,6 +461,80 @@ const AdminPanel = ({ onLogout }) => {
     </div>
   );
 };
+// ==================== SEARCH ====================
+const SEARCH_SECTIONS = { 'one-on-one': 'One-on-One', 'field-visits': 'Полевые выходы', 'morning-events': 'Утренние мероприятия' };
+
+// Сниппет приходит с <mark>…</mark>; рендерим без innerHTML, текст записей не доверенный
+const Highlight = ({ text }) => (
+  <>{(text || '').split(/<\/?mark>/).map((part, i) => i % 2 ? <mark key={i} className="bg-yellow-200 rounded px-0.5">{part}</mark> : <span key={i}>{part}</span>)}</>
+);
+
+const SearchPanel = ({ branch, branches = [] }) => {
+  const [query, setQuery] = useState('');
+  const [section, setSection] = useState('');
+  const [branchFilter, setBranchFilter] = useState('');
+  const [page, setPage] = useState(1);
+  const [result, setResult] = useState(null);
+  const [loading, setLoading] = useState(false);
+  const [error, setError] = useState(null);
+
+  const runSearch = async (p = 1) => {
+    if (query.trim().length < 2) return;
+    setLoading(true); setError(null);
+    try {
+      const params = new URLSearchParams({ q: query.trim(), page: p, limit: 20 });
+      if (branch || branchFilter) params.set('branch', branch || branchFilter);
+      if (section) params.set('section', section);
+      const data = await api.request(`/search?${params}`);
+      setResult(data); setPage(p);
+    } catch (err) { setError(err.message); }
+    setLoading(false);
+  };
+
+  return (
+    <div className="space-y-4 animate-fade-in">
+      <form onSubmit={e => { e.preventDefault(); runSearch(1); }} className="bg-white rounded-xl shadow-sm p-4 flex flex-wrap gap-3 items-center">
+        <input type="text" value={query} onChange={e => setQuery(e.target.value)} placeholder="Например: косметика, стандарты, цель на месяц" className="flex-1 min-w-[240px] px-4 py-2 border rounded-lg" />
+        <select value={section} onChange={e => setSection(e.target.value)} className="px-3 py-2 border rounded-lg text-sm">
+          <option value="">Все разделы</option>
+          {Object.entries(SEARCH_SECTIONS).map(([id, label]) => <option key={id} value={id}>{label}</option>)}
+        </select>
+        {!branch && (
+          <select value={branchFilter} onChange={e => setBranchFilter(e.target.value)} className="px-3 py-2 border rounded-lg text-sm">
+            <option value="">Все филиалы</option>
+            {branches.map(b => <option key={b} value={b}>{b}</option>)}
+          </select>
+        )}
+        <button type="submit" disabled={loading} className="px-4 py-2 bg-blue-600 text-white rounded-lg hover:bg-blue-700 text-sm font-medium disabled:opacity-50">{loading ? 'Поиск...' : 'Найти'}</button>
+      </form>
+      {error && <div className="bg-red-50 text-red-700 rounded-xl p-4 text-sm">{error}</div>}
+      {result && (
+        <div className="space-y-3">
+          <div className="text-sm text-gray-500">Найдено: {result.total}</div>
+          {result.results.map(r => (
+            <div key={`${r.section}-${r.id}`} className="bg-white rounded-xl shadow-sm p-4 border border-gray-100">
+              <div className="flex flex-wrap items-center gap-2 text-xs text-gray-500 mb-2">
+                <span className="px-2 py-0.5 bg-blue-50 text-blue-700 rounded-full font-medium">{SEARCH_SECTIONS[r.section] || r.section}</span>
+                {!branch && <span className="font-medium text-gray-700">{r.branch_name}</span>}
+                <span>{r.date || r.submitted_at}</span>
+                {r.title && <span>• {r.title}</span>}
+              </div>
+              <div className="text-sm text-gray-800"><Highlight text={r.snippet} /></div>
+            </div>
+          ))}
+          {result.pages > 1 && (
+            <div className="flex items-center gap-3">
+              <button disabled={page <= 1 || loading} onClick={() => runSearch(page - 1)} className="px-3 py-1.5 bg-white border rounded-lg text-sm disabled:opacity-50">← Назад</button>
+              <span className="text-sm text-gray-500">{page} / {result.pages}</span>
+              <button disabled={page >= result.pages || loading} onClick={() => runSearch(page + 1)} className="px-3 py-1.5 bg-white border rounded-lg text-sm disabled:opacity-50">Вперёд →</button>
+            </div>
+          )}
+        </div>
+      )}
+    </div>
+  );
+};
+
 // ==================== EDITABLE TABLE (for branch history views) ====================
 const EditableTable = ({ data, section, onRefresh }) => {
   const [editingId, setEditingId] = useState(null);
@@ -525,6 +637,7 @@ const BarberCRM = ({ branch, token, onLogout }) => {
     { id: 'master-plans', label: 'Планы мастеров', icon: Icons.Target },
     { id: 'reviews', label: 'Отзывы', icon: Icons.ChatAlt },
     { id: 'branch-summary', label: 'Сводка', icon: Icons.ClipboardList },
+    { id: 'search', label: 'Поиск', icon: Icons.Search },
   ];
 
   return (
@@ -609,6 +722,7 @@ const BarberCRM = ({ branch, token, onLogout }) => {
           {currentView === 'master-plans' && <MasterPlansPage branch={branch} showToast={showToast} />}
           {currentView === 'reviews' && <ReviewsPage branch={branch} showToast={showToast} />}
           {currentView === 'branch-summary' && <BranchSummaryPage branch={branch} showToast={showToast} />}
+          {currentView === 'search' && <SearchPanel branch={branch.name} />}
         </div>
       </div>
     </div>
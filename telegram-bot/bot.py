@@ -7,7 +7,9 @@ BarberCRM Telegram Bot — бот для руководителя (только
 """
 
 import os
+import re
 import logging
+from urllib.parse import urlencode
 import httpx
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
@@ -152,6 +154,33 @@ def format_records(records: list[dict], section: str, branch: str) -> str:
     return "\n".join(lines)
 
 
+SEARCH_SECTIONS = {
+    "one-on-one": "One-on-One",
+    "field-visits": "Полевые выходы",
+    "morning-events": "Утренние мероприятия",
+}
+
+
+def _highlight(snippet: str) -> str:
+    """Сниппет с <mark>…</mark> → MarkdownV2 с жирными совпадениями."""
+    parts = re.split(r"</?mark>", snippet or "")
+    return "".join(f"*{_esc(p)}*" if i % 2 else _esc(p) for i, p in enumerate(parts))
+
+
+def format_search(data: dict, query: str) -> str:
+    results = data.get("results", [])
+    if not results:
+        return f"🔎 По запросу «{_esc(query)}» ничего не найдено\\."
+    lines = [f"🔎 *{_esc(query)}* — найдено: {data.get('total', len(results))}\n"]
+    for r in results:
+        section = SEARCH_SECTIONS.get(r.get("section"), r.get("section", ""))
+        lines.append(f"*{_esc(section)}* · {_esc(r.get('branch_name', ''))} · {_esc(str(r.get('date') or r.get('submitted_at', '')))}")
+        if r.get("title"):
+            lines.append(f"👤 {_esc(str(r['title']))}")
+        lines.append(f"{_highlight(r.get('snippet', ''))}\n")
+    return "\n".join(lines)
+
+
 def _split(text: str, limit: int = 4000) -> list[str]:
     if len(text) <= limit:
         return [text]
@@ -260,6 +289,7 @@ async def main_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
             "⭐ *Отзывы*\n"
             "👶 *Адаптация новичков*\n"
             "📝 *Итоговые отчёты*\n\n"
+            "🔎 /search текст — поиск по записям\n"
             "🚪 *Выйти* — завершить сессию",
             KB_MAIN,
         )
@@ -322,6 +352,30 @@ async def branch_menu(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     return BRANCH_MENU
 
 
+async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> None:
+    """/search <текст> — поиск по записям (в выбранном филиале, если он выбран)."""
+    user = update.effective_user
+    if BOT_ACCESS_PASSWORD and user.id not in authorized_users:
+        await update.message.reply_text("🔐 Сначала войдите: /start")
+        return
+
+    query = " ".join(ctx.args or []).strip()
+    if len(query) < 2:
+        await update.message.reply_text("Использование: /search <текст>\nНапример: /search косметика")
+        return
+
+    params = {"q": query, "limit": 10}
+    branch = ctx.user_data.get("branch")
+    if branch:
+        params["branch"] = branch
+    await update.message.reply_text("⏳ Ищу…")
+    data = await api_get(f"search?{urlencode(params)}")
+    if data and data.get("success"):
+        await _send(update, format_search(data, query))
+    else:
+        await update.message.reply_text("❌ Ошибка поиска")
+
+
 async def cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> int:
     ctx.user_data.clear()
     await update.message.reply_text("Бот остановлен. /start для запуска.", reply_markup=ReplyKeyboardRemove())
@@ -352,6 +406,7 @@ def main():
         fallbacks=[CommandHandler("cancel", cancel), CommandHandler("start", cmd_start)],
         allow_reentry=True,
     ))
+    app.add_handler(CommandHandler("search", cmd_search))
 
     logger.info("🤖 BarberCRM Bot запущен (пароль: %s)", "ДА" if BOT_ACCESS_PASSWORD else "НЕТ")
     app.run_polling(allowed_updates=Update.ALL_TYPES)